@@ -0,0 +1,407 @@
+import argparse
+import asyncio
+import json
+import time
+import typing
+from connection import CONGESTION_CONTROL, MAX_RETRIES, Connection, RttEstimator, generate_seqnum, increment_seqnum
+from compression import CODECS, COMPRESSION, decompressor
+from congestion import CONGESTION_CONTROLS
+from integrity import DIGEST_ALGORITHM, DIGEST_ALGORITHMS, ContentDigest, ContentVerifier
+from log import log
+from node import HandshakeError, MessageInfo, Node
+from pmtu import PMTU_MODE, PMTU_MODES
+from stats import SNAPSHOT_INTERVAL, start_exporters
+from segment import FIN_ACK_BYTES, FIN_BYTES, MAX_PAYLOAD, MIN_PAYLOAD, Segment, SegmentError
+from transfer import MAX_TIMEOUTS, FileTransfer, TransferError
+
+
+# File received from a peer: the metadata, then the chunks in order
+class FileReception:
+  def __init__(self, done: asyncio.Future) -> None:
+    self.addr: typing.Optional[typing.Tuple[str, int]] = None
+    self.metadata: typing.Optional[dict] = None
+    self.chunks: typing.List[bytes] = []
+    # resolved once the peer closed the connection
+    self.done = done
+
+  @property
+  def data(self):
+    return b"".join(self.chunks)
+
+# Forwards the datagrams of the endpoint to the node
+class NodeProtocol(asyncio.DatagramProtocol):
+  def __init__(self, node) -> None:
+    self.node = node
+
+  def datagram_received(self, data: bytes, addr: typing.Tuple[str, int]):
+    self.node.datagram_received(data, addr)
+
+  def error_received(self, exc: Exception):
+    log.warning(str(exc))
+
+# Node driven by an asyncio event loop (loop.create_datagram_endpoint on the bound socket of the
+# node). Datagrams are handled as they arrive and every wait is a timer of the loop, so one thread
+# serves any number of peers. The protocol is the one of Node, only the steps that block there (the
+# passive handshake and termination) are tasks here, and file transfers are driven through the
+# event driven interface of FileTransfer. It talks to blocking Server and Client nodes: recv_file
+# requests a file like Client, connect and send_file serve one like Server.
+class AsyncNode(Node):
+  def __init__(self, ip: str, port: int) -> None:
+    super().__init__(ip, port)
+    # the transport reads the socket without its control messages, the kernel drops go unreported
+    self.socket_stats.kernel_drops = None
+    self.register_handler(self.handle_message)
+    self.register_on_close(self.__on_closed)
+    self.transport: typing.Optional[asyncio.DatagramTransport] = None
+    # addresses of the peers that requested a file (syn from an unknown peer nobody waits for)
+    self.requests: asyncio.Queue = asyncio.Queue()
+    # byte range asked by a requesting peer instead of the whole file (OPTION_RANGE)
+    self.request_ranges: typing.Dict[typing.Tuple[str, int], typing.Tuple[int, int]] = {}
+    # files being received, keyed by peer, None for the first peer that connects
+    self.__receptions: typing.Dict[typing.Optional[typing.Tuple[str, int]], FileReception] = {}
+    # event driven tasks (start, on_segment, on_timer, deadline, is_done) with their timer and future
+    self.__tasks: typing.Dict[typing.Tuple[str, int], typing.Tuple[typing.Any, typing.Optional[asyncio.TimerHandle], asyncio.Future]] = {}
+    # (is_done, future) of the coroutines in wait_until
+    self.__waiters: typing.List[typing.Tuple[typing.Callable[[], bool], asyncio.Future]] = []
+    self.__ack_timer: typing.Optional[asyncio.TimerHandle] = None
+
+  # Opens the datagram endpoint, the other coroutines call it when needed
+  async def run(self):
+    if self.transport is None:
+      loop = asyncio.get_running_loop()
+      self.transport, _ = await loop.create_datagram_endpoint(lambda: NodeProtocol(self), sock=self.get_socket())
+
+  def send_encoded(self, ip_remote: str, port_remote: int, headers: bytes, payload: bytes):
+    self.count_sent(ip_remote, port_remote, len(headers) + len(payload))
+    self.transport.sendto(headers + payload if payload else headers, (ip_remote, port_remote))
+
+  # The transport queues what the socket does not take, a batch goes through it datagram by datagram
+  def send_batch(self, ip_remote: str, port_remote: int, datagrams: typing.List[typing.Tuple[bytes, bytes]]):
+    self.follow_window(ip_remote, port_remote)
+    for headers, payload in datagrams:
+      self.send_encoded(ip_remote, port_remote, headers, payload)
+
+  def send_bytes(self, ip_remote: str, port_remote: int, data: bytes):
+    self.count_sent(ip_remote, port_remote, len(data))
+    self.transport.sendto(data, (ip_remote, port_remote))
+
+  def datagram_received(self, data: bytes, addr: typing.Tuple[str, int]):
+    try:
+      segment, checksum_valid = Segment.from_bytes(data)
+    except SegmentError as e:
+      log.warning(str(e))
+      return
+    if checksum_valid and segment.flags.syn and not segment.flags.ack:
+      self.__on_syn(addr, segment)
+    elif checksum_valid and segment.flags.fin and not segment.flags.ack:
+      self.__on_fin(addr)
+    elif self.receive_segment(addr, segment, checksum_valid):
+      task = self.__tasks.get(addr)
+      if task is not None:
+        task[0].on_segment(segment)
+        self.__schedule(addr)
+    self.__notify()
+    self.__schedule_ack_flush()
+
+  # Resolves the waiters that are done
+  def __notify(self):
+    for is_done, future in self.__waiters:
+      if not future.done() and is_done():
+        future.set_result(True)
+
+  def __schedule_ack_flush(self):
+    deadline = self.next_ack_deadline()
+    if deadline is None or (self.__ack_timer is not None and self.__ack_timer.when() <= deadline):
+      return
+    if self.__ack_timer is not None:
+      self.__ack_timer.cancel()
+    # the loop clock is time.monotonic, like the deadlines
+    self.__ack_timer = asyncio.get_running_loop().call_at(deadline, self.__flush_acks)
+
+  def __flush_acks(self):
+    self.__ack_timer = None
+    self.flush_delayed_acks()
+    self.__schedule_ack_flush()
+
+  # Like Node.wait_for, resend is called each time the retransmission timeout of rtt expires
+  # Returns the number of attempts, or None if it is still not done after retries attempts (None retries forever)
+  async def wait_until(self, is_done: typing.Callable[[], bool], resend: typing.Callable[[], None], rtt: RttEstimator, retries: typing.Optional[int] = MAX_RETRIES):
+    attempts = 1
+    while not is_done():
+      waiter = (is_done, asyncio.get_running_loop().create_future())
+      self.__waiters.append(waiter)
+      try:
+        await asyncio.wait_for(waiter[1], rtt.rto)
+      except asyncio.TimeoutError:
+        if retries is not None and attempts >= retries:
+          return None
+        attempts += 1
+        rtt.on_timeout()
+        resend()
+      finally:
+        self.__waiters.remove(waiter)
+    return attempts
+
+  # Runs an event driven task (FileTransfer) to completion, its timer is a timer of the loop
+  async def run_task(self, addr: typing.Tuple[str, int], task):
+    done = asyncio.get_running_loop().create_future()
+    self.__tasks[addr] = (task, None, done)
+    try:
+      task.start()
+      self.__schedule(addr)
+      await done
+    finally:
+      timer = self.__tasks.pop(addr)[1]
+      if timer is not None:
+        timer.cancel()
+    return task
+
+  def __schedule(self, addr: typing.Tuple[str, int]):
+    task, timer, done = self.__tasks[addr]
+    if timer is not None:
+      timer.cancel()
+      timer = None
+    if task.is_done or task.is_failed:
+      if not done.done():
+        done.set_result(task)
+    else:
+      deadline = task.deadline()
+      if deadline is not None:
+        timer = asyncio.get_running_loop().call_at(deadline, self.__on_timer, addr)
+    self.__tasks[addr] = (task, timer, done)
+
+  def __on_timer(self, addr: typing.Tuple[str, int]):
+    self.__tasks[addr][0].on_timer()
+    self.__schedule(addr)
+
+  # Active open, like Node.handshake
+  async def connect(self, ip: str, port: int):
+    await self.run()
+    # path probes block on a socket of their own until each is answered or times out, they run
+    # off the loop and open_connection finds the payload known
+    if self.path_payloads.mode == "probe":
+      await asyncio.get_running_loop().run_in_executor(None, self.path_payloads.get, ip, port, self.payload_size)
+    sent_at = time.monotonic()
+    connection = self.open_connection(ip, port)
+    def resend():
+      log.debug("[Handshake] Timeout, resending syn")
+      self.send(ip, port, Segment.syn(connection.send.seq_num, self.syn_options(connection)))
+    attempts = await self.wait_until(lambda: connection.send.is_connected, resend, connection.send.rtt)
+    if attempts is None:
+      self.connections.pop((ip, port), None)
+      raise HandshakeError()
+    # first rtt sample, only if the syn was not resent (Karn's rule)
+    if attempts == 1:
+      connection.send.rtt.sample(time.monotonic() - sent_at)
+    return connection
+
+  # Sends a file (or the chunks covering byte_range) to a peer, connecting first if needed,
+  # returns the FileTransfer
+  async def send_file(self, ip: str, port: int, file_path: str, byte_range: typing.Optional[typing.Tuple[int, int]] = None):
+    connection = self.connections.get((ip, port))
+    if connection is None or not connection.send.is_connected:
+      connection = await self.connect(ip, port)
+    transfer = FileTransfer(self, connection, file_path, byte_range=byte_range)
+    try:
+      await self.run_task((ip, port), transfer)
+    finally:
+      transfer.close()
+    if transfer.is_failed:
+      self.connections.pop((ip, port), None)
+      raise TransferError(f"no ack from {ip}:{port} after {MAX_TIMEOUTS} timeouts")
+    log.info(f"[!] Finished sending to {ip}:{port} ({transfer.retransmissions} retransmissions)")
+    return transfer
+
+  # Receives a file, until the peer closes the connection. With request, a syn asks the peer for
+  # it first like Client does, without a peer the first one that connects sends it (p2p)
+  async def recv_file(self, ip: typing.Optional[str] = None, port: typing.Optional[int] = None, request: bool = True):
+    await self.run()
+    key = (ip, port) if ip is not None else None
+    reception = FileReception(asyncio.get_running_loop().create_future())
+    reception.addr = key
+    self.__receptions[key] = reception
+    try:
+      if request and key is not None:
+        log.info(f"[!] Sent SYN to {ip}:{port}")
+        self.send(ip, port, Segment.syn(0))
+      await reception.done
+    finally:
+      self.__receptions.pop(key, None)
+      self.__receptions.pop(reception.addr, None)
+    return reception
+
+  # Address of the next peer that requested a file
+  async def accept_request(self):
+    await self.run()
+    return await self.requests.get()
+
+  # Termination, like Node.end_connection
+  async def disconnect(self, ip: str, port: int):
+    connection = self.connections.get((ip, port))
+    if connection is None:
+      return
+    self.send_bytes(ip, port, FIN_BYTES)
+    if await self.wait_until(lambda: (ip, port) not in self.connections, lambda: self.send_bytes(ip, port, FIN_BYTES), connection.send.rtt) is None:
+      log.warning(f"[Termination] No FIN ACK from {ip}:{port}, closing")
+      self.connections.pop((ip, port), None)
+
+  # Ends every connection, then closes the endpoint
+  async def close(self):
+    await asyncio.gather(*(self.disconnect(ip, port) for (ip, port), connection in list(self.connections.items()) if connection.send.is_connected))
+    if self.__ack_timer is not None:
+      self.__ack_timer.cancel()
+    if self.transport is not None:
+      # the transport owns the socket from run on
+      self.transport.close()
+      self.release()
+    else:
+      super().close()
+
+  # Passive open: the peer a reception waits for connects, other unknown peers are requests
+  def __on_syn(self, addr: typing.Tuple[str, int], segment: Segment):
+    connection = self.connections.get(addr)
+    if connection is not None:
+      # our syn ack was lost
+      if not connection.send.is_connected:
+        self.send(addr[0], addr[1], Segment.syn_ack(connection.send.seq_num, connection.receive.seq_num, self.syn_options(connection)))
+      return
+    if addr not in self.__receptions:
+      if None not in self.__receptions:
+        log.info(f"[!] Received request from {addr[0]}:{addr[1]}")
+        if segment.range is not None:
+          self.request_ranges[addr] = segment.range
+        self.requests.put_nowait(addr)
+        return
+      reception = self.__receptions.pop(None)
+      reception.addr = addr
+      self.__receptions[addr] = reception
+    new_connection = Connection(self.ip, self.port, addr[0], addr[1])
+    new_connection.receive.seq_num = increment_seqnum(segment.seq_num)
+    new_connection.receive.is_connected = True
+    new_connection.send.seq_num = generate_seqnum()
+    self.set_windows(new_connection)
+    new_connection.receive.payload_size = self.path_payloads.get(addr[0], addr[1], self.payload_size, active=False)
+    self.connections[addr] = new_connection
+    new_connection.stats.socket = self.socket_stats
+    self.stats.add(new_connection)
+    self.negotiate(new_connection, segment)
+    log.debug(f"[Handshake] Received SYN from {addr[0]}:{addr[1]}")
+    asyncio.get_running_loop().create_task(self.__accept(addr, new_connection))
+
+  async def __accept(self, addr: typing.Tuple[str, int], connection: Connection):
+    def resend():
+      self.send(addr[0], addr[1], Segment.syn_ack(connection.send.seq_num, connection.receive.seq_num, self.syn_options(connection)))
+    sent_at = time.monotonic()
+    resend()
+    attempts = await self.wait_until(lambda: connection.send.is_connected, resend, connection.send.rtt)
+    if attempts is None:
+      log.warning(f"[Handshake] No ACK from {addr[0]}:{addr[1]}")
+      self.connections.pop(addr, None)
+      self.__on_closed(MessageInfo(addr[0], addr[1], Segment.fin()))
+      return
+    if attempts == 1:
+      connection.send.rtt.sample(time.monotonic() - sent_at)
+    log.info(f"[Handshake] Connection established {addr[0]}:{addr[1]}")
+
+  def __on_fin(self, addr: typing.Tuple[str, int]):
+    log.debug("[~] Received FIN")
+    connection = self.connections.get(addr)
+    if connection is None or not connection.receive.is_connected:
+      return
+    self.complete_handshake(addr, connection, Segment.fin())
+    connection.receive.is_connected = False
+    self.send_bytes(addr[0], addr[1], FIN_ACK_BYTES)
+    asyncio.get_running_loop().create_task(self.__close_passive(addr, connection))
+
+  async def __close_passive(self, addr: typing.Tuple[str, int], connection: Connection):
+    if await self.wait_until(lambda: not connection.send.is_connected, lambda: self.send_bytes(addr[0], addr[1], FIN_ACK_BYTES), connection.send.rtt) is None:
+      # the peer is gone or only the last ack was lost, close anyway
+      self.connections.pop(addr, None)
+      connection.send.is_connected = False
+      self.__on_closed(MessageInfo(addr[0], addr[1], Segment.fin()))
+    log.info(f"[Termination] Connection closed {addr[0]}:{addr[1]}")
+
+  def __on_closed(self, message: MessageInfo):
+    reception = self.__receptions.get((message.ip, message.port))
+    if reception is not None and not reception.done.done():
+      reception.done.set_result(reception)
+
+  def handle_message(self, message: MessageInfo):
+    reception = self.__receptions.get((message.ip, message.port))
+    if reception is None:
+      return
+    if reception.metadata is None:
+      reception.metadata = json.loads(bytes(message.segment.payload))
+    elif message.segment.compressed:
+      reception.chunks.append(decompressor(reception.metadata['compression'])(message.segment.payload))
+    else:
+      # the payload is a view into the datagram, only valid while it is handled
+      reception.chunks.append(bytes(message.segment.payload))
+    if log.tracing:
+      log.trace("[Segment SEQ=%d] Received, Ack sent", message.segment.seq_num)
+
+# Serves file_path to every peer that requests it, concurrently
+async def serve(node: AsyncNode, file_path: str):
+  async def send(addr: typing.Tuple[str, int]):
+    try:
+      await node.send_file(addr[0], addr[1], file_path, node.request_ranges.pop(addr, None))
+      await node.disconnect(addr[0], addr[1])
+    except (HandshakeError, TransferError) as e:
+      log.error(str(e))
+  log.info("[!] Listening for broadcast request for clients.\n")
+  while True:
+    addr = await node.accept_request()
+    asyncio.get_running_loop().create_task(send(addr))
+
+async def receive(node: AsyncNode, server_ip: str, server_port: int, output_path: str):
+  reception = await node.recv_file(server_ip, server_port)
+  await node.close()
+  path = "output/" + output_path
+  if reception.metadata is not None:
+    path += '.' + reception.metadata['extension']
+  data = reception.data
+  with open(path, "wb") as f:
+    f.write(data)
+  if reception.metadata is not None and 'digest' in reception.metadata:
+    verifier = ContentVerifier(ContentDigest.from_metadata(reception.metadata['digest']), len(data))
+    verifier.update(0, data)
+    if verifier.check():
+      log.info(f"[!] Content verified ({verifier.digest.algorithm})")
+    else:
+      log.error(f"[!] Content does not match ({verifier.digest.algorithm})")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", type=str, choices=("serve", "recv"))
+    parser.add_argument("port", type=int)
+    parser.add_argument("path", type=str)
+    parser.add_argument("server_port", type=int, nargs="?")
+    parser.add_argument("--congestion", type=str, default=CONGESTION_CONTROL, choices=CONGESTION_CONTROLS)
+    parser.add_argument("--compression", type=str, default=COMPRESSION, choices=list(CODECS), help="codec of the chunks sent, raw by default")
+    parser.add_argument("--pmtu", type=str, default=PMTU_MODE, choices=PMTU_MODES, help="how the payload size towards a peer is found")
+    parser.add_argument("--payload-size", type=int, default=MAX_PAYLOAD, help="largest payload taken, in bytes")
+    parser.add_argument("--digest", type=str, default=DIGEST_ALGORITHM, choices=DIGEST_ALGORITHMS, help="digest of the content sent in the metadata")
+    parser.add_argument("--no-block-hashes", action="store_true", help="only the whole content digest, no per block hashes")
+    parser.add_argument("--stats-file", type=str, default=None, help="writes a json snapshot of the connection statistics there")
+    parser.add_argument("--stats-interval", type=float, default=SNAPSHOT_INTERVAL, help="seconds between two snapshots")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serves the statistics in the prometheus format on this port")
+    log.add_arguments(parser)
+    args = parser.parse_args()
+    log.from_args(args)
+
+    node = AsyncNode('127.0.0.1', args.port)
+    node.congestion_control = args.congestion
+    node.compression = args.compression
+    node.payload_size = min(max(args.payload_size, MIN_PAYLOAD), MAX_PAYLOAD)
+    node.path_payloads.mode = args.pmtu
+    node.digest_algorithm = args.digest
+    node.block_hashes = not args.no_block_hashes
+    exporters = start_exporters(node.stats, args.stats_file, args.stats_interval, args.metrics_port)
+    try:
+      if args.mode == "serve":
+        asyncio.run(serve(node, "input/" + args.path))
+      else:
+        asyncio.run(receive(node, '127.0.0.1', args.server_port, args.path))
+    finally:
+      for exporter in exporters:
+        exporter.close()
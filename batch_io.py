@@ -0,0 +1,429 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import struct
+import sys
+import typing
+from stats import SocketStats
+
+
+# sendmmsg and recvmmsg are linux system calls, other platforms send and receive one datagram a call
+HAS_MMSG = sys.platform.startswith("linux")
+# scatter gather send is not available on every platform (e.g. windows)
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")
+# segmentation offload: a run of equal datagrams to a peer is handed to the kernel as one buffer
+# it splits (UDP_SEGMENT, linux 4.18), not exposed by the socket module before python 3.12
+UDP_SEGMENT = getattr(socket, "UDP_SEGMENT", 103)
+SOL_UDP = getattr(socket, "SOL_UDP", 17)
+# most segments (UDP_MAX_SEGMENTS) and bytes (largest udp payload) of one offloaded send
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65507
+# messages handed to one sendmmsg, and most datagrams one recvmmsg reads
+SEND_BATCH = 64
+RECEIVE_BATCH = 8
+# seconds a send waits for room in the socket send buffer, None waits as long as it takes. Sends
+# do not follow the timeout of the socket, which receive sets for reads (0 on the event loop)
+SEND_TIMEOUT = None
+MSG_DONTWAIT = getattr(socket, "MSG_DONTWAIT", 0x40)
+# count of the datagrams the kernel dropped on the socket, sent along with the received ones once
+# there is any (linux 2.6.33), not exposed by the socket module
+SO_RXQ_OVFL = getattr(socket, "SO_RXQ_OVFL", 40)
+DROP_COUNT = struct.Struct("@I")
+# control message space of one received datagram, room for the drop count
+RECEIVE_CONTROL_SIZE = socket.CMSG_SPACE(DROP_COUNT.size) if hasattr(socket, "CMSG_SPACE") else 0
+
+class iovec(ctypes.Structure):
+  _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class msghdr(ctypes.Structure):
+  _fields_ = [
+    ("msg_name", ctypes.c_void_p),
+    ("msg_namelen", ctypes.c_uint32),
+    ("msg_iov", ctypes.POINTER(iovec)),
+    ("msg_iovlen", ctypes.c_size_t),
+    ("msg_control", ctypes.c_void_p),
+    ("msg_controllen", ctypes.c_size_t),
+    ("msg_flags", ctypes.c_int),
+  ]
+
+class mmsghdr(ctypes.Structure):
+  _fields_ = [("msg_hdr", msghdr), ("msg_len", ctypes.c_uint)]
+
+class sockaddr_in(ctypes.Structure):
+  _fields_ = [("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_uint16), ("sin_addr", ctypes.c_ubyte * 4), ("sin_zero", ctypes.c_ubyte * 8)]
+
+# Buffer export of the C API, gives the address of read only buffers (memoryviews into the input
+# mappings) that ctypes cannot take
+class Py_buffer(ctypes.Structure):
+  _fields_ = [
+    ("buf", ctypes.c_void_p),
+    ("obj", ctypes.c_void_p),
+    ("len", ctypes.c_ssize_t),
+    ("itemsize", ctypes.c_ssize_t),
+    ("readonly", ctypes.c_int),
+    ("ndim", ctypes.c_int),
+    ("format", ctypes.c_char_p),
+    ("shape", ctypes.c_void_p),
+    ("strides", ctypes.c_void_p),
+    ("suboffsets", ctypes.c_void_p),
+    ("internal", ctypes.c_void_p),
+  ]
+
+def load_libc():
+  if not HAS_MMSG:
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    return libc
+  except (OSError, AttributeError):
+    return None
+
+# Format of a ctypes structure for struct, nested structures flattened and padding made explicit
+def struct_format(structure, offset: int = 0):
+  codes = {ctypes.c_void_p: "P", ctypes.c_uint32: "I", ctypes.c_uint: "I", ctypes.c_int: "i", ctypes.c_size_t: "N"}
+  fields = ""
+  end = offset
+  for name, kind in structure._fields_:
+    field = getattr(structure, name)
+    fields += "x" * (offset + field.offset - end)
+    if issubclass(kind, ctypes.Structure):
+      fields += struct_format(kind, offset + field.offset)
+    else:
+      fields += codes.get(kind, "P")
+    end = offset + field.offset + field.size
+  return fields + "x" * (offset + ctypes.sizeof(structure) - end)
+
+MMSGHDR = struct.Struct("@" + struct_format(mmsghdr))
+IOVEC = struct.Struct("@" + struct_format(iovec))
+# length received in each mmsghdr
+MSG_LEN = struct.Struct("@I")
+MSG_LEN_OFFSET = mmsghdr.msg_len.offset
+# control message length of each mmsghdr, set before a receive and written back by the kernel
+CONTROL_LEN = struct.Struct("@N")
+CONTROL_LEN_OFFSET = mmsghdr.msg_hdr.offset + msghdr.msg_controllen.offset
+# cmsghdr: length, level and type, the data follows at CMSG_LEN(0)
+CMSG_HEADER = struct.Struct("@Nii")
+CMSG_DATA_OFFSET = socket.CMSG_LEN(0) if hasattr(socket, "CMSG_LEN") else CMSG_HEADER.size
+# headers and payload of a datagram
+IOVEC_PAIR = struct.Struct("@" + 2 * struct_format(iovec))
+
+libc = load_libc()
+
+# buffer export functions of the C API, called with the address of a Py_buffer; an export keeps
+# the data of an object in place (and alive) until it is released
+get_buffer = ctypes.PYFUNCTYPE(ctypes.c_int, ctypes.py_object, ctypes.c_void_p, ctypes.c_int)(("PyObject_GetBuffer", ctypes.pythonapi))
+release_buffer = ctypes.PYFUNCTYPE(None, ctypes.c_void_p)(("PyBuffer_Release", ctypes.pythonapi))
+# PyObject_GetBuffer flags: any buffer, or one the kernel may write into
+PYBUF_SIMPLE = 0
+PYBUF_WRITABLE = 1
+BUFFER_POINTER = struct.Struct("@P")
+BUFFER_POINTER_OFFSET = Py_buffer.buf.offset
+
+# Whether the kernel takes UDP_SEGMENT on sock (0 leaves sends as they are)
+def supports_gso(sock: socket.socket):
+  if not HAS_MMSG:
+    return False
+  try:
+    sock.setsockopt(SOL_UDP, UDP_SEGMENT, 0)
+    return True
+  except OSError:
+    return False
+
+# Whether the kernel reports its drops on sock (SO_RXQ_OVFL), turned on if so
+def enable_drop_count(sock: socket.socket):
+  if not HAS_MMSG or not RECEIVE_CONTROL_SIZE:
+    return False
+  try:
+    sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+    return True
+  except OSError:
+    return False
+
+# (view, address, size) of memory the kernel reads or writes in place: the ctypes view holds an
+# export of buffer, which can be neither freed nor resized for as long as the view is kept
+def pin(buffer: bytearray):
+  view = ctypes.c_char.from_buffer(buffer)
+  return view, ctypes.addressof(view), len(buffer)
+
+# Buffer exports of the data a system call reads or writes in place, whatever the object (bytes,
+# bytearrays, memoryviews into the input mappings that ctypes cannot take), in an array of
+# Py_buffer reused from call to call. The addresses stay valid until release.
+class BufferExports:
+  def __init__(self, capacity: int) -> None:
+    self.count = 0
+    self.capacity = 0
+    self.reserve(capacity)
+
+  # Room for size exports, only while none is held
+  def reserve(self, size: int):
+    if size > self.capacity:
+      self.capacity = size
+      self.storage = bytearray(size * ctypes.sizeof(Py_buffer))
+      self.__pin = pin(self.storage)
+
+  # Exports data, returns the address of its bytes
+  def address_of(self, data, flags: int = PYBUF_SIMPLE):
+    offset = self.count * ctypes.sizeof(Py_buffer)
+    get_buffer(data, self.__pin[1] + offset, flags)
+    self.count += 1
+    return BUFFER_POINTER.unpack_from(self.storage, offset + BUFFER_POINTER_OFFSET)[0]
+
+  def release(self):
+    for i in range(self.count):
+      release_buffer(self.__pin[1] + i * ctypes.sizeof(Py_buffer))
+    self.count = 0
+
+def pack_gso(segment_size: int):
+  header = struct.Struct(f"={'Q' if ctypes.sizeof(ctypes.c_size_t) == 8 else 'I'}ii")
+  # CMSG_LEN, padded to CMSG_SPACE
+  data = header.pack(header.size + 2, SOL_UDP, UDP_SEGMENT) + struct.pack("=H", segment_size)
+  return data + bytes(-len(data) % ctypes.sizeof(ctypes.c_size_t))
+
+# Batched datagram I/O on a bound udp socket: a burst of datagrams to a peer leaves in one
+# sendmmsg, runs of equal sized datagrams as one offloaded (UDP_SEGMENT) message in it, and
+# receive reads every queued datagram (up to the buffers given) in one recvmmsg. Without these
+# system calls each datagram is sent and received on its own. Receives keep the timeout
+# semantics of the socket: a timeout raises socket.timeout, a timeout of 0 BlockingIOError. Sends
+# wait for a full send buffer to drain within send_timeout, whatever the socket timeout is.
+# Given socket statistics, the drop count the kernel sends with the datagrams is kept in them.
+class BatchSocket:
+  def __init__(self, sock: socket.socket, stats: typing.Optional[SocketStats] = None) -> None:
+    self.sock = sock
+    self.mmsg = libc is not None
+    self.gso = self.mmsg and supports_gso(sock)
+    self.stats = stats
+    self.drop_count = stats is not None and enable_drop_count(sock)
+    self.send_timeout = SEND_TIMEOUT
+    if self.drop_count:
+      stats.kernel_drops = 0
+    # system calls and datagrams, to compare against one call per datagram
+    self.send_calls = 0
+    self.sent = 0
+    self.receive_calls = 0
+    self.received = 0
+    # packed sockaddr_in of each peer and control message of each segment size, pinned (pin) as
+    # the kernel reads them in place
+    self.__names: typing.Dict[typing.Tuple[str, int], typing.Tuple[ctypes.c_char, int, int]] = {}
+    self.__controls: typing.Dict[int, typing.Tuple[ctypes.c_char, int, int]] = {}
+    # sendmmsg headers and io vectors, packed for each call
+    self.__headers = bytearray(SEND_BATCH * MMSGHDR.size)
+    self.__iovecs = bytearray(2 * SEND_BATCH * IOVEC.size)
+    self.__headers_pin = pin(self.__headers)
+    self.__iovecs_pin = pin(self.__iovecs)
+    # segment headers of the datagrams, copied for each call
+    self.__arena = bytearray(SEND_BATCH * 64)
+    self.__arena_pin = pin(self.__arena)
+    # exports of the payloads during a call
+    self.__exports = BufferExports(SEND_BATCH)
+    self.__poll = select.poll() if hasattr(select, "poll") else None
+    if self.__poll is not None:
+      self.__poll.register(sock.fileno(), select.POLLIN)
+    # recvmmsg headers, each with its address, io vector and control space, packed once
+    self.__receive_headers = bytearray(RECEIVE_BATCH * MMSGHDR.size)
+    self.__receive_iovecs = bytearray(RECEIVE_BATCH * IOVEC.size)
+    self.__receive_names = bytearray(RECEIVE_BATCH * ctypes.sizeof(sockaddr_in))
+    self.__receive_controls = bytearray(RECEIVE_BATCH * RECEIVE_CONTROL_SIZE or 1)
+    self.__receive_pins = [pin(buffer) for buffer in (self.__receive_headers, self.__receive_iovecs, self.__receive_names, self.__receive_controls)]
+    self.__receive_headers_address, iovecs_address, names_address, controls_address = (address for _, address, _ in self.__receive_pins)
+    for i in range(RECEIVE_BATCH):
+      control_address = controls_address + i * RECEIVE_CONTROL_SIZE if self.drop_count else 0
+      MMSGHDR.pack_into(self.__receive_headers, i * MMSGHDR.size, names_address + i * ctypes.sizeof(sockaddr_in), ctypes.sizeof(sockaddr_in), iovecs_address + i * IOVEC.size, 1, control_address, RECEIVE_CONTROL_SIZE if self.drop_count else 0, 0, 0)
+    # address of each peer by its packed port and ip
+    self.__peers: typing.Dict[bytes, typing.Tuple[str, int]] = {}
+
+  # Sends datagrams (headers, payload) to addr, in order
+  def send(self, addr: typing.Tuple[str, int], datagrams: typing.List[typing.Tuple[bytes, bytes]]):
+    if not self.mmsg:
+      for headers, payload in datagrams:
+        self.send_one(addr, headers, payload)
+      return
+    messages = self.group(datagrams)
+    start = 0
+    while start < len(messages):
+      batch = messages[start:start + SEND_BATCH]
+      sent = self.__sendmmsg(addr, datagrams, batch)
+      if sent < len(batch):
+        # the device does not offload the segmentation, every datagram goes on its own from now on
+        self.gso = False
+        first = batch[sent][0]
+        messages = messages[:start + sent] + [(index, 1, 0) for index in range(first, len(datagrams))]
+      start += sent
+
+  # Sends a single datagram, headers and payload gathered by the kernel where it can
+  def send_one(self, addr: typing.Tuple[str, int], headers: bytes, payload: bytes = b""):
+    while True:
+      self.send_calls += 1
+      try:
+        if not payload:
+          self.sock.sendto(headers, addr)
+        elif HAS_SENDMSG:
+          self.sock.sendmsg([headers, payload], [], 0, addr)
+        else:
+          self.sock.sendto(headers + payload, addr)
+        break
+      except (BlockingIOError, socket.timeout):
+        # send buffer full, with the socket left non blocking or on a short receive timeout
+        self.__wait(select.POLLOUT, self.send_timeout)
+    self.sent += 1
+
+  # (first datagram, count, segment size or 0) of each message: with offload, a run of datagrams
+  # of the same size (the last one may be shorter) is one message
+  def group(self, datagrams: typing.List[typing.Tuple[bytes, bytes]]):
+    messages = []
+    sizes = [len(headers) + len(payload) for headers, payload in datagrams]
+    first = 0
+    while first < len(datagrams):
+      size = total = sizes[first]
+      count = 1
+      while self.gso and first + count < len(datagrams) and count < GSO_MAX_SEGMENTS and sizes[first + count] <= size and total + sizes[first + count] <= GSO_MAX_BYTES:
+        total += sizes[first + count]
+        count += 1
+        if sizes[first + count - 1] < size:
+          break
+      messages.append((first, count, size if count > 1 else 0))
+      first += count
+    return messages
+
+  # Sends messages in as few sendmmsg as the socket takes, returns how many were sent: all of
+  # them, or the ones before an offloaded message the kernel refused
+  # The headers and io vectors are packed into scratch memory (struct is much cheaper than
+  # setting ctypes fields), the data stays where it is
+  def __sendmmsg(self, addr: typing.Tuple[str, int], datagrams: typing.List[typing.Tuple[bytes, bytes]], messages: typing.List[typing.Tuple[int, int, int]]):
+    name = self.__names.get(addr)
+    if name is None:
+      name = self.__names[addr] = pin(bytearray(struct.pack("=H", socket.AF_INET) + struct.pack("!H", addr[1]) + socket.inet_aton(addr[0]) + bytes(8)))
+    iovec_count = 2 * sum(count for _, count, _ in messages)
+    if len(messages) * MMSGHDR.size > len(self.__headers) or iovec_count * IOVEC.size > len(self.__iovecs):
+      self.__headers = bytearray(max(len(messages) * MMSGHDR.size, len(self.__headers)))
+      self.__iovecs = bytearray(max(iovec_count * IOVEC.size, len(self.__iovecs)))
+      self.__headers_pin = pin(self.__headers)
+      self.__iovecs_pin = pin(self.__iovecs)
+    # segment headers are small, copying them beats exporting each one
+    arena_size = sum(len(headers_data) for headers_data, _ in datagrams[messages[0][0]:messages[-1][0] + messages[-1][1]])
+    if arena_size > len(self.__arena):
+      self.__arena = bytearray(arena_size)
+      self.__arena_pin = pin(self.__arena)
+    headers = self.__headers
+    iovecs = self.__iovecs
+    arena = self.__arena
+    headers_address = self.__headers_pin[1]
+    iovecs_address = self.__iovecs_pin[1]
+    arena_address = self.__arena_pin[1]
+    exports = self.__exports
+    exports.reserve(iovec_count)
+    slot = 0
+    position = 0
+    try:
+      for i, (first, count, gso_size) in enumerate(messages):
+        start = slot
+        for headers_data, payload in datagrams[first:first + count]:
+          size = len(headers_data)
+          arena[position:position + size] = headers_data
+          if len(payload):
+            IOVEC_PAIR.pack_into(iovecs, slot * IOVEC.size, arena_address + position, size, exports.address_of(payload), len(payload))
+            slot += 2
+          else:
+            IOVEC.pack_into(iovecs, slot * IOVEC.size, arena_address + position, size)
+            slot += 1
+          position += size
+        control_address = control_size = 0
+        if gso_size:
+          control = self.__controls.get(gso_size)
+          if control is None:
+            control = self.__controls[gso_size] = pin(bytearray(pack_gso(gso_size)))
+          _, control_address, control_size = control
+        MMSGHDR.pack_into(headers, i * MMSGHDR.size, name[1], name[2], iovecs_address + start * IOVEC.size, slot - start, control_address, control_size, 0, 0)
+      sent = 0
+      while sent < len(messages):
+        result = libc.sendmmsg(self.sock.fileno(), headers_address + sent * MMSGHDR.size, len(messages) - sent, 0)
+        self.send_calls += 1
+        if result < 0:
+          error = ctypes.get_errno()
+          if error == errno.EINTR:
+            continue
+          if error in (errno.EAGAIN, errno.EWOULDBLOCK):
+            self.__wait(select.POLLOUT, self.send_timeout)
+            continue
+          if error in (errno.EIO, errno.EINVAL) and messages[sent][2]:
+            return sent
+          raise OSError(error, os.strerror(error))
+        self.sent += sum(count for _, count, _ in messages[sent:sent + result])
+        sent += result
+      return sent
+    finally:
+      exports.release()
+
+  # Waits until the socket is ready for events, within timeout
+  def __wait(self, events: int, timeout: typing.Optional[float]):
+    if timeout == 0:
+      raise BlockingIOError(errno.EAGAIN, os.strerror(errno.EAGAIN))
+    if self.__poll is not None and events == select.POLLIN:
+      ready = self.__poll.poll(None if timeout is None else timeout * 1000)
+    else:
+      readable, writable, _ = select.select([self.sock] if events == select.POLLIN else [], [self.sock] if events != select.POLLIN else [], [], timeout)
+      ready = readable or writable
+    if not ready:
+      raise socket.timeout("timed out")
+
+  # Receives into buffers (bytearrays of the same size), at least one datagram unless the timeout
+  # expires. Returns (nbytes, address) of each datagram read, in the order of buffers
+  def receive(self, buffers: typing.List[bytearray], timeout: typing.Optional[float] = None):
+    self.sock.settimeout(timeout)
+    if not self.mmsg or len(buffers) == 1:
+      self.receive_calls += 1
+      self.received += 1
+      if not self.drop_count:
+        return [self.sock.recvfrom_into(buffers[0])]
+      nbytes, controls, _, addr = self.sock.recvmsg_into([buffers[0]], RECEIVE_CONTROL_SIZE)
+      for level, kind, data in controls:
+        if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+          self.stats.kernel_drops = DROP_COUNT.unpack_from(data)[0]
+      return [(nbytes, addr)]
+    count = min(len(buffers), RECEIVE_BATCH)
+    exports = self.__exports
+    try:
+      for i in range(count):
+        IOVEC.pack_into(self.__receive_iovecs, i * IOVEC.size, exports.address_of(buffers[i], PYBUF_WRITABLE), len(buffers[i]))
+        if self.drop_count:
+          CONTROL_LEN.pack_into(self.__receive_headers, i * MMSGHDR.size + CONTROL_LEN_OFFSET, RECEIVE_CONTROL_SIZE)
+      while True:
+        # datagrams already queued are read without polling first
+        result = libc.recvmmsg(self.sock.fileno(), self.__receive_headers_address, count, MSG_DONTWAIT, None)
+        self.receive_calls += 1
+        if result > 0:
+          break
+        error = ctypes.get_errno()
+        if error == errno.EINTR:
+          continue
+        if error not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          raise OSError(error, os.strerror(error))
+        self.__wait(select.POLLIN, self.sock.gettimeout())
+    finally:
+      exports.release()
+    self.received += result
+    received = []
+    names = self.__receive_names
+    for i in range(result):
+      # the kernel writes the same sockaddr_in length back, the headers are reused as they are
+      name = bytes(names[i * ctypes.sizeof(sockaddr_in) + 2:i * ctypes.sizeof(sockaddr_in) + 8])
+      peer = self.__peers.get(name)
+      if peer is None:
+        peer = self.__peers[name] = (socket.inet_ntoa(name[2:]), int.from_bytes(name[:2], "big"))
+      received.append((MSG_LEN.unpack_from(self.__receive_headers, i * MMSGHDR.size + MSG_LEN_OFFSET)[0], peer))
+      if self.drop_count and CONTROL_LEN.unpack_from(self.__receive_headers, i * MMSGHDR.size + CONTROL_LEN_OFFSET)[0]:
+        self.__read_drop_count(i)
+    return received
+
+  # Keeps the drop count of the control message received with datagram i
+  def __read_drop_count(self, i: int):
+    _, level, kind = CMSG_HEADER.unpack_from(self.__receive_controls, i * RECEIVE_CONTROL_SIZE)
+    if level == socket.SOL_SOCKET and kind == SO_RXQ_OVFL:
+      self.stats.kernel_drops = DROP_COUNT.unpack_from(self.__receive_controls, i * RECEIVE_CONTROL_SIZE + CMSG_DATA_OFFSET)[0]
+
+  def __str__(self):
+    return f"sent {self.sent} datagrams in {self.send_calls} calls, received {self.received} in {self.receive_calls} ({'sendmmsg/recvmmsg' if self.mmsg else 'one per call'}{', segmentation offload' if self.gso else ''})"
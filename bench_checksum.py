@@ -0,0 +1,36 @@
+import argparse
+import os
+import random
+import timeit
+from checksum import ENGINES, fold, loop_sum
+from segment import MAX_PAYLOAD
+
+
+# Checks every engine against the reference loop, including the all zero and 0xFFFF edge cases
+def verify(samples: int):
+  payloads = [b"", b"\x00", b"\x00\x00\x00", b"\xff\xff", b"\xff\xff\xff\xff", b"\xff", bytes(MAX_PAYLOAD), b"\xff" * MAX_PAYLOAD]
+  payloads += [os.urandom(random.randint(0, MAX_PAYLOAD)) for _ in range(samples)]
+  for payload in payloads:
+    expected = loop_sum(payload)
+    for name, engine in ENGINES.items():
+      # engines must agree once the header words are folded in
+      for header in (0, 1, 0xFFFF, 0x1FFFE):
+        if fold(header + engine(payload)) != fold(header + expected):
+          raise AssertionError(f"engine {name} differs on a {len(payload)} byte payload")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", type=int, default=MAX_PAYLOAD)
+    parser.add_argument("--number", type=int, default=200)
+    parser.add_argument("--verify", type=int, default=50)
+    args = parser.parse_args()
+
+    verify(args.verify)
+    payload = os.urandom(args.size)
+    baseline = None
+    print(f"{'engine':<8}{'us/segment':>12}{'MB/s':>10}{'speedup':>10}")
+    for name, engine in ENGINES.items():
+      seconds = timeit.timeit(lambda: engine(payload), number=args.number) / args.number
+      if baseline is None:
+        baseline = seconds
+      print(f"{name:<8}{seconds * 1e6:>12.1f}{args.size / seconds / 1e6:>10.1f}{baseline / seconds:>9.1f}x")
@@ -0,0 +1,64 @@
+import argparse
+import math
+import os
+import time
+from mapped_file import MappedFile
+from segment import MAX_PAYLOAD
+
+
+# The old path, a file handle per sender and a seek and read per chunk
+def seek_read(path: str, chunk_count: int, senders: int, passes: int):
+  for _ in range(senders):
+    with open(path, "rb") as file:
+      for _ in range(passes):
+        for index in range(chunk_count):
+          file.seek(index * MAX_PAYLOAD)
+          file.read(MAX_PAYLOAD)
+
+def mapped(file: MappedFile, chunk_count: int, senders: int, passes: int):
+  for _ in range(senders * passes):
+    for index in range(chunk_count):
+      file.chunk(index)
+
+# Checks the chunks of a mapping against the file, around window boundaries too
+def verify(path: str, file: MappedFile, chunk_count: int):
+  with open(path, "rb") as f:
+    for index in range(chunk_count):
+      f.seek(index * MAX_PAYLOAD)
+      if bytes(file.chunk(index)) != f.read(MAX_PAYLOAD):
+        raise AssertionError(f"chunk {index} differs")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", type=str)
+    # concurrent senders of the same file, each reads every chunk once per pass (passes > 1 as retransmissions)
+    parser.add_argument("--senders", type=int, default=4)
+    parser.add_argument("--passes", type=int, default=1)
+    parser.add_argument("--window", type=int, default=1 << 22, help="window size of the windowed mapping")
+    args = parser.parse_args()
+
+    path = "input/" + args.input_path
+    chunk_count = math.ceil(os.path.getsize(path) / MAX_PAYLOAD)
+    whole = MappedFile(path, MAX_PAYLOAD)
+    windowed = MappedFile(path, MAX_PAYLOAD, max_map_size=0, window_size=args.window)
+    verify(path, whole, chunk_count)
+    verify(path, windowed, chunk_count)
+
+    runs = [
+      ("seek/read", lambda: seek_read(path, chunk_count, args.senders, args.passes)),
+      ("mmap", lambda: mapped(whole, chunk_count, args.senders, args.passes)),
+      ("windowed", lambda: mapped(windowed, chunk_count, args.senders, args.passes)),
+    ]
+    total = chunk_count * args.senders * args.passes
+    baseline = None
+    print(f"{chunk_count} chunks, {args.senders} senders, {args.passes} passes")
+    print(f"{'path':<10}{'us/chunk':>10}{'MB/s':>10}{'speedup':>10}")
+    for name, run in runs:
+      start = time.perf_counter()
+      run()
+      seconds = (time.perf_counter() - start) / total
+      if baseline is None:
+        baseline = seconds
+      print(f"{name:<10}{seconds * 1e6:>10.2f}{MAX_PAYLOAD / seconds / 1e6:>10.1f}{baseline / seconds:>9.1f}x")
+    whole.close()
+    windowed.close()
@@ -0,0 +1,51 @@
+import argparse
+import contextlib
+import io
+import os
+import threading
+import time
+from client import Client
+from server import Server
+
+
+# One striped transfer of input_path to an in process client over streams connections
+def run(input_path: str, port: int, streams: int):
+  server = Server('127.0.0.1', port, input_path)
+  client = Client('127.0.0.1', port + 1, '127.0.0.1', port)
+  client.streams = streams
+  thread = threading.Thread(target=client.run, daemon=True)
+  with contextlib.redirect_stdout(io.StringIO()):
+    start = time.perf_counter()
+    thread.start()
+    server.listen_broadcast()
+    server.broadcast()
+    thread.join()
+    seconds = time.perf_counter() - start
+  if b"".join(client.data) != open(server.file_path, "rb").read():
+    raise AssertionError(f"file received over {streams} streams differs")
+  server.close()
+  client.close()
+  return seconds
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("input_path", type=str)
+    parser.add_argument("--port", type=int, default=7000)
+    parser.add_argument("--max-streams", type=int, default=8)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    size = os.path.getsize("input/" + args.input_path)
+    print(f"{size} bytes, best of {args.runs} runs")
+    print(f"{'streams':<8}{'seconds':>10}{'MB/s':>10}{'speedup':>10}")
+    baseline = None
+    port = args.port
+    for streams in range(1, args.max_streams + 1):
+      seconds = []
+      for _ in range(args.runs):
+        seconds.append(run(args.input_path, port, streams))
+        port += 2
+      best = min(seconds)
+      if baseline is None:
+        baseline = best
+      print(f"{streams:<8}{best:>10.3f}{size / best / 1e6:>10.1f}{baseline / best:>9.2f}x")
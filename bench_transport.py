@@ -0,0 +1,223 @@
+import argparse
+import contextlib
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import typing
+import connection
+from client import Client
+from impairment import Impairment, impair
+from segment import MAX_PAYLOAD
+from server import Server
+
+
+MODES = ("broadcast", "parallel", "p2p")
+# metrics of a run, the median of the runs of a configuration is reported
+METRICS = ("goodput", "handshake", "ttfb", "retransmission_ratio", "cpu_per_mb", "io_calls_per_mb", "kernel_drops")
+# a run that takes longer is reported as failed
+RUN_TIMEOUT = 120
+
+# Counts the datagrams with a payload (metadata and chunks) a node sends
+class SentCounter:
+  def __init__(self, node) -> None:
+    self.segments = 0
+    send_encoded = node.send_encoded
+    def counted(ip_remote: str, port_remote: int, headers: bytes, payload: bytes):
+      if payload:
+        self.segments += 1
+      send_encoded(ip_remote, port_remote, headers, payload)
+    send_batch = node.send_batch
+    def counted_batch(ip_remote: str, port_remote: int, datagrams: typing.List[typing.Tuple[bytes, bytes]]):
+      self.segments += sum(1 for _, payload in datagrams if payload)
+      send_batch(ip_remote, port_remote, datagrams)
+    node.send_encoded = counted
+    node.send_batch = counted_batch
+
+# Receiver side timings: the connection (handshake done) and the first chunk after the metadata
+class ReceiveTimer:
+  def __init__(self, client: Client) -> None:
+    self.connected_at: typing.Optional[float] = None
+    self.first_byte_at: typing.Optional[float] = None
+    self.messages = 0
+    handle_message = client.handle_message
+    def on_connect(message):
+      if self.connected_at is None:
+        self.connected_at = time.perf_counter()
+    def on_message(message):
+      self.messages += 1
+      if self.messages == 2:
+        self.first_byte_at = time.perf_counter()
+      handle_message(message)
+    client.register_on_connect(on_connect)
+    client.register_handler(on_message)
+
+# Random content of size bytes under input/, the same for the same seed
+def make_input(size: int, seed: int):
+  name = f"bench_transport_{size}.bin"
+  with open("input/" + name, "wb") as f:
+    f.write(random.Random(seed).randbytes(size))
+  return name
+
+# Sets up both ends alike: payload size (as is, no path mtu lookup), window (receive buffer and
+# congestion window cap of the connections of the node), loss on both ways, whether datagrams are
+# sent and received in batches, and whether socket buffers follow the window
+def configure(node, window: int, payload_size: int, loss: float, seed: int, batch_io: bool, buffer_tuning: bool):
+  node.max_window = node.receive_buffer_segments = window
+  node.payload_size = payload_size
+  node.path_payloads.mode = "fixed"
+  if not batch_io:
+    node.batch_socket.mmsg = node.batch_socket.gso = False
+  node.socket_buffers.auto_tune = buffer_tuning
+  if loss > 0:
+    impair(node, Impairment(loss=loss, seed=seed))
+
+# One transfer of input_path from a server (or a peer) to an in process client, returns its metrics
+def run(mode: str, input_path: str, port: int, window: int, payload_size: int, loss: float, seed: int, batch_io: bool = True, buffer_tuning: bool = True):
+  size = os.path.getsize("input/" + input_path)
+  receiver = Client('127.0.0.1', port + 1, '127.0.0.1', port + 1 if mode == "p2p" else port)
+  if mode == "p2p":
+    receiver.p2p = True
+    sender = Client('127.0.0.1', port, '127.0.0.1', port + 1)
+  else:
+    sender = Server('127.0.0.1', port, input_path)
+    # nothing to repair, the transfer ends with the last chunk
+    sender.repair_wait = 0
+  configure(sender, window, payload_size, loss, seed, batch_io, buffer_tuning)
+  configure(receiver, window, payload_size, loss, seed + 1, batch_io, buffer_tuning)
+  sent = SentCounter(sender)
+  timer = ReceiveTimer(receiver)
+  thread = threading.Thread(target=receiver.run, daemon=True)
+  with contextlib.redirect_stdout(io.StringIO()):
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    thread.start()
+    if mode == "p2p":
+      handshake_start = time.perf_counter()
+      sender.handshake('127.0.0.1', port + 1)
+      handshake = time.perf_counter() - handshake_start
+      sender.transfer('127.0.0.1', port + 1, input_path)
+    else:
+      sender.listen_broadcast()
+      if mode == "parallel":
+        sender.broadcast_parallel()
+      else:
+        sender.broadcast()
+    thread.join(RUN_TIMEOUT)
+    seconds = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+  if mode != "p2p":
+    handshake = None if timer.connected_at is None else timer.connected_at - start
+  matches = not thread.is_alive() and b"".join(receiver.data) == open("input/" + input_path, "rb").read()
+  chunk_count = math.ceil(size / receiver.chunk_size)
+  sender.close()
+  receiver.close()
+  return {
+    'goodput': size / seconds / 1e6 if matches else 0.0,
+    'handshake': handshake,
+    'ttfb': None if timer.first_byte_at is None else timer.first_byte_at - start,
+    # datagrams sent beyond the metadata and one per chunk
+    'retransmission_ratio': max(0, sent.segments - 1 - chunk_count) / chunk_count,
+    'cpu_per_mb': cpu / (size / 1e6),
+    # socket system calls sending and receiving datagrams, both ends
+    'io_calls_per_mb': sum(node.batch_socket.send_calls + node.batch_socket.receive_calls for node in (sender, receiver)) / (size / 1e6),
+    # datagrams the kernel dropped on a full receive buffer, both ends (0 where it does not tell)
+    'kernel_drops': sum(node.socket_stats.kernel_drops or 0 for node in (sender, receiver)),
+    'ok': matches,
+  }
+
+# Median of each metric over the runs, None if a run did not measure it
+def summarize(runs: typing.List[dict]):
+  summary = {}
+  for metric in METRICS:
+    values = [run[metric] for run in runs]
+    summary[metric] = None if None in values else statistics.median(values)
+  summary['ok'] = all(run['ok'] for run in runs)
+  return summary
+
+# Commit the results were measured at, to compare runs across commits
+def git_commit():
+  try:
+    return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def key(result: dict):
+  return (result['mode'], result['size'], result['window'], result['payload_size'], result['loss'])
+
+# Configurations whose goodput fell by more than tolerance against the baseline results
+def regressions(results: typing.List[dict], baseline: typing.List[dict], tolerance: float):
+  previous = {key(result): result for result in baseline}
+  found = []
+  for result in results:
+    before = previous.get(key(result))
+    if before is not None and before['goodput'] and result['goodput'] < before['goodput'] * (1 - tolerance):
+      found.append((result, before))
+  return found
+
+def format_ms(seconds: typing.Optional[float]):
+  return "-" if seconds is None else f"{seconds * 1000:.1f}"
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modes", type=str, nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1 << 20], help="file sizes, in bytes")
+    parser.add_argument("--windows", type=int, nargs="+", default=[connection.RECEIVE_BUFFER_SIZE], help="windows, in segments: receive buffer and congestion window cap of both ends")
+    parser.add_argument("--payload-sizes", type=int, nargs="+", default=[1400, MAX_PAYLOAD], help="segment payload sizes, in bytes")
+    parser.add_argument("--losses", type=float, nargs="+", default=[0.0, 0.01], help="probabilities a datagram is lost, both ways")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--port", type=int, default=7100)
+    parser.add_argument("--json", type=str, default=None, help="writes the results to this file")
+    parser.add_argument("--csv", type=str, default=None, help="writes the results to this file")
+    parser.add_argument("--baseline", type=str, default=None, help="results (json) of an earlier commit, exits with 1 if goodput regressed")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="goodput drop tolerated against the baseline")
+    parser.add_argument("--no-batch-io", action="store_true", help="one system call per datagram, no sendmmsg, recvmmsg or segmentation offload")
+    parser.add_argument("--no-buffer-tuning", action="store_true", help="keeps the system default socket buffers instead of sizing them for the window")
+    args = parser.parse_args()
+
+    results = []
+    port = args.port
+    print(f"{'mode':<10}{'size':>10}{'window':>8}{'payload':>9}{'loss':>7}{'MB/s':>9}{'hs ms':>8}{'ttfb ms':>9}{'retx':>7}{'cpu s/MB':>10}{'calls/MB':>10}{'drops':>7}")
+    for size in args.sizes:
+      input_path = make_input(size, args.seed)
+      try:
+        for mode, window, payload_size, loss in itertools.product(args.modes, args.windows, args.payload_sizes, args.losses):
+          runs = []
+          for index in range(args.runs):
+            runs.append(run(mode, input_path, port, window, payload_size, loss, args.seed + index, not args.no_batch_io, not args.no_buffer_tuning))
+            port += 2
+          result = {'mode': mode, 'size': size, 'window': window, 'payload_size': payload_size, 'loss': loss, 'runs': args.runs}
+          result.update(summarize(runs))
+          results.append(result)
+          print(f"{mode:<10}{size:>10}{window:>8}{payload_size:>9}{loss:>7g}{result['goodput']:>9.1f}{format_ms(result['handshake']):>8}{format_ms(result['ttfb']):>9}{result['retransmission_ratio']:>7.3f}{result['cpu_per_mb']:>10.3f}{result['io_calls_per_mb']:>10.0f}{result['kernel_drops']:>7.0f}{'' if result['ok'] else '  failed'}")
+      finally:
+        os.remove("input/" + input_path)
+
+    report = {'commit': git_commit(), 'python': sys.version.split()[0], 'platform': platform.platform(), 'results': results}
+    if args.json is not None:
+      with open(args.json, "w") as f:
+        json.dump(report, f, indent=2)
+    if args.csv is not None:
+      with open(args.csv, "w", newline="") as f:
+        writer = csv.DictWriter(f, ['commit', 'mode', 'size', 'window', 'payload_size', 'loss', 'runs'] + list(METRICS) + ['ok'])
+        writer.writeheader()
+        for result in results:
+          writer.writerow(dict(result, commit=report['commit']))
+    if args.baseline is not None:
+      with open(args.baseline) as f:
+        baseline = json.load(f)
+      found = regressions(results, baseline['results'], args.tolerance)
+      for result, before in found:
+        print(f"[!] {result['mode']} {result['size']} bytes, window {result['window']}, payload {result['payload_size']}, loss {result['loss']:g}: {result['goodput']:.1f} MB/s against {before['goodput']:.1f} MB/s at {baseline['commit']}")
+      if found:
+        sys.exit(1)
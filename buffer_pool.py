@@ -0,0 +1,37 @@
+import threading
+import typing
+
+
+BUFFER_POOL_SIZE = 8
+
+# Pool of preallocated receive buffers, listen receives each datagram into a pooled buffer
+# and segments expose their payload as a memoryview into it instead of copying.
+# Ownership: a buffer belongs to whoever acquired it until it is released. Node.listen releases
+# its buffer when it returns, so a handler that wants to keep a payload must copy it (bytes(payload)).
+class BufferPool:
+  def __init__(self, buffer_size: int, count: int = BUFFER_POOL_SIZE) -> None:
+    self.buffer_size = buffer_size
+    self.count = count
+    self.free: typing.List[bytearray] = [bytearray(buffer_size) for _ in range(count)]
+    # buffers allocated because the pool was empty (e.g. nested or concurrent listens)
+    self.allocated = 0
+    self.__lock = threading.Lock()
+
+  def acquire(self):
+    with self.__lock:
+      if self.free:
+        return self.free.pop()
+      self.allocated += 1
+    return bytearray(self.buffer_size)
+
+  # Buffers of buffer_size from now on, the ones in use are dropped when released
+  def resize(self, buffer_size: int):
+    with self.__lock:
+      if buffer_size != self.buffer_size:
+        self.buffer_size = buffer_size
+        self.free = [bytearray(buffer_size) for _ in range(self.count)]
+
+  def release(self, buffer: bytearray):
+    with self.__lock:
+      if len(self.free) < self.count and len(buffer) == self.buffer_size:
+        self.free.append(buffer)
@@ -0,0 +1,86 @@
+import sys
+import typing
+from array import array
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Folds the carries of a one's complement sum back into 16 bit
+def fold(checksum: int):
+  while checksum >> 16:
+    checksum = (checksum >> 16) + (checksum & 0xFFFF)
+  return checksum
+
+# Every engine returns the folded 16 bit one's complement sum of data, read as big endian words
+# (an odd trailing byte is the high byte of a zero padded word). The result is only 0 when every
+# word is 0, so engines can be swapped without changing a single checksum bit.
+
+# Reference implementation, one word per iteration
+def loop_sum(data: bytes):
+  checksum = 0
+  for i in range(0, len(data), 2):
+    checksum += (data[i] << 8)
+    if i + 1 < len(data):
+      checksum += data[i + 1]
+  return fold(checksum)
+
+# Sums the words in bulk through an array of unsigned shorts
+def array_sum(data: bytes):
+  data = memoryview(data).cast("B")
+  even = len(data) & ~1
+  words = array("H")
+  words.frombytes(data[:even])
+  if sys.byteorder == "little":
+    words.byteswap()
+  checksum = sum(words)
+  if even != len(data):
+    checksum += data[even] << 8
+  return fold(checksum)
+
+# Reads the whole buffer as one big endian integer, 2^16 = 1 (mod 0xFFFF) so the remainder is the
+# one's complement sum of the words
+def int_sum(data: bytes):
+  checksum = int.from_bytes(data, "big")
+  if len(data) & 1:
+    checksum <<= 8
+  if checksum == 0:
+    return 0
+  return checksum % 0xFFFF or 0xFFFF
+
+# Vectorized sum, only available when numpy is installed
+def numpy_sum(data: bytes):
+  data = memoryview(data).cast("B")
+  even = len(data) & ~1
+  checksum = int(numpy.frombuffer(data[:even], dtype=">u2").sum(dtype=numpy.uint64))
+  if even != len(data):
+    checksum += data[even] << 8
+  return fold(checksum)
+
+ENGINES: typing.Dict[str, typing.Callable[[bytes], int]] = {
+  "loop": loop_sum,
+  "array": array_sum,
+  "int": int_sum,
+}
+if numpy is not None:
+  ENGINES["numpy"] = numpy_sum
+
+DEFAULT_ENGINE = "int"
+
+_engine = DEFAULT_ENGINE
+
+# Selects the engine used by every segment checksum
+def set_engine(name: str):
+  global _engine
+  if name not in ENGINES:
+    raise ValueError(f"unknown checksum engine {name}, available: {', '.join(ENGINES)}")
+  _engine = name
+
+def get_engine():
+  return _engine
+
+# Sum of the payload words with the selected engine
+def payload_sum(data: bytes):
+  return ENGINES[_engine](data)
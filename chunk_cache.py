@@ -0,0 +1,48 @@
+import threading
+import typing
+from collections import OrderedDict
+from checksum import payload_sum
+
+
+CHUNK_CACHE_SIZE = 256
+
+# LRU cache of file chunks and their payload sum, keyed by (file, chunk size, chunk index)
+# A chunk sent to N clients (and retransmitted) is only read and summed once, the segment
+# checksum is then derived by folding the header words into the cached sum
+class ChunkCache:
+  def __init__(self, max_entries: int = CHUNK_CACHE_SIZE) -> None:
+    self.max_entries = max_entries
+    self.entries: OrderedDict[typing.Tuple[str, int, int], typing.Tuple[bytes, int]] = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self.__lock = threading.Lock()
+
+  # Returns (payload, payload sum) of a chunk, calling load to read the payload on a miss
+  def get(self, file_path: str, chunk_size: int, index: int, load: typing.Callable[[], bytes]):
+    key = (file_path, chunk_size, index)
+    with self.__lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+      self.misses += 1
+
+    payload = load()
+    entry = (payload, payload_sum(payload))
+    with self.__lock:
+      self.entries[key] = entry
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+    return entry
+
+  def clear(self):
+    with self.__lock:
+      self.entries.clear()
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def __str__(self) -> str:
+    return f"chunks: {len(self.entries)}/{self.max_entries}, hits: {self.hits}, misses: {self.misses}"
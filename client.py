@@ -1,21 +1,68 @@
 import argparse
 import json
+import socket
+import time
 import typing
+from compression import CODECS, COMPRESSION, decompressor
+from congestion import CONGESTION_CONTROLS
+from connection import CONGESTION_CONTROL, Connection, get_seqnum_diff, increment_seqnum
+from file_sink import FileSink
+from integrity import DIGEST_ALGORITHM, DIGEST_ALGORITHMS, ContentDigest, ContentVerifier, verify_file
+from log import log
+from resume import RESUME_SUFFIX, ResumeState
+from stats import SNAPSHOT_INTERVAL, start_exporters
 from node import Node, MessageInfo
-from segment import Segment, SegmentFlags
+from pmtu import PMTU_MODE, PMTU_MODES
+from segment import MAX_PAYLOAD, MIN_PAYLOAD, OPTION_RANGE, OPTION_STREAMS, Segment, pack_range, pack_streams
+from striping import STREAM_COUNT
+
+# a corrupted block is requested again at most REPAIR_ROUNDS times, each request is sent up to
+# REPAIR_RETRIES times, waiting REPAIR_TIMEOUT seconds for the server to connect (the server may
+# still be closing the previous connection when the first one arrives)
+REPAIR_ROUNDS = 3
+REPAIR_RETRIES = 4
+REPAIR_TIMEOUT = 0.5
+# seconds without a segment from the sender after which a transfer is given up, the progress is
+# kept to resume it
+IDLE_TIMEOUT = 30.0
+
+# Raised when the sender stays silent for idle_timeout seconds
+class IdleTimeout(Exception):
+  pass
 
 
 class Client(Node):
   
-  def __init__(self, ip: str, port: int, server_ip: str, server_port: typing.Optional[int]=None) -> None:
+  # With an output path (under output/, without extension) the file is streamed to disk,
+  # otherwise the chunks are kept in data
+  def __init__(self, ip: str, port: int, server_ip: str, server_port: typing.Optional[int]=None, output_path: typing.Optional[str]=None) -> None:
     super().__init__(ip, port)
     self.register_handler(self.handle_message)
+    self.register_on_close(self.handle_close)
     self.server_ip = server_ip
     self.server_port = server_port
-    self.data: list[bytes] = []
-    self.is_first = True
+    # chunks kept in memory (without output path) by global index
+    self.chunks: dict[int, bytes] = {}
     self.output_path_extension = None
     self.p2p = False
+    self.output_path = output_path
+    self.sink: typing.Optional[FileSink] = None
+    # chunks written to the output file, persisted to resume an interrupted transfer
+    self.resume: typing.Optional[ResumeState] = None
+    # parallel connections asked for in the broadcast request (striped transfer)
+    self.streams = STREAM_COUNT
+    # per sending connection, sequence number of its first chunk and global index of that chunk,
+    # to place each chunk at its offset
+    self.stream_starts: dict[tuple[str, int], tuple[int, int]] = {}
+    # per sending connection, codec of its compressed chunks
+    self.stream_codecs: dict[tuple[str, int], typing.Optional[str]] = {}
+    self.closed_streams = 0
+    # connections the file is sent over, announced in the metadata
+    self.stripes = 1
+    self.chunk_size = MAX_PAYLOAD
+    # checks the content against the digest of the metadata as it is written
+    self.verifier: typing.Optional[ContentVerifier] = None
+    self.idle_timeout = IDLE_TIMEOUT
   # def send(self, segment: Segment):
   #   self.send(self.server_ip, self.server_port, segment)
 
@@ -23,43 +70,189 @@ class Client(Node):
     if self.port == self.server_port:
       # wait for another client to send a message
       conn = None
-      print("[P2P] Waiting for peer node to connect")
+      log.info("[P2P] Waiting for peer node to connect")
       while conn is None:
         addr, segment = self.listen()
         conn = self.connections.get((addr[0], addr[1]))
 
       # listen for message from peer 
       while conn is not None:
-        self.listen()
+        self.listen_idle()
         conn = self.connections.get((addr[0], addr[1]))
     else:
       # if not p2p, then syn broadcast request
       if not self.p2p:
         # sending broadcast request
-        print(f"[!] Sent SYN to {self.server_ip}:{self.server_port}")
-        self.send(self.server_ip, self.server_port, Segment.syn(0))
+        log.info(f"[!] Sent SYN to {self.server_ip}:{self.server_port}")
+        options = {OPTION_STREAMS: pack_streams(self.streams)} if self.streams > 1 else None
+        self.send(self.server_ip, self.server_port, Segment.syn(0, options))
 
-      # listening to handshake
-      while self.get_server() is None:
-        self.listen()
+      # listening to handshake, striped connections come from other ports of the server
+      while not self.connections:
+        self.listen_idle()
         
       # receive files
-      while self.get_server() is not None:
-        self.listen()
+      while self.is_receiving():
+        self.listen_idle()
+
+      if not self.p2p:
+        self.repair()
+
+  # Listens for the next segment, raises IdleTimeout when none comes within idle_timeout
+  def listen_idle(self):
+    try:
+      return self.listen(self.idle_timeout)
+    except socket.timeout:
+      raise IdleTimeout(f"No segment from the sender in {self.idle_timeout:g} seconds")
+
+  # Requests the blocks found corrupted again, each one alone (OPTION_RANGE)
+  def repair(self):
+    if self.verifier is None:
+      return
+    for _ in range(REPAIR_ROUNDS):
+      if self.sink is not None:
+        self.sink.flush()
+      corrupt = self.verifier.corrupt_ranges()
+      if not corrupt:
+        return
+      for offset, length in corrupt:
+        log.warning(f"[!] Block at {offset} ({length} bytes) is corrupted, requesting it again")
+        self.stream_starts.clear()
+        self.closed_streams = 0
+        self.stripes = 1
+        for _ in range(REPAIR_RETRIES):
+          self.send(self.server_ip, self.server_port, Segment.syn(0, {OPTION_RANGE: pack_range(offset, length)}))
+          deadline = time.monotonic() + REPAIR_TIMEOUT
+          while not self.connections and deadline > time.monotonic():
+            try:
+              self.listen(deadline - time.monotonic())
+            except socket.timeout:
+              break
+          if self.connections:
+            break
+        if self.connections:
+          # checked again as it comes in
+          self.verifier.reset_block(offset)
+          while self.is_receiving():
+            self.listen_idle()
 
   def get_server(self):
     return self.connections.get((self.server_ip, self.server_port))
 
+  # Until every connection the file is sent over is closed
+  def is_receiving(self):
+    if not self.stream_starts:
+      return len(self.connections) > 0
+    return self.closed_streams < self.stripes
+
+  @property
+  def data(self):
+    return [self.chunks[index] for index in sorted(self.chunks)]
+
   def handle_message(self, message_info: MessageInfo):
-    if self.is_first:
+    addr = (message_info.ip, message_info.port)
+    stream_start = self.stream_starts.get(addr)
+    if stream_start is None:
       metadata_segment= message_info.segment
-      metadata = json.loads(metadata_segment.payload.decode())
+      metadata = json.loads(bytes(metadata_segment.payload))
       self.output_path_filename = metadata['filename']
       self.output_path_extension = metadata['extension']
-      self.is_first = False
+      first_chunk = metadata.get('first_chunk', 0)
+      self.stream_starts[addr] = (increment_seqnum(metadata_segment.seq_num), first_chunk)
+      self.stream_codecs[addr] = metadata.get('compression')
+      self.stripes = metadata.get('stripes', 1)
+      self.chunk_size = metadata.get('chunk_size', MAX_PAYLOAD)
+      if self.verifier is None and 'digest' in metadata and 'filesize' in metadata:
+        self.verifier = ContentVerifier(ContentDigest.from_metadata(metadata['digest']), metadata['filesize'])
+      if self.output_path is not None and self.sink is None:
+        self.open_output(metadata)
+      if self.resume is not None:
+        self.skip_held(addr, first_chunk, metadata.get('stripe_chunks', self.resume.chunk_count - first_chunk))
     else:
-      self.data.append(message_info.segment.payload)
-    print(f"[Segment SEQ={message_info.segment.seq_num}] Received, Ack sent")
+      index = stream_start[1] + get_seqnum_diff(stream_start[0], message_info.segment.seq_num)
+      decode = decompressor(self.stream_codecs[addr]) if message_info.segment.compressed else None
+      # the payload is a view into a receive buffer that is reused once the handler returns
+      if self.sink is not None:
+        # decompressed by the writer thread
+        self.sink.write(index * self.chunk_size, bytes(message_info.segment.payload), decode)
+      else:
+        self.chunks[index] = decode(message_info.segment.payload) if decode is not None else bytes(message_info.segment.payload)
+        if self.verifier is not None:
+          self.verifier.update(index * self.chunk_size, self.chunks[index])
+    if log.tracing:
+      log.trace("[Segment SEQ=%d] Received, Ack sent", message_info.segment.seq_num)
+
+  def handle_close(self, message_info: MessageInfo):
+    if (message_info.ip, message_info.port) in self.stream_starts:
+      self.closed_streams += 1
+
+  # Opens the output file, resuming the partial file of a previous transfer of the same content
+  def open_output(self, metadata: dict):
+    output_file = self.get_output_file()
+    identity = None
+    if 'digest' in metadata and 'filesize' in metadata:
+      identity = {'filesize': metadata['filesize'], 'digest': metadata['digest']['value'], 'chunk_size': self.chunk_size}
+    self.resume = ResumeState.load(output_file, identity) if identity is not None else None
+    if self.resume is not None:
+      log.info(f"[!] Resuming {output_file}, {self.resume.held} chunks already held")
+    elif identity is not None:
+      self.resume = ResumeState(output_file + RESUME_SUFFIX, identity)
+    if self.verifier is not None and self.resume is not None and self.resume.held:
+      # the blocks already held are checked from the partial file
+      with open(output_file, "rb") as f:
+        for offset, length in self.resume.held_ranges():
+          f.seek(offset)
+          self.on_write(offset, f.read(length))
+    self.sink = FileSink(output_file, metadata.get('filesize'), truncate=self.resume is None or self.resume.held == 0, on_write=self.on_write)
+
+  # Called by the writer thread of the sink once data is written, a corrupted block is no longer held
+  def on_write(self, offset: int, data: bytes):
+    corrupt = self.verifier.update(offset, data) if self.verifier is not None else []
+    if self.resume is not None:
+      self.resume.mark(offset, len(data))
+      for block_offset, length in corrupt:
+        self.resume.unmark(block_offset, length)
+
+  # Moves the expected sequence number of a connection past the chunks of its range already held,
+  # the ack of the metadata then tells the sender to skip them
+  def skip_held(self, addr: tuple[str, int], first_chunk: int, chunk_count: int):
+    held = self.resume.held_from(first_chunk, chunk_count)
+    connection = self.connections.get(addr)
+    if held and connection is not None:
+      connection.receive.seq_num = increment_seqnum(connection.receive.seq_num, held)
+
+  def get_output_file(self):
+    path = "output/" + self.output_path
+    return path if self.output_path_extension is None else path + '.' + self.output_path_extension
+
+  # Chunks still queued for the disk are not consumed yet, they shrink the advertised window
+  def receive_backlog(self, connection: Connection):
+    return self.sink.backlog if self.sink is not None else 0
+
+  # Waits for the pending writes and closes the output file, the progress is kept until it is complete
+  # Also called when the transfer is cut short (idle sender, interrupted), the bitmap saved then
+  # holds every chunk the sink wrote
+  def finish(self):
+    output_file = None
+    if self.sink is not None:
+      self.sink.close()
+      output_file = self.sink.path
+      self.sink = None
+    if self.resume is not None and not self.resume.is_complete:
+      log.warning(f"[!] Transfer incomplete, {self.resume.held} of {self.resume.chunk_count} chunks kept in {self.resume.path}")
+    elif self.verifier is not None:
+      verified = self.verifier.check()
+      if verified is None and output_file is not None:
+        verified = verify_file(output_file, self.verifier.digest)
+      if verified:
+        log.info(f"[!] Content verified ({self.verifier.digest.algorithm})")
+      elif verified is not None:
+        log.error(f"[!] Content does not match ({self.verifier.digest.algorithm})")
+    if self.resume is not None:
+      if self.resume.is_complete:
+        self.resume.remove()
+      else:
+        self.resume.save()
 
 ip_alisha = "10.5.105.30"
 ip_ken = '10.5.105.82'
@@ -71,9 +264,35 @@ if __name__ == '__main__':
     parser.add_argument("server_port", type=int)
     parser.add_argument("output_path", type=str)
     parser.add_argument("peer", type=str)
+    parser.add_argument("--congestion", type=str, default=CONGESTION_CONTROL, choices=CONGESTION_CONTROLS)
+    parser.add_argument("--compression", type=str, default=COMPRESSION, choices=list(CODECS), help="codec of the chunks sent, raw by default")
+    parser.add_argument("--streams", type=int, default=STREAM_COUNT, help="parallel connections to receive the file over")
+    parser.add_argument("--pmtu", type=str, default=PMTU_MODE, choices=PMTU_MODES, help="how the payload size towards a peer is found")
+    parser.add_argument("--payload-size", type=int, default=MAX_PAYLOAD, help="largest payload taken, in bytes")
+    parser.add_argument("--digest", type=str, default=DIGEST_ALGORITHM, choices=DIGEST_ALGORITHMS, help="digest of the content sent in the metadata")
+    parser.add_argument("--no-block-hashes", action="store_true", help="only the whole content digest, no per block hashes")
+    parser.add_argument("--stats-file", type=str, default=None, help="writes a json snapshot of the connection statistics there")
+    parser.add_argument("--stats-interval", type=float, default=SNAPSHOT_INTERVAL, help="seconds between two snapshots")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serves the statistics in the prometheus format on this port")
+    parser.add_argument("--no-batch-io", action="store_true", help="one system call per datagram, no sendmmsg, recvmmsg or segmentation offload")
+    parser.add_argument("--no-buffer-tuning", action="store_true", help="keeps the system default socket buffers instead of sizing them for the window")
+    parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT, help="seconds without a segment from the sender before the transfer is given up")
+    log.add_arguments(parser)
     args = parser.parse_args()
-    client = Client(localhost, args.client_port, localhost, args.server_port)
-    output_path = args.output_path
+    log.from_args(args)
+    client = Client(localhost, args.client_port, localhost, args.server_port, args.output_path if args.peer != "p2p" else None)
+    client.congestion_control = args.congestion
+    client.compression = args.compression
+    client.payload_size = min(max(args.payload_size, MIN_PAYLOAD), MAX_PAYLOAD)
+    client.path_payloads.mode = args.pmtu
+    client.digest_algorithm = args.digest
+    client.block_hashes = not args.no_block_hashes
+    if args.no_batch_io:
+      client.batch_socket.mmsg = client.batch_socket.gso = False
+    client.socket_buffers.auto_tune = not args.no_buffer_tuning
+    client.streams = args.streams
+    client.idle_timeout = args.idle_timeout
+    exporters = start_exporters(client.stats, args.stats_file, args.stats_interval, args.metrics_port)
     if args.peer == "p2p":
       # send to peer node
       # server port is client peer node
@@ -83,9 +302,14 @@ if __name__ == '__main__':
     else:
       if args.server_port == args.client_port:
         client.p2p = True
-      client.run()
-      path = "output/"
-      path += output_path if client.output_path_extension is None else output_path + ('.' + client.output_path_extension)
-      with open(path, "wb") as f:
-        for data in client.data:
-          f.write(data)
+      # the progress is saved however the transfer ends
+      try:
+        client.run()
+      except IdleTimeout as e:
+        log.error(f"[!] {e}")
+      except KeyboardInterrupt:
+        log.warning("[!] Interrupted")
+      finally:
+        client.finish()
+    for exporter in exporters:
+      exporter.close()
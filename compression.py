@@ -0,0 +1,125 @@
+import os
+import threading
+import typing
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from checksum import payload_sum
+
+try:
+  import bz2
+except ImportError:
+  bz2 = None
+try:
+  import lzma
+except ImportError:
+  lzma = None
+
+
+# codec of the chunks a node sends, None sends them raw
+COMPRESSION = None
+# compression level of each codec, fast levels keep up with the send window
+COMPRESSION_LEVELS = {"zlib": 1, "bz2": 1, "lzma": 0}
+# threads compressing chunks, and chunks compressed ahead of the send window
+COMPRESS_WORKERS = min(8, os.cpu_count() or 1)
+COMPRESS_AHEAD = 64
+# compressed chunks kept for retransmissions and other receivers
+COMPRESS_CACHE_SIZE = 512
+# a chunk is sent compressed only if it saves at least 1/MIN_SAVING of its size
+MIN_SAVING = 16
+# after RAW_STREAK chunks of a file in a row did not compress (already compressed media), only one
+# chunk in RAW_STREAK is tried until one compresses again
+RAW_STREAK = 8
+
+# (compress(data, level), decompress(data)) of the codecs this platform has
+CODECS: typing.Dict[str, typing.Tuple[typing.Callable[[bytes, int], bytes], typing.Callable[[bytes], bytes]]] = {
+  "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress)
+}
+if bz2 is not None:
+  CODECS["bz2"] = (lambda data, level: bz2.compress(data, max(1, level)), bz2.decompress)
+if lzma is not None:
+  CODECS["lzma"] = (lambda data, level: lzma.compress(data, preset=level), lzma.decompress)
+# bit of each codec in the codecs a node advertises in its handshake (OPTION_CODECS)
+CODEC_BITS = {"zlib": 1, "bz2": 2, "lzma": 4}
+
+# Bitmask of the codecs this node decodes
+def supported_codecs():
+  mask = 0
+  for name in CODECS:
+    mask |= CODEC_BITS[name]
+  return mask
+
+# Codec a sender configured with codec uses towards a peer decoding peer_codecs, or None
+def choose_codec(codec: typing.Optional[str], peer_codecs: int):
+  if codec is None or codec not in CODECS or not CODEC_BITS[codec] & peer_codecs:
+    return None
+  return codec
+
+def decompressor(codec: str):
+  return CODECS[codec][1]
+
+# Compresses the chunks of the input files in a pool of threads, ahead of the send window, so the
+# send loop only picks up finished results. Each chunk is compressed on its own (any chunk can be
+# lost and resent alone), a chunk that does not shrink enough is kept raw. Results are
+# (payload, payload sum, compressed), kept per (file, chunk size, index, codec) like ChunkCache,
+# so retransmissions and other receivers reuse them.
+class ChunkCompressor:
+  def __init__(self, workers: int = COMPRESS_WORKERS, max_entries: int = COMPRESS_CACHE_SIZE) -> None:
+    self.workers = workers
+    self.max_entries = max_entries
+    self.entries: OrderedDict[typing.Tuple[str, int, int, str], Future] = OrderedDict()
+    self.compressed = 0
+    self.raw = 0
+    # chunks in a row that did not compress, per (file, codec)
+    self.raw_streaks: typing.Dict[typing.Tuple[str, str], int] = {}
+    self.__executor: typing.Optional[ThreadPoolExecutor] = None
+    self.__lock = threading.Lock()
+
+  # Starts compressing a chunk unless it is already, load reads its raw payload
+  def prefetch(self, key: typing.Tuple[str, int, int, str], load: typing.Callable[[], bytes]):
+    with self.__lock:
+      future = self.entries.get(key)
+      if future is not None:
+        self.entries.move_to_end(key)
+        return future
+      if self.__executor is None:
+        self.__executor = ThreadPoolExecutor(self.workers, thread_name_prefix="compress")
+      future = self.__executor.submit(self.__compress, key, load)
+      self.entries[key] = future
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+      return future
+
+  # (payload, payload sum, compressed) of a chunk, waits for it if it is still being compressed
+  def get(self, key: typing.Tuple[str, int, int, str], load: typing.Callable[[], bytes]):
+    return self.prefetch(key, load).result()
+
+  # Runs in a pool thread, the streaks and counters it shares with the other workers are only read
+  # and updated under the lock, the codec runs outside of it
+  def __compress(self, key: typing.Tuple[str, int, int, str], load: typing.Callable[[], bytes]):
+    path, _, index, codec = key
+    payload = load()
+    with self.__lock:
+      attempt = self.raw_streaks.get((path, codec), 0) < RAW_STREAK or index % RAW_STREAK == 0
+    if attempt:
+      compressed = CODECS[codec][0](payload, COMPRESSION_LEVELS[codec])
+      if len(compressed) <= len(payload) - len(payload) // MIN_SAVING:
+        with self.__lock:
+          self.raw_streaks[(path, codec)] = 0
+          self.compressed += 1
+        return compressed, payload_sum(compressed), True
+    with self.__lock:
+      if attempt:
+        self.raw_streaks[(path, codec)] = self.raw_streaks.get((path, codec), 0) + 1
+      self.raw += 1
+    return payload, payload_sum(payload), False
+
+  def close(self):
+    with self.__lock:
+      if self.__executor is not None:
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+        self.__executor = None
+      self.entries.clear()
+
+  def __str__(self) -> str:
+    return f"compressed: {self.compressed}, raw: {self.raw}"
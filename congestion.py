@@ -0,0 +1,120 @@
+import time
+import typing
+
+
+# initial congestion window, also the size of the fixed window
+INITIAL_WINDOW = 5
+MAX_WINDOW_SIZE = 64
+MIN_SSTHRESH = 2
+
+# Congestion control of a connection, the window (in segments) grows with acks up to max_window and
+# shrinks on losses
+# The send loop calls on_ack with the number of segments newly acknowledged (cumulatively), on_loss
+# when a loss is detected from sacks or duplicate acks and on_timeout when a retransmission timer expires
+class CongestionControl:
+  def __init__(self, max_window: int = MAX_WINDOW_SIZE) -> None:
+    self.max_window = max_window
+    self.cwnd = float(min(INITIAL_WINDOW, max_window))
+    self.ssthresh = float(max_window)
+
+  @property
+  def window(self):
+    return max(1, min(int(self.cwnd), self.max_window))
+
+  @property
+  def is_slow_start(self):
+    return self.cwnd < self.ssthresh
+
+  def on_ack(self, acked: int):
+    pass
+
+  def on_loss(self):
+    pass
+
+  def on_timeout(self):
+    pass
+
+  def __str__(self) -> str:
+    return f"{type(self).__name__.lower()} cwnd: {self.cwnd:.2f}, ssthresh: {self.ssthresh:.2f}"
+
+# The old behavior, a window of INITIAL_WINDOW segments
+class FixedWindow(CongestionControl):
+  pass
+
+# Slow start, then additive increase of one segment per window, halved on loss (RFC 5681)
+class Reno(CongestionControl):
+  def on_ack(self, acked: int):
+    if self.is_slow_start:
+      self.cwnd = min(self.cwnd + acked, self.max_window)
+    else:
+      self.cwnd = min(self.cwnd + acked / self.cwnd, self.max_window)
+
+  def on_loss(self):
+    self.ssthresh = max(self.cwnd / 2, MIN_SSTHRESH)
+    self.cwnd = self.ssthresh
+
+  def on_timeout(self):
+    self.ssthresh = max(self.cwnd / 2, MIN_SSTHRESH)
+    self.cwnd = 1.0
+
+# Window grows as a cubic function of the time since the last loss, centered on the window the
+# loss happened at, and never slower than reno would (RFC 8312, without the rtt term)
+class Cubic(CongestionControl):
+  C = 0.4
+  BETA = 0.7
+
+  def __init__(self, max_window: int = MAX_WINDOW_SIZE) -> None:
+    super().__init__(max_window)
+    self.w_max = 0.0
+    self.k = 0.0
+    self.origin = 0.0
+    self.w_est = 0.0
+    self.epoch_start: typing.Optional[float] = None
+
+  def on_ack(self, acked: int):
+    if self.is_slow_start:
+      self.cwnd = min(self.cwnd + acked, self.max_window)
+      return
+    now = time.monotonic()
+    if self.epoch_start is None:
+      self.epoch_start = now
+      self.k = ((self.w_max - self.cwnd) / self.C) ** (1 / 3) if self.cwnd < self.w_max else 0.0
+      self.origin = max(self.w_max, self.cwnd)
+      self.w_est = self.cwnd
+    target = self.origin + self.C * (now - self.epoch_start - self.k) ** 3
+    # reno friendly region
+    self.w_est += 3 * (1 - self.BETA) / (1 + self.BETA) * acked / self.cwnd
+    target = max(target, self.w_est)
+    if target > self.cwnd:
+      self.cwnd += (target - self.cwnd) / self.cwnd * acked
+    else:
+      self.cwnd += 0.01 * acked / self.cwnd
+    self.cwnd = min(self.cwnd, self.max_window)
+
+  def __reduce(self):
+    # fast convergence, release bandwidth when the loss happens below the previous maximum
+    if self.cwnd < self.w_max:
+      self.w_max = self.cwnd * (1 + self.BETA) / 2
+    else:
+      self.w_max = self.cwnd
+    self.epoch_start = None
+    self.ssthresh = max(self.cwnd * self.BETA, MIN_SSTHRESH)
+
+  def on_loss(self):
+    self.__reduce()
+    self.cwnd = self.ssthresh
+
+  def on_timeout(self):
+    self.__reduce()
+    self.cwnd = 1.0
+
+CONGESTION_CONTROLS: typing.Dict[str, typing.Type[CongestionControl]] = {
+  "fixed": FixedWindow,
+  "reno": Reno,
+  "cubic": Cubic,
+}
+
+def create_congestion_control(name: str, max_window: int = MAX_WINDOW_SIZE):
+  if name not in CONGESTION_CONTROLS:
+    raise ValueError(f"unknown congestion control {name}, available: {', '.join(CONGESTION_CONTROLS)}")
+  return CONGESTION_CONTROLS[name](max_window)
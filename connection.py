@@ -1,10 +1,30 @@
 
 
 import random
+import time
 import typing
+from congestion import MAX_WINDOW_SIZE, CongestionControl, create_congestion_control
+from segment import MAX_PAYLOAD
+from stats import ConnectionStats
 
 
-WINDOW_SIZE = 5
+# congestion control of new connections, see congestion.CONGESTION_CONTROLS
+CONGESTION_CONTROL = "reno"
+# segments the receiver keeps out of order, waiting for the missing ones
+RECEIVE_BUFFER_SIZE = 64
+# delayed ack, in order segments are acknowledged every DELAYED_ACK_SEGMENTS segments or after DELAYED_ACK_TIMEOUT seconds
+DELAYED_ACK_SEGMENTS = 2
+DELAYED_ACK_TIMEOUT = 0.01
+# retransmit only the unacknowledged segments (selective repeat) instead of the whole window (go back n)
+SELECTIVE_REPEAT = True
+# retransmission timeout bounds in seconds (RFC 6298), the initial one is used until the first rtt sample
+INITIAL_RTO = 1.0
+MIN_RTO = 0.02
+MAX_RTO = 60.0
+# attempts (first send included) for control segments before giving up
+MAX_RETRIES = 5
+# send a timestamp in data segments, echoed in the acks, so every ack gives an rtt sample
+USE_TIMESTAMPS = True
 
 def generate_seqnum():
   return random.randint(0, 2**32 - 1)
@@ -25,6 +45,47 @@ def get_seqnum_diff(seqnum_low: int, seqnum_high: int):
     return seqnum_high + (0xFFFFFFFF - seqnum_low)
   return seqnum_high - seqnum_low
 
+# Millisecond clock for the timestamp option, wraps at 32 bit
+def timestamp():
+  return int(time.monotonic() * 1000) & 0xFFFFFFFF
+
+# Smoothed round trip time estimator (RFC 6298). Samples from retransmitted segments must not be
+# fed to it (Karn's rule) unless they come from an echoed timestamp. Every timeout doubles the
+# retransmission timeout until the next valid sample.
+class RttEstimator:
+  def __init__(self) -> None:
+    self.srtt: typing.Optional[float] = None
+    self.rttvar: typing.Optional[float] = None
+    self.base_rto = INITIAL_RTO
+    self.backoff = 0
+    self.samples = 0
+    self.min_rtt: typing.Optional[float] = None
+
+  def sample(self, rtt: float):
+    self.samples += 1
+    if self.min_rtt is None or rtt < self.min_rtt:
+      self.min_rtt = rtt
+    if self.srtt is None:
+      self.srtt = rtt
+      self.rttvar = rtt / 2
+    else:
+      self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+      self.srtt = 0.875 * self.srtt + 0.125 * rtt
+    self.base_rto = min(MAX_RTO, max(MIN_RTO, self.srtt + 4 * self.rttvar))
+    self.backoff = 0
+
+  # Round trip time from the timestamp echoed in an ack
+  def sample_timestamp(self, echoed: int):
+    self.sample(((timestamp() - echoed) & 0xFFFFFFFF) / 1000)
+
+  def on_timeout(self):
+    if self.base_rto * 2 ** self.backoff < MAX_RTO:
+      self.backoff += 1
+
+  @property
+  def rto(self):
+    return min(MAX_RTO, self.base_rto * 2 ** self.backoff)
+
 class ConnectionSend:
   def __init__(self, ip: str, port: int, remote_ip: str, remote_port: int) -> None:
     self.ip = ip
@@ -34,19 +95,81 @@ class ConnectionSend:
     # same as sequence base
     self.seq_num = 0
     self.is_connected = False
+    self.selective_repeat = SELECTIVE_REPEAT
+    # sequence number + 1 of segments acknowledged individually, ahead of the sequence base
+    self.selective_acks: typing.Set[int] = set()
+    # sequence number after the last segment sent, None until the send loop sets it
+    self.next_seq_num: typing.Optional[int] = None
+    self.rtt = RttEstimator()
+    self.use_timestamps = USE_TIMESTAMPS
+    self.congestion: CongestionControl = create_congestion_control(CONGESTION_CONTROL)
+    # window advertised by the receiver, None until the first ack carrying it
+    self.receive_window: typing.Optional[int] = None
+    # largest window the socket buffers of the node were sized for (Node.fit_socket_buffers)
+    self.buffered_window = 0
+    # largest payload sent, negotiated in the handshake (the smallest of both advertised sizes)
+    self.payload_size = MAX_PAYLOAD
+    # codecs the peer decodes, advertised in the handshake (compression.CODEC_BITS)
+    self.codecs = 0
+
+  # Congestion control name, its window never larger than max_window
+  def set_congestion_control(self, name: str, max_window: int = MAX_WINDOW_SIZE):
+    self.congestion = create_congestion_control(name, max_window)
+
+  # Current retransmission timeout
+  @property
+  def rto(self):
+    return self.rtt.rto
 
+  # Segments allowed in flight, the congestion window bounded by the receive window
   @property
   def window_size(self):
-    return WINDOW_SIZE
+    if self.receive_window is None:
+      return self.congestion.window
+    return min(self.congestion.window, self.receive_window)
 
   @property
   def sequence_max(self):
     return increment_seqnum(self.seq_num + self.window_size + 1)
   
   def is_valid_ack(self, ack_num: int):
+    # the window can shrink below what is in flight, so acks are checked against what was sent
+    if self.next_seq_num is not None:
+      return 0 < get_seqnum_diff(self.seq_num, ack_num) <= get_seqnum_diff(self.seq_num, self.next_seq_num)
     if (self.sequence_max < self.seq_num):
       return self.seq_num <= ack_num - 1 or ack_num - 1 < self.sequence_max
     return self.seq_num <= ack_num - 1 < self.sequence_max
+
+  # Cumulative ack, every segment before ack_num is received
+  def acknowledge(self, ack_num: int):
+    if not self.is_valid_ack(ack_num):
+      return False
+    self.seq_num = ack_num
+    self.__skip_selective_acks()
+    return True
+
+  # Selective ack of the segments in a [left, right) sack block
+  def selective_acknowledge(self, left: int, right: int):
+    if not self.is_valid_ack(right):
+      return False
+    # the block may start before the sequence base
+    count = get_seqnum_diff(left, right)
+    if count > get_seqnum_diff(self.seq_num, right):
+      left = self.seq_num
+      count = get_seqnum_diff(left, right)
+    for i in range(count):
+      self.selective_acks.add(increment_seqnum(left, i + 1))
+    self.__skip_selective_acks()
+    return True
+
+  def is_selectively_acked(self, seq_num: int):
+    return increment_seqnum(seq_num) in self.selective_acks
+
+  # Moves the sequence base over segments that were already acknowledged individually
+  def __skip_selective_acks(self):
+    while increment_seqnum(self.seq_num) in self.selective_acks:
+      self.seq_num = increment_seqnum(self.seq_num)
+    self.selective_acks = {sack_num for sack_num in self.selective_acks if self.is_valid_ack(sack_num)}
     
 
 class ConnectionReceive:
@@ -57,10 +180,52 @@ class ConnectionReceive:
     self.remote_port = remote_port
     self.seq_num = 0
     self.is_connected = False
-  
+    self.buffer_size = RECEIVE_BUFFER_SIZE
+    # segments received ahead of seq_num, keyed by their sequence number
+    self.reorder_buffer: typing.Dict[int, typing.Any] = {}
+    # segments received in order but not acknowledged yet (delayed ack), 1 segment disables the delay
+    self.delayed_ack_segments = DELAYED_ACK_SEGMENTS
+    self.delayed_ack_timeout = DELAYED_ACK_TIMEOUT
+    self.unacked_segments = 0
+    self.ack_deadline: typing.Optional[float] = None
+    # timestamp of the peer to echo in the next ack
+    self.ts_recent: typing.Optional[int] = None
+    # largest payload advertised to the peer (OPTION_MSS)
+    self.payload_size = MAX_PAYLOAD
+
+  # Stores a segment received ahead of the expected sequence number, returns False if it does not fit
+  def buffer(self, segment):
+    if not 0 < get_seqnum_diff(self.seq_num, segment.seq_num) < self.buffer_size:
+      return False
+    if segment.seq_num not in self.reorder_buffer:
+      # the payload is a view into a receive buffer, keep a copy
+      segment.payload = bytes(segment.payload)
+      self.reorder_buffer[segment.seq_num] = segment
+    return True
+
+  # [left, right) ranges of the buffered segments, for the sack option of the ack
+  def sack_blocks(self):
+    blocks = []
+    for seq_num in sorted(self.reorder_buffer, key=lambda seq_num: get_seqnum_diff(self.seq_num, seq_num)):
+      if blocks and blocks[-1][1] == seq_num:
+        blocks[-1][1] = increment_seqnum(seq_num)
+      else:
+        blocks.append([seq_num, increment_seqnum(seq_num)])
+    return [(left, right) for left, right in blocks]
+
+  # Pops the buffered segments that directly follow seq_num, advancing it
+  def pop_contiguous(self):
+    segments = []
+    while self.seq_num in self.reorder_buffer:
+      segment = self.reorder_buffer.pop(self.seq_num)
+      segments.append(segment)
+      self.seq_num = increment_seqnum(self.seq_num)
+    return segments
+
 class Connection:
   def __init__(self, ip: str, port: int, remote_ip: str, remote_port: int) -> None:
     self.receive = ConnectionReceive(ip, port, remote_ip, remote_port)
     self.send = ConnectionSend(ip, port, remote_ip, remote_port)
+    self.stats = ConnectionStats()
 
 # ack itu punya send
\ No newline at end of file
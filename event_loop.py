@@ -0,0 +1,226 @@
+import selectors
+import time
+import typing
+from collections import deque
+from buffer_pool import BUFFER_POOL_SIZE
+from connection import MAX_RETRIES, Connection
+from segment import FIN_BYTES, Segment, SegmentError
+from fanout import FanOutGroup
+from log import log
+from transfer import FileTransfer
+
+
+# datagrams read per wake up before the tasks run, each holds a pool buffer until then
+MAX_BATCH = BUFFER_POOL_SIZE
+
+# Per connection state machine driven by an event loop: start is called when it is added,
+# on_segment for each valid segment of its peer (after the node processed it) and on_timer
+# once its deadline passed. The loop drops it once is_done.
+class ConnectionTask:
+  def __init__(self, node, ip: str, port: int) -> None:
+    self.node = node
+    self.ip = ip
+    self.port = port
+    # segments of the peer waiting to be handled
+    self.inbox: typing.Deque[Segment] = deque()
+    self.is_done = False
+
+  @property
+  def addr(self):
+    return (self.ip, self.port)
+
+  def start(self):
+    pass
+
+  def on_segment(self, segment: Segment):
+    pass
+
+  def on_timer(self):
+    pass
+
+  # Time (time.monotonic) on_timer should be called at, or None
+  def deadline(self) -> typing.Optional[float]:
+    return None
+
+STATE_HANDSHAKE = "handshake"
+STATE_TRANSFER = "transfer"
+STATE_CLOSING = "closing"
+
+# Sends a file to a peer: handshake, the transfer (FileTransfer) then termination, without ever
+# blocking, so one loop drives the transfers to every client of a server
+# With a group, the peer is a receiver of a one to many transfer (FanOutGroup)
+class SendFileTask(ConnectionTask):
+  def __init__(self, node, ip: str, port: int, file_path: str, group: typing.Optional[FanOutGroup] = None, byte_range: typing.Optional[typing.Tuple[int, int]] = None) -> None:
+    super().__init__(node, ip, port)
+    self.file_path = file_path
+    self.group = group
+    # only the chunks covering it are sent (a range request), never as part of the group
+    self.byte_range = byte_range
+    self.state = STATE_HANDSHAKE
+    self.conn: typing.Optional[Connection] = None
+    self.transfer: typing.Optional[FileTransfer] = None
+    # syn or fin retransmissions
+    self.attempts = 0
+    self.sent_at = 0.0
+    self.retry_at = 0.0
+
+  def start(self):
+    if self.byte_range is not None:
+      self.group = None
+    self.conn = self.node.open_connection(self.ip, self.port, None if self.group is None else self.group.seq_num)
+    self.__sent()
+
+  def __sent(self):
+    self.attempts += 1
+    self.sent_at = time.monotonic()
+    self.retry_at = self.sent_at + self.conn.send.rto
+
+  def on_segment(self, segment: Segment):
+    if self.state == STATE_HANDSHAKE and self.conn.send.is_connected:
+      # first rtt sample, only if the syn was not resent (Karn's rule)
+      if self.attempts == 1:
+        self.conn.send.rtt.sample(time.monotonic() - self.sent_at)
+      self.state = STATE_TRANSFER
+      self.transfer = FileTransfer(self.node, self.conn, self.file_path, byte_range=self.byte_range) if self.group is None else self.group.join(self.conn)
+      self.transfer.start()
+    elif self.state == STATE_TRANSFER:
+      self.transfer.on_segment(segment)
+      if self.transfer.is_done:
+        self.transfer.close()
+        log.info(f"[!] Finished sending to {self.ip}:{self.port} ({self.transfer.retransmissions} retransmissions)")
+        self.state = STATE_CLOSING
+        self.attempts = 0
+        self.node.send_bytes(self.ip, self.port, FIN_BYTES)
+        self.__sent()
+    elif self.state == STATE_CLOSING and self.addr not in self.node.connections:
+      self.is_done = True
+
+  def on_timer(self):
+    if self.state == STATE_TRANSFER:
+      self.transfer.on_timer()
+      if self.transfer.is_failed:
+        log.error(f"[!] No ack from {self.ip}:{self.port}, giving up the transfer")
+        self.transfer.close()
+        self.node.connections.pop(self.addr, None)
+        self.is_done = True
+      return
+    if self.attempts >= MAX_RETRIES:
+      if self.state == STATE_HANDSHAKE:
+        log.warning(f"[Handshake] No SYN ACK from {self.ip}:{self.port}, giving up")
+      else:
+        log.warning(f"[Termination] No FIN ACK from {self.ip}:{self.port}, closing")
+        self.transfer.close()
+      self.node.connections.pop(self.addr, None)
+      self.is_done = True
+      return
+    self.conn.send.rtt.on_timeout()
+    if self.state == STATE_HANDSHAKE:
+      log.debug("[Handshake] Timeout, resending syn")
+      self.node.send(self.ip, self.port, Segment.syn(self.conn.send.seq_num, self.node.syn_options(self.conn)))
+    else:
+      self.node.send_bytes(self.ip, self.port, FIN_BYTES)
+    self.__sent()
+
+  def deadline(self):
+    if self.state == STATE_TRANSFER:
+      return self.transfer.deadline()
+    return self.retry_at
+
+# Single I/O loop of a node: owns its socket (through selectors), parses each datagram once, lets
+# the node run the protocol on it (acks, sacks, windows, handshake and termination flags) and puts
+# it in the inbox of the task of its peer, keyed by (ip, port) like Node.connections. Tasks only
+# send, they never read the socket, so concurrent transfers do not steal each other's acks.
+# Connection requests (syn without ack) go to the on_request callback instead of the node.
+# With a linger, the loop keeps waiting for requests that long once every task is done.
+class EventLoop:
+  def __init__(self, node) -> None:
+    self.node = node
+    self.selector = selectors.DefaultSelector()
+    self.selector.register(node, selectors.EVENT_READ)
+    self.tasks: typing.Dict[typing.Tuple[str, int], ConnectionTask] = {}
+    self.__on_request = None
+    # time the loop stops at once it has no task, None while it has
+    self.idle_until: typing.Optional[float] = None
+
+  # Registers a callback for connection requests, called with the address of the peer and the request
+  def register_on_request(self, on_request: typing.Callable[[typing.Tuple[str, int], Segment], None]):
+    self.__on_request = on_request
+
+  def add_task(self, task: ConnectionTask):
+    self.tasks[task.addr] = task
+    task.start()
+
+  # Runs until every task is done and no request came for linger seconds
+  def run(self, linger: float = 0):
+    while True:
+      if self.tasks:
+        self.idle_until = None
+      elif self.idle_until is None:
+        self.idle_until = time.monotonic() + linger
+      if self.idle_until is not None and self.idle_until <= time.monotonic():
+        break
+      self.run_once()
+    self.idle_until = None
+
+  def run_once(self):
+    # datagrams a batch read left in the node are not seen by the selector
+    if self.node.pending_datagrams or self.selector.select(self.__timeout()):
+      self.__read()
+    self.node.flush_delayed_acks()
+    now = time.monotonic()
+    for addr, task in list(self.tasks.items()):
+      if not task.is_done:
+        deadline = task.deadline()
+        if deadline is not None and deadline <= now:
+          task.on_timer()
+      if task.is_done:
+        self.tasks.pop(addr)
+
+  def __timeout(self):
+    deadlines = [deadline for deadline in (task.deadline() for task in self.tasks.values()) if deadline is not None]
+    ack_deadline = self.node.next_ack_deadline()
+    if ack_deadline is not None:
+      deadlines.append(ack_deadline)
+    if self.idle_until is not None:
+      deadlines.append(self.idle_until)
+    if not deadlines:
+      return None
+    return max(0, min(deadlines) - time.monotonic())
+
+  # Reads the pending datagrams (at most MAX_BATCH), then hands them to the tasks
+  # The buffers are released once the tasks handled their segments
+  def __read(self):
+    buffers = []
+    ready: typing.List[ConnectionTask] = []
+    try:
+      for _ in range(MAX_BATCH):
+        buffer = self.node.buffer_pool.acquire()
+        buffers.append(buffer)
+        try:
+          addr, segment, checksum_valid = self.node.listen_base(0, buffer)
+        except BlockingIOError:
+          break
+        except SegmentError as e:
+          log.warning(str(e))
+          continue
+        if checksum_valid and segment.flags.syn and not segment.flags.ack:
+          if self.__on_request is not None:
+            self.__on_request(addr, segment)
+          continue
+        if not self.node.receive_segment(addr, segment, checksum_valid):
+          continue
+        task = self.tasks.get(addr)
+        if task is not None:
+          if not task.inbox:
+            ready.append(task)
+          task.inbox.append(segment)
+      for task in ready:
+        while task.inbox and not task.is_done:
+          task.on_segment(task.inbox.popleft())
+        task.inbox.clear()
+    finally:
+      for buffer in buffers:
+        self.node.buffer_pool.release(buffer)
+
+  def close(self):
+    self.selector.close()
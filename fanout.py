@@ -0,0 +1,93 @@
+import typing
+from compression import choose_codec
+from connection import Connection, generate_seqnum
+from transfer import FileTransfer
+
+
+# One to many transfer of a file. Every connection of the group starts at the same sequence number,
+# so the datagram of a chunk is the same for every receiver: it is encoded once and sent to all of
+# them. New chunks are fanned out in lockstep up to the frontier, the furthest chunk every receiver
+# window allows, so the group goes at the pace of its slowest receiver. Acks, timers, windows and
+# retransmissions stay per receiver (FanOutMember), a chunk is resent only to the receivers missing it.
+class FanOutGroup:
+  def __init__(self, node, file_path: str) -> None:
+    self.node = node
+    self.file_path = file_path
+    # initial sequence number of every connection of the group
+    self.seq_num = generate_seqnum()
+    self.members: typing.List[FanOutMember] = []
+    # chunks below it were fanned out
+    self.frontier = 0
+    # encoded (headers, payload) of the chunks not acknowledged by every receiver yet
+    self.encoded: typing.Dict[int, typing.Tuple[int, bytes, bytes]] = {}
+    self.encodings = 0
+    # chunk size and codec of the group, the ones negotiated by the first receiver
+    self.payload_size: typing.Optional[int] = None
+    self.codec: typing.Optional[str] = None
+
+  # Sender state of a new receiver. A receiver that negotiated another payload size or codec gets
+  # other segments, it is sent to on its own
+  def join(self, conn: Connection):
+    codec = choose_codec(self.node.compression, conn.send.codecs)
+    if self.payload_size is None:
+      self.payload_size = conn.send.payload_size
+      self.codec = codec
+    if conn.send.payload_size != self.payload_size or codec != self.codec:
+      return FileTransfer(self.node, conn, self.file_path)
+    member = FanOutMember(self, conn)
+    self.members.append(member)
+    return member
+
+  def leave(self, member: "FanOutMember"):
+    if member in self.members:
+      self.members.remove(member)
+
+  # Headers and payload of chunk index for a member, encoded by the first member that sends it
+  def encode(self, member: "FanOutMember", index: int):
+    seq_num = member.seq_num(index)
+    entry = self.encoded.get(index)
+    if entry is None or entry[0] != seq_num:
+      self.encodings += 1
+      entry = (seq_num, *FileTransfer.encode_chunk(member, index))
+      self.encoded[index] = entry
+    return entry[1], entry[2]
+
+  # Moves the frontier as far as the windows of the receivers allow and sends the new chunks to
+  # all of them. Receivers behind the frontier (joined late or rewound) catch up on their own.
+  def fan_out(self):
+    members = [member for member in self.members if member.first_seq_num is not None and not member.is_done]
+    in_step = [member for member in members if member.sent_chunks >= self.frontier]
+    if in_step:
+      frontier = min(min(member.acked_chunks + member.conn.send.window_size, member.chunk_count) for member in in_step)
+      if frontier > self.frontier:
+        self.frontier = frontier
+        for member in in_step:
+          FileTransfer.send_window(member)
+    # chunks every receiver acknowledged are not sent again
+    if members:
+      acked = min(member.acked_chunks for member in members)
+      for index in [index for index in self.encoded if index < acked]:
+        self.encoded.pop(index)
+
+# Sender state of one receiver of a FanOutGroup
+class FanOutMember(FileTransfer):
+  def __init__(self, group: FanOutGroup, conn: Connection) -> None:
+    super().__init__(group.node, conn, group.file_path)
+    self.group = group
+
+  def send_limit(self):
+    return self.group.frontier
+
+  def send_window(self):
+    self.group.fan_out()
+    super().send_window()
+
+  # First transmissions share the group encoding, retransmissions get a fresh timestamp
+  def encode_chunk(self, index: int):
+    if index < self.sent_chunks:
+      return super().encode_chunk(index)
+    return self.group.encode(self, index)
+
+  def close(self):
+    self.group.leave(self)
+    super().close()
@@ -0,0 +1,82 @@
+import os
+import queue
+import threading
+import typing
+
+
+# positional writes are not available on every platform (e.g. windows)
+HAS_PWRITE = hasattr(os, "pwrite")
+
+# Output file written at chunk offsets by a background thread, so a slow disk never holds up the
+# receive loop and its acks. The file is preallocated when the size is known. Writes are queued
+# without a bound, the receiver advertises a smaller window while they pile up (backlog), which
+# is what limits them. close waits for the queue to drain.
+# A partial file being resumed is kept (truncate False), on_write is called by the writer thread
+# with (offset, data) once data is written. Data queued with a decode function (e.g. a
+# decompressor) is decoded by the writer thread too, off the receive loop.
+class FileSink:
+  def __init__(self, path: str, size: typing.Optional[int] = None, truncate: bool = True, on_write: typing.Optional[typing.Callable[[int, bytes], None]] = None) -> None:
+    self.path = path
+    self.size = size
+    self.on_write = on_write
+    self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | (os.O_TRUNC if truncate else 0) | getattr(os, "O_BINARY", 0), 0o644)
+    if size:
+      self.__preallocate(size)
+    self.queue: queue.Queue = queue.Queue()
+    self.written = 0
+    self.error: typing.Optional[Exception] = None
+    self.__thread = threading.Thread(target=self.__run, daemon=True)
+    self.__thread.start()
+
+  def __preallocate(self, size: int):
+    if hasattr(os, "posix_fallocate"):
+      try:
+        os.posix_fallocate(self.fd, 0, size)
+        return
+      except OSError:
+        # not supported by the file system
+        pass
+    os.ftruncate(self.fd, size)
+
+  # Queues data to be written at offset, never blocks
+  def write(self, offset: int, data: bytes, decode: typing.Optional[typing.Callable[[bytes], bytes]] = None):
+    self.queue.put_nowait((offset, data, decode))
+
+  # Writes queued but not written yet
+  @property
+  def backlog(self):
+    return self.queue.qsize()
+
+  def __run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      offset, data, decode = item
+      try:
+        if decode is not None:
+          data = decode(data)
+        if HAS_PWRITE:
+          os.pwrite(self.fd, data, offset)
+        else:
+          os.lseek(self.fd, offset, os.SEEK_SET)
+          os.write(self.fd, data)
+        self.written += len(data)
+        if self.on_write is not None:
+          self.on_write(offset, data)
+      except Exception as e:
+        self.error = e
+      finally:
+        self.queue.task_done()
+
+  # Waits for the queued writes
+  def flush(self):
+    self.queue.join()
+
+  # Waits for the queued writes, then closes the file
+  def close(self):
+    self.queue.put(None)
+    self.__thread.join()
+    os.close(self.fd)
+    if self.error is not None:
+      raise self.error
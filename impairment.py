@@ -0,0 +1,305 @@
+import argparse
+import heapq
+import random
+import selectors
+import socket
+import threading
+import time
+import typing
+from segment import HEADER_SIZE, MAX_SEGMENT, Segment
+
+
+# seed of the random decisions, the same seed drops, duplicates, reorders and corrupts the same
+# datagrams of the same sequence of datagrams
+IMPAIRMENT_SEED = 1
+# a reordered datagram is held back this many seconds more than the others, the next ones overtake it
+REORDER_DELAY = 0.005
+# bytes queued in front of a bandwidth limit before datagrams are dropped (tail drop)
+QUEUE_SIZE = 1 << 18
+
+# What a link does to the datagrams going through it: probabilities (0 to 1) of loss, duplication,
+# reordering and corruption (a bit flipped), a one way delay with a jitter (seconds, the jitter is
+# spread uniformly around the delay) and a bandwidth (bits per second, None for no limit)
+class Impairment:
+  def __init__(self, loss: float = 0.0, duplicate: float = 0.0, reorder: float = 0.0, corrupt: float = 0.0, delay: float = 0.0, jitter: float = 0.0, bandwidth: typing.Optional[float] = None, queue_size: int = QUEUE_SIZE, seed: int = IMPAIRMENT_SEED) -> None:
+    self.loss = loss
+    self.duplicate = duplicate
+    self.reorder = reorder
+    self.corrupt = corrupt
+    self.delay = delay
+    self.jitter = jitter
+    self.bandwidth = bandwidth
+    self.queue_size = queue_size
+    self.seed = seed
+
+  # Whether datagrams can be held back, they then go through the delivery thread of the link
+  @property
+  def is_delaying(self):
+    return self.delay > 0 or self.jitter > 0 or self.reorder > 0 or self.bandwidth is not None
+
+  def __str__(self) -> str:
+    bandwidth = "unlimited" if self.bandwidth is None else f"{self.bandwidth / 1e6:g} Mbit/s"
+    return f"loss {self.loss:g}, duplicate {self.duplicate:g}, reorder {self.reorder:g}, corrupt {self.corrupt:g}, delay {self.delay * 1000:g} ms, jitter {self.jitter * 1000:g} ms, bandwidth {bandwidth}, seed {self.seed}"
+
+# Datagrams sent through an Impairment: each one is dropped, corrupted, duplicated or scheduled
+# after its delay, its time on the wire at the bandwidth and the datagrams queued before it. A
+# thread sends the held datagrams once they are due, the others are sent right away by the caller.
+class ImpairedLink:
+  def __init__(self, impairment: Impairment) -> None:
+    self.impairment = impairment
+    self.random = random.Random(impairment.seed)
+    # (due, order, data, socket, address) of the held datagrams
+    self.queue: typing.List[typing.Tuple[float, int, bytes, socket.socket, typing.Tuple[str, int]]] = []
+    self.order = 0
+    # time the bandwidth limit is free to send the next datagram at
+    self.free_at = 0.0
+    self.sent = 0
+    self.dropped = 0
+    self.duplicated = 0
+    self.reordered = 0
+    self.corrupted = 0
+    self.__condition = threading.Condition()
+    self.__thread: typing.Optional[threading.Thread] = None
+    self.__closed = False
+
+  # Sends data to address from sock through the impairment
+  def submit(self, data: bytes, sock: socket.socket, address: typing.Tuple[str, int]):
+    impairment = self.impairment
+    with self.__condition:
+      if self.random.random() < impairment.loss:
+        self.dropped += 1
+        return
+      if self.random.random() < impairment.corrupt:
+        data = corrupt(data, self.random)
+        self.corrupted += 1
+      copies = 1
+      if self.random.random() < impairment.duplicate:
+        copies = 2
+        self.duplicated += 1
+      if not impairment.is_delaying:
+        for _ in range(copies):
+          self.__deliver(data, sock, address)
+        return
+      now = time.monotonic()
+      due = now
+      if impairment.bandwidth is not None:
+        if (self.free_at - now) * impairment.bandwidth / 8 > impairment.queue_size:
+          self.dropped += 1
+          return
+        self.free_at = max(now, self.free_at) + len(data) * 8 / impairment.bandwidth
+        due = self.free_at
+      due += max(0.0, impairment.delay + self.random.uniform(-impairment.jitter, impairment.jitter))
+      if self.random.random() < impairment.reorder:
+        due += REORDER_DELAY
+        self.reordered += 1
+      for _ in range(copies):
+        heapq.heappush(self.queue, (due, self.order, bytes(data), sock, address))
+        self.order += 1
+      if self.__thread is None:
+        self.__thread = threading.Thread(target=self.__run, name="impairment", daemon=True)
+        self.__thread.start()
+      self.__condition.notify()
+
+  def __deliver(self, data: bytes, sock: socket.socket, address: typing.Tuple[str, int]):
+    try:
+      sock.sendto(data, address)
+      self.sent += 1
+    except OSError:
+      # closed socket or full buffer, the datagram is lost like on a real link
+      self.dropped += 1
+
+  def __run(self):
+    with self.__condition:
+      while not self.__closed:
+        if not self.queue:
+          self.__condition.wait()
+          continue
+        wait = self.queue[0][0] - time.monotonic()
+        if wait > 0:
+          self.__condition.wait(wait)
+          continue
+        _, _, data, sock, address = heapq.heappop(self.queue)
+        self.__deliver(data, sock, address)
+
+  # Stops the delivery thread, the datagrams still held are dropped
+  def close(self):
+    with self.__condition:
+      self.__closed = True
+      self.dropped += len(self.queue)
+      self.queue.clear()
+      self.__condition.notify()
+
+  def __str__(self) -> str:
+    return f"sent: {self.sent}, dropped: {self.dropped}, duplicated: {self.duplicated}, reordered: {self.reordered}, corrupted: {self.corrupted}"
+
+# Copy of data with one random bit flipped
+def corrupt(data: bytes, rng: random.Random):
+  corrupted = bytearray(data)
+  bit = rng.randrange(len(corrupted) * 8)
+  corrupted[bit >> 3] ^= 1 << (bit & 7)
+  return bytes(corrupted)
+
+# Sends everything a node sends (send, send_encoded, send_batch, send_bytes) through an ImpairedLink, returns
+# the link. Datagrams go out of the bound socket of the node, so its peers see the same address.
+def impair(node, impairment: Impairment):
+  link = ImpairedLink(impairment)
+  sock = node.get_socket()
+  def send_encoded(ip_remote: str, port_remote: int, headers: bytes, payload: bytes):
+    node.count_sent(ip_remote, port_remote, len(headers) + len(payload))
+    link.submit(headers + payload if payload else headers, sock, (ip_remote, port_remote))
+  def send_bytes(ip_remote: str, port_remote: int, data: bytes):
+    node.count_sent(ip_remote, port_remote, len(data))
+    link.submit(data, sock, (ip_remote, port_remote))
+  def send_batch(ip_remote: str, port_remote: int, datagrams: typing.List[typing.Tuple[bytes, bytes]]):
+    node.follow_window(ip_remote, port_remote)
+    for headers, payload in datagrams:
+      send_encoded(ip_remote, port_remote, headers, payload)
+  node.send_encoded = send_encoded
+  node.send_batch = send_batch
+  node.send_bytes = send_bytes
+  return link
+
+# Impairs what a node receives (listen_base): datagrams are dropped, corrupted or duplicated
+# as they are read. Delay, reordering and bandwidth need datagrams to be held back, they only apply
+# on the way out (impair on the sending node, or ImpairmentRelay). Returns the link for its counters.
+def impair_listen(node, impairment: Impairment):
+  link = ImpairedLink(impairment)
+  listen_base = node.listen_base
+  # copy of the last datagram, read again by the next call
+  duplicates: typing.List[typing.Tuple[typing.Tuple[str, int], bytes]] = []
+  def impaired_listen_base(timeout: typing.Optional[float] = None, buffer: typing.Optional[bytearray] = None):
+    if buffer is None:
+      buffer = bytearray(node.buffer_pool.buffer_size)
+    if duplicates:
+      addr, data = duplicates.pop()
+      buffer[:len(data)] = data
+      segment, checksum_valid = Segment.from_bytes(memoryview(buffer)[:len(data)])
+      return addr, segment, checksum_valid
+    deadline = None if not timeout else time.monotonic() + timeout
+    while True:
+      addr, segment, checksum_valid = listen_base(timeout if deadline is None else max(0.001, deadline - time.monotonic()), buffer)
+      if link.random.random() < impairment.loss:
+        link.dropped += 1
+        continue
+      size = HEADER_SIZE + len(segment.options_bytes) + len(segment.payload)
+      if link.random.random() < impairment.corrupt:
+        buffer[:size] = corrupt(bytes(buffer[:size]), link.random)
+        link.corrupted += 1
+        segment, checksum_valid = Segment.from_bytes(memoryview(buffer)[:size])
+      if link.random.random() < impairment.duplicate:
+        duplicates.append((addr, bytes(buffer[:size])))
+        link.duplicated += 1
+      link.sent += 1
+      return addr, segment, checksum_valid
+  node.listen_base = impaired_listen_base
+  return link
+
+# Standalone UDP relay: peers send to the relay port instead of the target, each peer gets a socket
+# of its own towards the target, and each address of the target side (e.g. the extra sockets of a
+# striped transfer) a socket of its own towards the peer, so both sides see distinct addresses like
+# they would without the relay. Both directions go through their own ImpairedLink.
+class ImpairmentRelay:
+  def __init__(self, ip: str, port: int, target: typing.Tuple[str, int], impairment: Impairment) -> None:
+    self.ip = ip
+    self.target = target
+    self.selector = selectors.DefaultSelector()
+    self.upstream = ImpairedLink(impairment)
+    # the other direction draws other random numbers, with a seed of its own
+    self.downstream = ImpairedLink(Impairment(impairment.loss, impairment.duplicate, impairment.reorder, impairment.corrupt, impairment.delay, impairment.jitter, impairment.bandwidth, impairment.queue_size, impairment.seed + 1))
+    # per peer, the socket its datagrams go to the target from
+    self.peer_sockets: typing.Dict[typing.Tuple[str, int], socket.socket] = {}
+    # per (target side address, peer), the socket its datagrams go to the peer from
+    self.target_sockets: typing.Dict[typing.Tuple[typing.Tuple[str, int], typing.Tuple[str, int]], socket.socket] = {}
+    # per socket, (address datagrams read from it go to, socket they are sent from, link)
+    self.routes: typing.Dict[socket.socket, typing.Tuple[typing.Optional[typing.Tuple[str, int]], typing.Optional[socket.socket], ImpairedLink]] = {}
+    self.sock = self.__open(port)
+    self.port = self.sock.getsockname()[1]
+    self.routes[self.sock] = (target, None, self.upstream)
+
+  def __open(self, port: int = 0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((self.ip, port))
+    sock.setblocking(False)
+    self.selector.register(sock, selectors.EVENT_READ)
+    return sock
+
+  # Socket towards the target for a peer
+  def __peer_socket(self, peer: typing.Tuple[str, int]):
+    sock = self.peer_sockets.get(peer)
+    if sock is None:
+      sock = self.peer_sockets[peer] = self.__open()
+      self.routes[sock] = (peer, None, self.downstream)
+    return sock
+
+  # Socket towards a peer for an address of the target side
+  def __target_socket(self, source: typing.Tuple[str, int], peer: typing.Tuple[str, int]):
+    if source == self.target:
+      return self.sock
+    sock = self.target_sockets.get((source, peer))
+    if sock is None:
+      sock = self.target_sockets[(source, peer)] = self.__open()
+      self.routes[sock] = (source, self.peer_sockets[peer], self.upstream)
+    return sock
+
+  # Relays the datagrams until duration seconds passed (forever without)
+  def run(self, duration: typing.Optional[float] = None):
+    deadline = None if duration is None else time.monotonic() + duration
+    while deadline is None or deadline > time.monotonic():
+      for key, _ in self.selector.select(None if deadline is None else max(0, deadline - time.monotonic())):
+        self.__relay(key.fileobj)
+
+  def __relay(self, sock: socket.socket):
+    while True:
+      try:
+        data, source = sock.recvfrom(MAX_SEGMENT)
+      except (BlockingIOError, ConnectionError):
+        return
+      destination, from_sock, link = self.routes[sock]
+      if link is self.downstream:
+        # from the target side to the peer of this socket, out of the socket of that address
+        link.submit(data, self.__target_socket(source, destination), destination)
+      elif from_sock is None:
+        # from a peer to the target
+        link.submit(data, self.__peer_socket(source), destination)
+      else:
+        # from a peer to another address of the target side
+        link.submit(data, from_sock, destination)
+
+  def close(self):
+    self.upstream.close()
+    self.downstream.close()
+    for sock in self.routes:
+      sock.close()
+    self.selector.close()
+
+# Adds the impairment options to a command line parser, read back by from_args
+def add_arguments(parser: argparse.ArgumentParser):
+  parser.add_argument("--loss", type=float, default=0.0, help="probability a datagram is lost")
+  parser.add_argument("--duplicate", type=float, default=0.0, help="probability a datagram is duplicated")
+  parser.add_argument("--reorder", type=float, default=0.0, help="probability a datagram is overtaken by the next ones")
+  parser.add_argument("--corrupt", type=float, default=0.0, help="probability a bit of a datagram is flipped")
+  parser.add_argument("--delay", type=float, default=0.0, help="one way delay, in ms")
+  parser.add_argument("--jitter", type=float, default=0.0, help="delay variation, in ms")
+  parser.add_argument("--bandwidth", type=float, default=None, help="bandwidth, in Mbit/s")
+  parser.add_argument("--seed", type=int, default=IMPAIRMENT_SEED)
+
+def from_args(args: argparse.Namespace):
+  return Impairment(args.loss, args.duplicate, args.reorder, args.corrupt, args.delay / 1000, args.jitter / 1000, None if args.bandwidth is None else args.bandwidth * 1e6, seed=args.seed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("port", type=int, help="port the peers send to instead of the target")
+    parser.add_argument("target_port", type=int)
+    parser.add_argument("--target-ip", type=str, default="127.0.0.1")
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    relay = ImpairmentRelay('127.0.0.1', args.port, (args.target_ip, args.target_port), from_args(args))
+    print(f"[!] Relaying {relay.port} to {args.target_ip}:{args.target_port}, {relay.upstream.impairment}")
+    try:
+      relay.run()
+    except KeyboardInterrupt:
+      pass
+    print(f"[!] To the target {relay.upstream}")
+    print(f"[!] From the target {relay.downstream}")
+    relay.close()
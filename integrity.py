@@ -0,0 +1,186 @@
+import base64
+import hashlib
+import math
+import threading
+import typing
+
+
+# digest of the whole content carried in the metadata
+DIGEST_ALGORITHM = "sha256"
+DIGEST_ALGORITHMS = ("sha256", "blake2b")
+# send the hashes of the blocks of the content too, a corrupted block is then requested again alone
+BLOCK_HASHES = True
+# smallest block, doubled until the hash list fits in the metadata segment
+BLOCK_SIZE = 1 << 20
+# bytes kept of each block hash
+BLOCK_HASH_SIZE = 16
+
+# Size of the base64 list of count block hashes
+def block_list_size(count: int):
+  return 4 * math.ceil(count * BLOCK_HASH_SIZE / 3)
+
+# Smallest block size (BLOCK_SIZE doubled) whose hash list for size bytes fits in room bytes,
+# None if not even a single hash fits
+def fit_block_size(size: int, room: int):
+  if room < block_list_size(1):
+    return None
+  block_size = BLOCK_SIZE
+  while block_list_size(math.ceil(size / block_size)) > room:
+    block_size *= 2
+  return block_size
+
+# Digest of a content: the hex digest of the whole content and, with a block size, the digests of
+# its blocks truncated to BLOCK_HASH_SIZE bytes
+class ContentDigest:
+  def __init__(self, algorithm: str, value: str, block_size: typing.Optional[int] = None, blocks: typing.Optional[typing.List[bytes]] = None) -> None:
+    self.algorithm = algorithm
+    self.value = value
+    self.block_size = block_size
+    self.blocks = blocks
+
+  def to_metadata(self):
+    metadata = {'algorithm': self.algorithm, 'value': self.value}
+    if self.blocks is not None:
+      metadata['block_size'] = self.block_size
+      metadata['blocks'] = base64.b64encode(b"".join(self.blocks)).decode()
+    return metadata
+
+  @staticmethod
+  def from_metadata(metadata: dict):
+    blocks = None
+    if 'blocks' in metadata:
+      data = base64.b64decode(metadata['blocks'])
+      blocks = [data[i:i + BLOCK_HASH_SIZE] for i in range(0, len(data), BLOCK_HASH_SIZE)]
+    return ContentDigest(metadata['algorithm'], metadata['value'], metadata.get('block_size'), blocks)
+
+# Digest of a mapped file in one pass over its chunks, the block hashes with it when block_size is given
+def compute_digest(file, algorithm: str, block_size: typing.Optional[int] = None):
+  digest = hashlib.new(algorithm)
+  blocks: typing.List[bytes] = []
+  block_digest = hashlib.new(algorithm)
+  offset = 0
+  for index in range(math.ceil(file.size / file.chunk_size)):
+    data = file.chunk(index)
+    digest.update(data)
+    while block_size is not None and data:
+      take = min(len(data), block_size - offset % block_size)
+      block_digest.update(data[:take])
+      data = data[take:]
+      offset += take
+      if offset % block_size == 0 or offset == file.size:
+        blocks.append(block_digest.digest()[:BLOCK_HASH_SIZE])
+        block_digest = hashlib.new(algorithm)
+  return ContentDigest(algorithm, digest.hexdigest(), block_size, blocks if block_size is not None else None)
+
+# Checks received data against a ContentDigest as it is written, without reading the file again.
+# The whole content digest is streamed while data comes in order (a single connection), the
+# blocks are checked as soon as each one is complete, whatever the order of the blocks (striped
+# or resumed transfers). Data inside a block waits for the data before it.
+class ContentVerifier:
+  def __init__(self, digest: ContentDigest, size: int) -> None:
+    self.digest = digest
+    self.size = size
+    # streamed digest of the content, None once data came out of order
+    self.content_hash = hashlib.new(digest.algorithm)
+    self.streamed = 0
+    self.block_count = math.ceil(size / digest.block_size) if digest.blocks is not None else 0
+    # per block being received, its digest so far and the offset it reached
+    self.block_hashes: typing.Dict[int, typing.Tuple[typing.Any, int]] = {}
+    # per block, data received ahead of the offset it reached, by offset
+    self.pending: typing.Dict[int, typing.Dict[int, bytes]] = {}
+    self.verified: typing.Set[int] = set()
+    self.corrupt: typing.Set[int] = set()
+    # data is written by the writer thread of the sink
+    self.__lock = threading.Lock()
+
+  # Feeds data written at offset, returns the (offset, length) of the blocks found corrupted
+  def update(self, offset: int, data: bytes):
+    with self.__lock:
+      if self.content_hash is not None:
+        if offset == self.streamed:
+          self.content_hash.update(data)
+          self.streamed += len(data)
+        elif offset > self.streamed:
+          self.content_hash = None
+      corrupt = []
+      while self.block_count and data:
+        block = offset // self.digest.block_size
+        take = min(len(data), (block + 1) * self.digest.block_size - offset)
+        if self.__update_block(block, offset, data[:take]):
+          corrupt.append(self.block_range(block))
+        offset += take
+        data = data[take:]
+      return corrupt
+
+  # Returns whether the block was completed and found corrupted
+  def __update_block(self, block: int, offset: int, data: bytes):
+    if block in self.verified or block in self.corrupt:
+      return False
+    digest, reached = self.block_hashes.get(block, (None, block * self.digest.block_size))
+    if digest is None:
+      digest = hashlib.new(self.digest.algorithm)
+    if offset > reached:
+      self.pending.setdefault(block, {})[offset] = bytes(data)
+      self.block_hashes[block] = (digest, reached)
+      return False
+    if offset + len(data) <= reached:
+      # resent data already hashed
+      return False
+    digest.update(data[reached - offset:])
+    reached = offset + len(data)
+    pending = self.pending.get(block, {})
+    while reached in pending:
+      data = pending.pop(reached)
+      digest.update(data)
+      reached += len(data)
+    start, length = self.block_range(block)
+    if reached < start + length:
+      self.block_hashes[block] = (digest, reached)
+      return False
+    self.block_hashes.pop(block, None)
+    self.pending.pop(block, None)
+    if digest.digest()[:BLOCK_HASH_SIZE] == self.digest.blocks[block]:
+      self.verified.add(block)
+      return False
+    self.corrupt.add(block)
+    return True
+
+  # (offset, length) of a block
+  def block_range(self, block: int):
+    start = block * self.digest.block_size
+    return start, min(self.digest.block_size, self.size - start)
+
+  # (offset, length) of the corrupted blocks
+  def corrupt_ranges(self):
+    with self.__lock:
+      return [self.block_range(block) for block in sorted(self.corrupt)]
+
+  # Forgets a corrupted block, to check it again once it is received again. The streamed digest
+  # went through the corrupted data, the blocks decide from now on
+  def reset_block(self, offset: int):
+    with self.__lock:
+      self.corrupt.discard(offset // self.digest.block_size)
+      self.content_hash = None
+
+  # True if the content matches the digest, False if it does not, None when it cannot tell (data
+  # out of order without block hashes, or missing)
+  def check(self):
+    with self.__lock:
+      if self.content_hash is not None and self.streamed == self.size:
+        return self.content_hash.hexdigest() == self.digest.value
+      if self.corrupt:
+        return False
+      if self.block_count and len(self.verified) == self.block_count:
+        return True
+      return None
+
+# Whether the file at path matches digest, reading it whole (when ContentVerifier cannot tell)
+def verify_file(path: str, digest: ContentDigest):
+  content_hash = hashlib.new(digest.algorithm)
+  with open(path, "rb") as f:
+    while True:
+      data = f.read(1 << 20)
+      if not data:
+        break
+      content_hash.update(data)
+  return content_hash.hexdigest() == digest.value
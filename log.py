@@ -0,0 +1,168 @@
+import argparse
+import atexit
+import signal
+import sys
+import threading
+import time
+import typing
+from collections import deque
+
+
+# levels, per segment events are TRACE
+TRACE = 5
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+# nothing but the errors, and no trace event is recorded
+QUIET = 100
+LEVELS = {"trace": TRACE, "debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR, "quiet": QUIET}
+LOG_LEVEL = "info"
+# trace events kept in memory (0 keeps none), dumped on an error or on demand
+TRACE_RING_SIZE = 0
+# printed trace lines: one event in TRACE_SAMPLE, at most TRACE_RATE lines per second
+TRACE_SAMPLE = 1
+TRACE_RATE = 1000
+# printed trace lines are buffered and written this many at once (or before any other line)
+TRACE_BUFFER_LINES = 256
+
+# Leveled logger of the transport. Lines of level INFO and above are written right away to the
+# current sys.stdout, trace lines are sampled, rate limited and buffered. Trace events can also be
+# kept in a ring buffer (a deque, appended to without a lock) as (time, level, message, args),
+# formatted only when it is dumped.
+# Hot paths check tracing first, so with trace lines off and no ring a trace event costs one branch:
+#   if log.tracing:
+#     log.trace("[Segment SEQ=%d] Sent", seq_num)
+class Logger:
+  def __init__(self, level: int = LEVELS[LOG_LEVEL], ring_size: int = TRACE_RING_SIZE) -> None:
+    self.__level = level
+    self.ring: typing.Optional[typing.Deque[typing.Tuple[float, int, str, tuple]]] = deque(maxlen=ring_size) if ring_size else None
+    # whether trace events are printed or recorded, the only check on the hot paths
+    self.tracing = False
+    self.trace_sample = TRACE_SAMPLE
+    self.trace_rate = TRACE_RATE
+    self.traced = 0
+    # lines printed in the current second, and the ones the rate limit dropped
+    self.rate_window = 0.0
+    self.rate_lines = 0
+    self.suppressed = 0
+    self.buffer: typing.List[str] = []
+    self.__lock = threading.Lock()
+    self.__update()
+
+  @property
+  def level(self):
+    return self.__level
+
+  @level.setter
+  def level(self, level: int):
+    self.__level = level
+    self.__update()
+
+  # Keeps the last size trace events in memory, 0 keeps none
+  def record(self, size: int):
+    self.ring = deque(maxlen=size) if size else None
+    self.__update()
+
+  def __update(self):
+    self.tracing = self.__level <= TRACE or (self.ring is not None and self.__level < QUIET)
+
+  def trace(self, message: str, *args):
+    if self.ring is not None:
+      self.ring.append((time.monotonic(), TRACE, message, args))
+    if self.__level > TRACE:
+      return
+    self.traced += 1
+    if self.traced % self.trace_sample:
+      return
+    with self.__lock:
+      now = time.monotonic()
+      if now - self.rate_window >= 1:
+        if self.suppressed:
+          self.buffer.append(f"[log] {self.suppressed} trace lines dropped by the rate limit")
+        self.rate_window = now
+        self.rate_lines = 0
+        self.suppressed = 0
+      if self.rate_lines >= self.trace_rate:
+        self.suppressed += 1
+        return
+      self.rate_lines += 1
+      self.buffer.append(message % args if args else message)
+      if len(self.buffer) >= TRACE_BUFFER_LINES:
+        self.__write_buffer()
+
+  def debug(self, message: str, *args):
+    self.log(DEBUG, message, *args)
+
+  def info(self, message: str, *args):
+    self.log(INFO, message, *args)
+
+  def warning(self, message: str, *args):
+    self.log(WARNING, message, *args)
+
+  # Errors dump the recorded trace events first, they tell what led there
+  def error(self, message: str, *args):
+    if self.ring:
+      self.dump()
+    self.log(ERROR, message, *args)
+
+  def log(self, level: int, message: str, *args):
+    if self.ring is not None and level < QUIET:
+      self.ring.append((time.monotonic(), level, message, args))
+    if level < self.__level:
+      return
+    with self.__lock:
+      self.buffer.append(message % args if args else message)
+      self.__write_buffer()
+
+  def __write_buffer(self):
+    if self.buffer:
+      sys.stdout.write("\n".join(self.buffer) + "\n")
+      self.buffer.clear()
+
+  # Writes the buffered trace lines
+  def flush(self):
+    with self.__lock:
+      self.__write_buffer()
+    sys.stdout.flush()
+
+  # Writes the recorded events, oldest first, with their time relative to the last one
+  def dump(self, stream: typing.Optional[typing.TextIO] = None):
+    if not self.ring:
+      return
+    events = list(self.ring)
+    names = {level: name for name, level in LEVELS.items()}
+    end = events[-1][0]
+    lines = [f"[log] last {len(events)} events"]
+    for at, level, message, args in events:
+      lines.append(f"{(at - end) * 1000:10.3f} ms {names.get(level, level):<7} {message % args if args else message}")
+    with self.__lock:
+      self.__write_buffer()
+      (stream or sys.stderr).write("\n".join(lines) + "\n")
+
+  # Dumps the recorded events when the process gets SIGUSR1 (where the platform has it)
+  def dump_on_signal(self):
+    if hasattr(signal, "SIGUSR1"):
+      signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump())
+
+  def configure(self, level: str, ring_size: int = TRACE_RING_SIZE, sample: int = TRACE_SAMPLE, rate: int = TRACE_RATE):
+    self.level = LEVELS[level]
+    self.record(ring_size)
+    self.trace_sample = max(1, sample)
+    self.trace_rate = rate
+    if ring_size:
+      self.dump_on_signal()
+
+  # Adds the logging options to a command line parser, read back by from_args
+  def add_arguments(self, parser: argparse.ArgumentParser):
+    parser.add_argument("--log-level", type=str, default=LOG_LEVEL, choices=list(LEVELS), help="trace prints every segment")
+    parser.add_argument("--trace-ring", type=int, default=TRACE_RING_SIZE, help="trace events kept in memory, dumped on an error or on SIGUSR1")
+    parser.add_argument("--trace-sample", type=int, default=TRACE_SAMPLE, help="prints one trace event in n")
+    parser.add_argument("--trace-rate", type=int, default=TRACE_RATE, help="most trace lines printed per second")
+
+  def from_args(self, args: argparse.Namespace):
+    self.configure(args.log_level, args.trace_ring, args.trace_sample, args.trace_rate)
+
+# logger of the transport, shared by every module
+log = Logger()
+atexit.register(log.flush)
@@ -0,0 +1,95 @@
+import mmap
+import os
+import sys
+import threading
+import typing
+from collections import OrderedDict
+from integrity import ContentDigest, compute_digest
+
+
+# files up to this size are mapped at once, larger ones (or any file when the address space is
+# 32 bit) through windows of MAP_WINDOW_SIZE bytes
+MAX_MAP_SIZE = 1 << 32 if sys.maxsize > 1 << 32 else 1 << 28
+MAP_WINDOW_SIZE = 1 << 26
+MAP_WINDOW_COUNT = 8
+
+# Read only memory mapping of an input file, shared by every sender of a node: chunks are
+# memoryviews into the page cache, so N clients and every retransmission reuse the same pages
+# without a read syscall or a copy. Large files are mapped by windows, window w maps
+# [w * window_size, (w + 1) * window_size + chunk_size) so a chunk starting in it never straddles
+# two windows, the MAP_WINDOW_COUNT most recent ones stay mapped.
+class MappedFile:
+  def __init__(self, path: str, chunk_size: int, max_map_size: int = MAX_MAP_SIZE, window_size: int = MAP_WINDOW_SIZE) -> None:
+    self.path = path
+    self.chunk_size = chunk_size
+    self.file = open(path, "rb")
+    self.size = os.fstat(self.file.fileno()).st_size
+    # windows are aligned on the allocation granularity, as mmap offsets must be
+    self.window_size = max(window_size - window_size % mmap.ALLOCATIONGRANULARITY, mmap.ALLOCATIONGRANULARITY)
+    self.is_windowed = self.size > max_map_size
+    self.map: typing.Optional[mmap.mmap] = None
+    self.view: typing.Optional[memoryview] = None
+    self.windows: OrderedDict[int, memoryview] = OrderedDict()
+    self.__lock = threading.Lock()
+    # digests of the content by (algorithm, block size), each computed once
+    self.digests: typing.Dict[typing.Tuple[str, typing.Optional[int]], ContentDigest] = {}
+    self.__digest_lock = threading.Lock()
+    if self.size and not self.is_windowed:
+      self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+      self.view = memoryview(self.map)
+
+  @property
+  def name(self):
+    return self.path
+
+  # Payload of chunk index, a view into the mapping. Chunks of another size (at most the chunk size
+  # of the mapping) are cut from the same mapping
+  def chunk(self, index: int, chunk_size: typing.Optional[int] = None):
+    if chunk_size is None:
+      chunk_size = self.chunk_size
+    offset = index * chunk_size
+    if offset >= self.size:
+      return b""
+    end = min(offset + chunk_size, self.size)
+    if not self.is_windowed:
+      return self.view[offset:end]
+    window = offset // self.window_size
+    start = window * self.window_size
+    return self.__window(window)[offset - start:end - start]
+
+  def __window(self, window: int):
+    with self.__lock:
+      view = self.windows.get(window)
+      if view is not None:
+        self.windows.move_to_end(window)
+        return view
+      start = window * self.window_size
+      length = min(self.window_size + self.chunk_size, self.size - start)
+      view = memoryview(mmap.mmap(self.file.fileno(), length, access=mmap.ACCESS_READ, offset=start))
+      self.windows[window] = view
+      # the mapping is unmapped once the chunks still referencing it are gone
+      if len(self.windows) > MAP_WINDOW_COUNT:
+        self.windows.popitem(last=False)
+      return view
+
+  # Digest of the content (integrity.ContentDigest), with the hashes of its blocks of block_size
+  # bytes if given. Computed once per file, whatever the number of transfers
+  def digest(self, algorithm: str, block_size: typing.Optional[int] = None):
+    with self.__digest_lock:
+      digest = self.digests.get((algorithm, block_size))
+      if digest is None:
+        digest = self.digests[(algorithm, block_size)] = compute_digest(self, algorithm, block_size)
+      return digest
+
+  # Chunks still referenced (cache, segments) keep their mapping alive until they are dropped
+  def close(self):
+    with self.__lock:
+      self.windows.clear()
+      self.view = None
+      if self.map is not None:
+        try:
+          self.map.close()
+        except BufferError:
+          pass
+        self.map = None
+    self.file.close()
@@ -1,10 +1,22 @@
-import math
-import os
 import socket
-from segment import MAX_PAYLOAD, Segment, SegmentError
+import time
+from segment import DEFAULT_PAYLOAD, FIN_ACK_BYTES, FIN_BYTES, HEADER_SIZE, MAX_PAYLOAD, MIN_PAYLOAD, OPTION_CODECS, OPTION_MSS, OPTION_PROBE, OPTION_SACK, OPTION_TIMESTAMP, OPTION_WINDOW, Segment, SegmentError, max_segment, pack_codecs, pack_mss, pack_options, pack_sack, pack_timestamp, pack_window
 import typing
+from collections import deque
+from batch_io import RECEIVE_BATCH, BatchSocket
+from buffer_pool import BUFFER_POOL_SIZE, BufferPool
+from chunk_cache import ChunkCache
+from mapped_file import MappedFile
+from pmtu import PathPayloads
+from compression import COMPRESSION, ChunkCompressor, supported_codecs
+from integrity import BLOCK_HASHES, DIGEST_ALGORITHM
+from log import log
+from socket_buffers import SocketBuffers
+from stats import SocketStats, StatsRegistry
 from abc import abstractmethod, ABC
-from connection import WINDOW_SIZE, Connection, generate_seqnum, get_seqnum_diff, increment_seqnum
+from congestion import MAX_WINDOW_SIZE
+from connection import CONGESTION_CONTROL, MAX_RETRIES, RECEIVE_BUFFER_SIZE, Connection, RttEstimator, generate_seqnum, get_seqnum_diff, increment_seqnum, timestamp
+from transfer import FileTransfer, TransferError
 
 # Message info class, describing the ip and port of segment source
 class MessageInfo:
@@ -23,51 +35,195 @@ class Node(ABC):
     self.port = port
     self.__socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     self.__socket.bind((self.ip, self.port))
+    # port 0 binds an ephemeral port
+    self.port = self.__socket.getsockname()[1]
+    # buffer sizes and kernel drops of the socket, shared by the statistics of the connections
+    self.socket_stats = SocketStats()
+    # socket buffers sized for the windows of the connections (fit_socket_buffers)
+    self.socket_buffers = SocketBuffers(self.__socket, self.socket_stats)
+    # bytes the kernel queues for this socket, datagrams beyond it are dropped
+    self.receive_buffer_size = self.socket_buffers.receive
+    # sends window bursts and reads queued datagrams in one system call where the platform can
+    self.batch_socket = BatchSocket(self.__socket, self.socket_stats)
+    # datagrams listen_base reads at once, the ones past the first wait in pending_datagrams
+    self.receive_batch = RECEIVE_BATCH
+    self.pending_datagrams: typing.Deque[typing.Tuple[bytearray, int, typing.Tuple[str, int]]] = deque()
     self.connections: typing.Dict[(str, int), Connection] = {}
+    # congestion control of the connections of this node, its window capped at max_window, and
+    # the out of order segments each connection keeps (set_windows)
+    self.congestion_control = CONGESTION_CONTROL
+    self.max_window = MAX_WINDOW_SIZE
+    self.receive_buffer_segments = RECEIVE_BUFFER_SIZE
     self.__handler = None
     self.__on_close = None
     self.__on_connect = None
+    # file chunks already read and summed, shared by every transfer of this node
+    self.chunk_cache = ChunkCache()
+    # largest payload this node takes, the connections advertise at most this much (OPTION_MSS)
+    self.payload_size = MAX_PAYLOAD
+    # payload size towards each peer, limited by the path to it (pmtu.py)
+    self.path_payloads = PathPayloads()
+    # receive buffers, segments received by listen are views into them, the pending datagrams
+    # of a batch hold some too
+    self.buffer_pool = BufferPool(max_segment(self.payload_size), BUFFER_POOL_SIZE + RECEIVE_BATCH)
+    # input files mapped once, shared by every transfer of this node
+    self.input_files: typing.Dict[str, MappedFile] = {}
+    # codec of the chunks sent to peers that decode it (compression.CODECS), None sends them raw
+    self.compression = COMPRESSION
+    # compresses chunks ahead of the send windows, shared by every transfer of this node
+    self.compressor = ChunkCompressor()
+    # digest of the files sent, with the hashes of their blocks (integrity.py)
+    self.digest_algorithm = DIGEST_ALGORITHM
+    self.block_hashes = BLOCK_HASHES
+    # statistics of the connections of this node, kept a while after they close
+    self.stats = StatsRegistry()
 
-  # Atomic send method
+  # Atomic send method, header and payload are gathered by the kernel so the payload is never copied
   def send(self, ip_remote: str, port_remote: int, segment: Segment):
-    self.__socket.sendto(segment.pack_headers() + segment.payload, (ip_remote, port_remote))
+    self.send_encoded(ip_remote, port_remote, segment.pack_headers(), segment.payload)
 
-  # Handshake wrapper method, defines the logic of the handshake (init part, sendin syn)
-  def handshake(self, ip_remote: str, port_remote: int):
+  # Sends a segment already packed into headers (pack_headers) and payload, e.g. one encoded for many peers
+  def send_encoded(self, ip_remote: str, port_remote: int, headers: bytes, payload: bytes):
+    self.count_sent(ip_remote, port_remote, len(headers) + len(payload))
+    self.batch_socket.send_one((ip_remote, port_remote), headers, payload)
+
+  # Sends datagrams (headers, payload) to a peer at once, e.g. a window of chunks
+  def send_batch(self, ip_remote: str, port_remote: int, datagrams: typing.List[typing.Tuple[bytes, bytes]]):
+    for headers, payload in datagrams:
+      self.count_sent(ip_remote, port_remote, len(headers) + len(payload))
+    self.follow_window(ip_remote, port_remote)
+    self.batch_socket.send((ip_remote, port_remote), datagrams)
+
+  # Grows the socket buffers once the window to a peer is larger than the one they were sized for
+  def follow_window(self, ip_remote: str, port_remote: int):
+    connection = self.connections.get((ip_remote, port_remote))
+    if connection is not None and connection.send.window_size > connection.send.buffered_window:
+      connection.send.buffered_window = connection.send.window_size
+      self.fit_socket_buffers()
+
+  # Sends an already packed segment (e.g. from Segment.ack_bytes)
+  def send_bytes(self, ip_remote: str, port_remote: int, data: bytes):
+    self.count_sent(ip_remote, port_remote, len(data))
+    self.batch_socket.send_one((ip_remote, port_remote), data)
+
+  # Counts a datagram sent to a peer in the statistics of its connection
+  def count_sent(self, ip_remote: str, port_remote: int, nbytes: int):
+    connection = self.connections.get((ip_remote, port_remote))
+    if connection is not None:
+      connection.stats.segments_sent += 1
+      connection.stats.bytes_sent += nbytes
+
+  # Memory mapping of an input file, mapped on first use
+  def open_input(self, file_path: str):
+    file = self.input_files.get(file_path)
+    if file is None:
+      file = self.input_files[file_path] = MappedFile(file_path, MAX_PAYLOAD)
+    return file
+
+  # Chunk index of a mapped file cut in chunk_size chunks through the chunk cache, returns
+  # (payload, payload sum). The payload is a view into the mapping, the cache keeps its sum
+  def read_chunk(self, file: MappedFile, index: int, chunk_size: int = MAX_PAYLOAD):
+    return self.chunk_cache.get(file.path, chunk_size, index, lambda: file.chunk(index, chunk_size))
+
+  # Socket descriptor, lets an event loop (selectors) wait on the node
+  def fileno(self):
+    return self.__socket.fileno()
+
+  # The bound socket, for event loops that drive it themselves (asyncio)
+  def get_socket(self):
+    return self.__socket
+
+  # First step of the handshake: registers the connection and sends the syn, it is connected
+  # once the syn ack is received. seq_num is the initial sequence number, random by default
+  def open_connection(self, ip_remote: str, port_remote: int, seq_num: typing.Optional[int] = None):
     # init connection
     new_connection = Connection(self.ip, self.port, ip_remote, port_remote)
-    new_connection.send.seq_num = generate_seqnum()
+    new_connection.send.seq_num = generate_seqnum() if seq_num is None else seq_num
+    self.set_windows(new_connection)
+    new_connection.receive.payload_size = self.path_payloads.get(ip_remote, port_remote, self.payload_size)
     # add connection to list of connection
     self.connections[(ip_remote, port_remote)] = new_connection
+    new_connection.stats.socket = self.socket_stats
+    self.stats.add(new_connection)
     # send syn
-    print(f"[Handshake] Sending SYN to {ip_remote}:{port_remote}")
-    self.send(ip_remote, port_remote, Segment.syn(new_connection.send.seq_num))
-    # wait for syn ack
-    is_ack = False
-    try_num = 1
-    while not is_ack and try_num < 2:
-      try:
-        # listen for syn ack
-        self.listen(2)
-        # if connected, then set is ack true, because ack is received in the connection
-        if new_connection.send.is_connected:
-          is_ack = True
-      except socket.timeout:
-        # if listen timed out
-        if new_connection.send.is_connected:
-          is_ack = True
-          break
-        try_num += 1
-        # try another time for sending syn
-        print("[Handshake] Timeout, resending syn")
-        self.send(ip_remote, port_remote, Segment.syn(new_connection.send.seq_num))
-    if not is_ack:
+    log.debug(f"[Handshake] Sending SYN to {ip_remote}:{port_remote}")
+    self.send(ip_remote, port_remote, Segment.syn(new_connection.send.seq_num, self.syn_options(new_connection)))
+    return new_connection
+
+  # Windows of a new connection, from the settings of the node
+  def set_windows(self, connection: Connection):
+    connection.send.set_congestion_control(self.congestion_control, self.max_window)
+    connection.receive.buffer_size = self.receive_buffer_segments
+
+  # Options of the syn and syn ack of a connection, the payload size it takes and the codecs it decodes
+  def syn_options(self, connection: Connection):
+    return {OPTION_MSS: pack_mss(connection.receive.payload_size), OPTION_CODECS: pack_codecs(supported_codecs())}
+
+  # Settles what the peer advertised in its syn or syn ack: the payload size is the smallest of
+  # both advertised sizes (DEFAULT_PAYLOAD for a peer that advertises none), chunks are compressed
+  # only with a codec the peer decodes
+  def negotiate(self, connection: Connection, segment: Segment):
+    mss = segment.mss
+    connection.send.payload_size = min(connection.receive.payload_size, DEFAULT_PAYLOAD if mss is None else max(MIN_PAYLOAD, mss))
+    connection.send.codecs = segment.codecs
+    self.fit_receive_buffers()
+    self.fit_socket_buffers()
+
+  # Receive buffers follow the largest payload advertised on the connections (the payload size of
+  # the node before any), a datagram never needs more
+  def fit_receive_buffers(self):
+    sizes = [connection.receive.payload_size for connection in self.connections.values()]
+    self.buffer_pool.resize(max_segment(max(sizes) if sizes else self.payload_size))
+
+  # Socket buffers hold the bytes in flight of every connection (window x segment size): the
+  # reorder buffer of the receiving side, the largest window sent so far on the sending side
+  def fit_socket_buffers(self):
+    connections = list(self.connections.values())
+    receive_bytes = sum(connection.receive.buffer_size * max_segment(connection.receive.payload_size) for connection in connections)
+    send_bytes = sum(connection.send.buffered_window * max_segment(connection.send.payload_size) for connection in connections)
+    self.socket_buffers.fit(receive_bytes, send_bytes)
+    self.receive_buffer_size = self.socket_buffers.receive
+
+  # Handshake wrapper method, defines the logic of the handshake (init part, sendin syn)
+  def handshake(self, ip_remote: str, port_remote: int):
+    sent_at = time.monotonic()
+    new_connection = self.open_connection(ip_remote, port_remote)
+    # wait for syn ack, the connection is connected once it is received
+    def resend():
+      log.debug("[Handshake] Timeout, resending syn")
+      self.send(ip_remote, port_remote, Segment.syn(new_connection.send.seq_num, self.syn_options(new_connection)))
+    attempts = self.wait_for(lambda: new_connection.send.is_connected, resend, new_connection.send.rtt)
+    if attempts is None:
       # fail handshake
       self.connections.pop((ip_remote, port_remote))
       raise HandshakeError()
+    # first rtt sample, only if the syn was not resent (Karn's rule)
+    if attempts == 1:
+      new_connection.send.rtt.sample(time.monotonic() - sent_at)
     
     return new_connection
 
+  # Listens until is_done, calling resend each time the retransmission timeout of rtt expires
+  # Returns the number of attempts, or None if it is still not done after retries attempts (None retries forever)
+  def wait_for(self, is_done: typing.Callable[[], bool], resend: typing.Callable[[], None], rtt: RttEstimator, retries: typing.Optional[int] = MAX_RETRIES):
+    attempts = 1
+    deadline = time.monotonic() + rtt.rto
+    while not is_done():
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        if retries is not None and attempts >= retries:
+          return None
+        attempts += 1
+        rtt.on_timeout()
+        resend()
+        deadline = time.monotonic() + rtt.rto
+        continue
+      try:
+        self.listen(remaining)
+      except socket.timeout:
+        pass
+    return attempts
+
   # Registers a handler, to handle when receiving message
   def register_handler(self, handler: typing.Callable[[MessageInfo], None]):
     self.__handler = handler
@@ -81,29 +237,162 @@ class Node(ABC):
     self.__on_connect = on_connect
 
   # Listen wrapper, calling on receive here and checking checksum
+  # The segment is received into a pooled buffer that is released when listen returns,
+  # handlers have to copy the payload if they keep it
+  # While acks are delayed, the wait is cut at their deadline to send them, then resumed
   def listen(self, timeout: typing.Optional[float] = None):
+    deadline = None if timeout is None else time.monotonic() + timeout
+    while True:
+      wait = None if deadline is None else max(0.001, deadline - time.monotonic())
+      ack_deadline = self.next_ack_deadline()
+      is_ack_wait = ack_deadline is not None and (wait is None or ack_deadline - time.monotonic() < wait)
+      if is_ack_wait:
+        wait = max(0.001, ack_deadline - time.monotonic())
+      try:
+        return self.__listen_once(wait)
+      except socket.timeout:
+        if not is_ack_wait:
+          raise
+        self.flush_delayed_acks()
+
+  def __listen_once(self, timeout: typing.Optional[float] = None):
+    buffer = self.buffer_pool.acquire()
     try:
-      addr, segment, checksum_valid = self.listen_base(timeout)
-      if checksum_valid:
-        self.__on_receive(addr, segment)
+      addr, segment, checksum_valid = self.listen_base(timeout, buffer)
+      if self.receive_segment(addr, segment, checksum_valid):
         return addr, segment
-      else:
-        # Checksum failed
-        print(f"[Segment SEQ={segment.seq_num}] Checksum failed, Ack prev sequence number")
-        self.send(addr[0], addr[1], Segment.ack(segment.seq_num))
     except SegmentError as e:
-      print(e)
+      log.warning(str(e))
+    finally:
+      self.buffer_pool.release(buffer)
+
+  # Protocol handling of a parsed datagram, returns whether it was valid
+  # Used by listen and by event loops that read the socket themselves
+  def receive_segment(self, addr: typing.Tuple[str, int], segment: Segment, checksum_valid: bool):
+    connection = self.connections.get((addr[0], addr[1]))
+    if connection is not None:
+      connection.stats.segments_received += 1
+      connection.stats.bytes_received += HEADER_SIZE + len(segment.options_bytes) + len(segment.payload)
+    if checksum_valid:
+      self.__on_receive(addr, segment)
+      return True
+    # Checksum failed, repeat the last cumulative ack
+    log.debug("[Segment SEQ=%d] Checksum failed, Ack prev sequence number", segment.seq_num)
+    if connection is not None:
+      connection.stats.checksum_failures += 1
+      if connection.receive.is_connected:
+        self.__send_ack(addr, connection)
+    return False
+
+  # The ack of the syn ack can be lost while the peer goes on: the first valid segment it sends in
+  # the window (data, metadata or fin) means it got the syn ack, and completes the handshake of
+  # the passive side the same as the ack would
+  def complete_handshake(self, addr: typing.Tuple[str, int], connection: Connection, segment: Segment):
+    if connection.send.is_connected or not connection.receive.is_connected:
+      return
+    if not segment.flags.fin and get_seqnum_diff(connection.receive.seq_num, segment.seq_num) >= connection.receive.buffer_size:
+      return
+    log.debug(f"[Handshake] ACK from {addr[0]}:{addr[1]} lost, connected by its first segment")
+    self.__connected(addr, connection, segment)
+
+  def __connected(self, addr: typing.Tuple[str, int], connection: Connection, segment: Segment):
+    connection.send.is_connected = True
+    connection.send.seq_num = increment_seqnum(connection.send.seq_num)
+    if self.__on_connect is not None:
+      self.__on_connect(MessageInfo(addr[0], addr[1], segment))
+
+  # Acks the received segments of a connection, with the out of order ones as sack blocks
+  def __send_ack(self, addr: typing.Tuple[str, int], connection: Connection):
+    connection.receive.unacked_segments = 0
+    connection.receive.ack_deadline = None
+    options = {OPTION_WINDOW: pack_window(self.receive_window(connection))}
+    blocks = connection.receive.sack_blocks()
+    if blocks:
+      options[OPTION_SACK] = pack_sack(blocks)
+    if connection.receive.ts_recent is not None:
+      options[OPTION_TIMESTAMP] = pack_timestamp(timestamp(), connection.receive.ts_recent)
+    options_bytes = pack_options(options) if options else b""
+    self.send_bytes(addr[0], addr[1], Segment.ack_bytes(connection.receive.seq_num, options_bytes))
+
+  # Segments the receiver can take on a connection, advertised in every ack: the free slots of the
+  # reorder buffer minus what the application did not consume yet, bounded by the share of the
+  # connection in the kernel socket buffer
+  def receive_window(self, connection: Connection):
+    window = connection.receive.buffer_size - len(connection.receive.reorder_buffer) - self.receive_backlog(connection)
+    # at least one segment, or a share rounded down to 0 would stall the sender on probes
+    kernel_window = max(1, self.receive_buffer_size // max_segment(connection.receive.payload_size) // max(1, len(self.connections)))
+    return max(0, min(window, kernel_window))
+
+  # Segments delivered to the handler but not consumed yet, nodes with a slow consumer override it
+  def receive_backlog(self, connection: Connection):
+    return 0
+
+  # Tells the sender the window opened again (e.g. once the consumer caught up)
+  def send_window_update(self, ip: str, port: int):
+    connection = self.connections.get((ip, port))
+    if connection is not None and connection.receive.is_connected:
+      self.__send_ack((ip, port), connection)
+
+  # Counts an in order segment, acking once enough segments are pending, otherwise
+  # the ack is sent by listen when the delay expires
+  # A window smaller than the delayed segments is acked right away, the sender cannot send more
+  def __delay_ack(self, addr: typing.Tuple[str, int], connection: Connection):
+    connection.receive.unacked_segments += 1
+    if connection.receive.unacked_segments >= min(connection.receive.delayed_ack_segments, self.receive_window(connection)):
+      self.__send_ack(addr, connection)
+    elif connection.receive.ack_deadline is None:
+      connection.receive.ack_deadline = time.monotonic() + connection.receive.delayed_ack_timeout
+
+  # Earliest deadline of the delayed acks, or None
+  def next_ack_deadline(self):
+    deadlines = [connection.receive.ack_deadline for connection in self.connections.values() if connection.receive.ack_deadline is not None]
+    return min(deadlines) if deadlines else None
+
+  # Sends the delayed acks whose deadline passed
+  def flush_delayed_acks(self):
+    now = time.monotonic()
+    for addr, connection in list(self.connections.items()):
+      if connection.receive.ack_deadline is not None and connection.receive.ack_deadline <= now:
+        self.__send_ack(addr, connection)
 
   # Atomic listen, listens to the socket and translate from bytes
-  def listen_base(self, timeout: typing.Optional[float] = None):
-    self.__socket.settimeout(timeout)
-    data, addr = self.__socket.recvfrom(32768)
-    segment, checksum_valid = Segment.from_bytes(data)
+  # Receives into buffer when given (the caller owns it), otherwise into a new buffer
+  # Up to receive_batch queued datagrams are read at once: the first one into buffer, the others
+  # into pooled buffers they are copied from by the next calls
+  def listen_base(self, timeout: typing.Optional[float] = None, buffer: typing.Optional[bytearray] = None):
+    if buffer is None:
+      buffer = bytearray(self.buffer_pool.buffer_size)
+    if self.pending_datagrams:
+      pending, nbytes, addr = self.pending_datagrams.popleft()
+      buffer[:nbytes] = memoryview(pending)[:nbytes]
+      self.buffer_pool.release(pending)
+    else:
+      buffers = [buffer] + [self.buffer_pool.acquire() for _ in range(self.receive_batch - 1 if self.batch_socket.mmsg else 0)]
+      try:
+        received = self.batch_socket.receive(buffers, timeout)
+      except BaseException:
+        for extra in buffers[1:]:
+          self.buffer_pool.release(extra)
+        raise
+      nbytes, addr = received[0]
+      for extra, (extra_nbytes, extra_addr) in zip(buffers[1:], received[1:]):
+        self.pending_datagrams.append((extra, extra_nbytes, extra_addr))
+      for extra in buffers[len(received):]:
+        self.buffer_pool.release(extra)
+    segment, checksum_valid = Segment.from_bytes(memoryview(buffer)[:nbytes])
     return (addr, segment, checksum_valid)
 
   # Handler for when receiving certain flags (included in handshake algorithm)
   def __on_receive(self, addr: tuple[str, int], segment: Segment):
+    # path mtu probe (pmtu.py), acked to the probing socket whatever the connection state when it
+    # is received whole (a probe larger than the receive buffer is truncated)
+    if OPTION_PROBE in segment.options:
+      if segment.probe_size == len(segment.payload):
+        self.send_bytes(addr[0], addr[1], Segment.ack_bytes(0, pack_options({OPTION_PROBE: segment.options[OPTION_PROBE]})))
+      return
     connection = self.connections.get((addr[0], addr[1]))
+    if connection is not None and not segment.flags.syn and not segment.flags.ack:
+      self.complete_handshake(addr, connection, segment)
     # syn not ack, server receive connection request
     if segment.flags.syn and not segment.flags.ack:
       # server acknowledgement of the syn, receive is now connected
@@ -111,55 +400,58 @@ class Node(ABC):
       new_connection.receive.seq_num = increment_seqnum(segment.seq_num)
       new_connection.receive.is_connected = True
       new_connection.send.seq_num = generate_seqnum()
+      self.set_windows(new_connection)
+      new_connection.receive.payload_size = self.path_payloads.get(addr[0], addr[1], self.payload_size, active=False)
 
       # send ack
       self.connections[(addr[0], addr[1])] = new_connection
-      self.send(addr[0], addr[1], Segment.syn_ack(new_connection.send.seq_num, new_connection.receive.seq_num))
-      print(f"[Handshake] Received SYN from {addr[0]}:{addr[1]}\n[Handshake] sending SYN ACK with SEQNUM [{new_connection.send.seq_num}] and ACK NUM [{new_connection.receive.seq_num}]")
+      new_connection.stats.socket = self.socket_stats
+      self.stats.add(new_connection)
+      self.negotiate(new_connection, segment)
+      self.send(addr[0], addr[1], Segment.syn_ack(new_connection.send.seq_num, new_connection.receive.seq_num, self.syn_options(new_connection)))
+      log.debug(f"[Handshake] Received SYN from {addr[0]}:{addr[1]}\n[Handshake] sending SYN ACK with SEQNUM [{new_connection.send.seq_num}] and ACK NUM [{new_connection.receive.seq_num}]")
       # wait for ack
-      print(f"[Handshake] Waiting for ACK with ACK NUM [{increment_seqnum(new_connection.receive.seq_num)}]")
-      is_ack = False
-      try_num = 1
-      while not is_ack and try_num < 2:
-        try:
-          self.listen(2)
-          if new_connection.send.is_connected:
-            is_ack = True
-            print(f"[Handshake] Connection established {addr[0]}:{addr[1]}")
-        except socket.timeout:
-          if new_connection.send.is_connected:
-            is_ack = True
-            print(f"[Handshake] Connection established {addr[0]}:{addr[1]}")
-            break
-          try_num += 1
-          print("[Handshake] Timeout, resending syn ack")
-          self.send(addr[0], addr[1], Segment.syn_ack(new_connection.send.seq_num, new_connection.receive.seq_num))
-      if not is_ack:
-        raise HandshakeError()
+      log.debug(f"[Handshake] Waiting for ACK with ACK NUM [{increment_seqnum(new_connection.receive.seq_num)}]")
+      def resend():
+        log.debug("[Handshake] Timeout, resending syn ack")
+        self.send(addr[0], addr[1], Segment.syn_ack(new_connection.send.seq_num, new_connection.receive.seq_num, self.syn_options(new_connection)))
+      sent_at = time.monotonic()
+      # done once acked, or once the connection is gone (e.g. closed by the peer meanwhile)
+      attempts = self.wait_for(lambda: new_connection.send.is_connected or self.connections.get((addr[0], addr[1])) is not new_connection, resend, new_connection.send.rtt)
+      if attempts is None:
+        # half open, the peer never answered: drop it rather than fail the receive loop
+        log.warning(f"[Handshake] No ACK from {addr[0]}:{addr[1]}, dropping the connection")
+        if self.connections.get((addr[0], addr[1])) is new_connection:
+          self.connections.pop((addr[0], addr[1]))
+        return
+      if attempts == 1:
+        new_connection.send.rtt.sample(time.monotonic() - sent_at)
+      log.info(f"[Handshake] Connection established {addr[0]}:{addr[1]}")
 
     # syn ack, client receive ack of syn from server
     elif segment.flags.syn and segment.flags.ack:
       connection = self.connections.get((addr[0], addr[1]))
-      self.send(addr[0], addr[1], Segment.ack(increment_seqnum(segment.seq_num)))
-      print(f"[Handshake] Received SYN ACK from {addr[0]}:{addr[1]}\n[Handshake] Sending ACK with ACK NUM [{increment_seqnum(segment.seq_num)}]")
+      self.send_bytes(addr[0], addr[1], Segment.ack_bytes(increment_seqnum(segment.seq_num)))
+      log.debug(f"[Handshake] Received SYN ACK from {addr[0]}:{addr[1]}\n[Handshake] Sending ACK with ACK NUM [{increment_seqnum(segment.seq_num)}]")
       # If connection is not registered, or send connection is connected, or not the correct ack, continue
       if connection is None or connection.send.is_connected or segment.ack_num != increment_seqnum(connection.send.seq_num):
         return
       # Send connection is connected
       connection.send.is_connected = True
       connection.send.seq_num = segment.ack_num
+      self.negotiate(connection, segment)
       
       # Send ack for the syn
       connection.receive.seq_num = increment_seqnum(segment.seq_num)
       connection.receive.is_connected = True
-      print(f"[Handshake] Connection established {addr[0]}:{addr[1]}")
+      log.info(f"[Handshake] Connection established {addr[0]}:{addr[1]}")
 
       if self.__on_connect is not None:
         self.__on_connect(MessageInfo(addr[0], addr[1], segment))
 
     # fin
     elif segment.flags.fin and not segment.flags.ack:
-      print(f"[~] Received FIN")
+      log.debug("[~] Received FIN")
       # cek
       if connection is None or not connection.receive.is_connected:
         return
@@ -168,40 +460,35 @@ class Node(ABC):
       connection.receive.is_connected = False
       
       # send fin ack
-      self.send(addr[0], addr[1], Segment.fin_ack())
-      print(f"[~] Sending FIN ACK, waiting for ACK...")
+      self.send_bytes(addr[0], addr[1], FIN_ACK_BYTES)
+      log.debug("[~] Sending FIN ACK, waiting for ACK...")
       # wait for ack
-      is_ack = False
-      try_num = 1
-      while not is_ack and try_num < 2:
-        try:
-          self.listen(2)
-          if not connection.send.is_connected:
-            is_ack = True
-            print(f"[Termination] Connection closed {addr[0]}:{addr[1]}")
-        except socket.timeout:
-          if not connection.send.is_connected:
-            is_ack = True
-            print(f"[Termination] Connection closed {addr[0]}:{addr[1]}")
-            break
-          try_num += 1
-          print("[Termination] Timeout, resending fin ack")
-          self.send(addr[0], addr[1], Segment.fin_ack())
+      def resend():
+        log.debug("[Termination] Timeout, resending fin ack")
+        self.send_bytes(addr[0], addr[1], FIN_ACK_BYTES)
+      if self.wait_for(lambda: not connection.send.is_connected, resend, connection.send.rtt) is None:
+        # the peer is gone or only the last ack was lost, close anyway
+        self.connections.pop((addr[0], addr[1]), None)
+        connection.send.is_connected = False
+        if self.__on_close is not None:
+          self.__on_close(MessageInfo(addr[0], addr[1], segment))
+      log.info(f"[Termination] Connection closed {addr[0]}:{addr[1]}")
     
     # fin ack
     elif segment.flags.fin and segment.flags.ack:
-      self.send(addr[0], addr[1], Segment.ack(0))
+      self.send_bytes(addr[0], addr[1], Segment.ack_bytes(0))
       if connection is None or not connection.send.is_connected:
         return
       connection.send.is_connected = False
       self.connections.pop((addr[0], addr[1]))
-      print(f"[Termination] Connection closed {addr[0]}:{addr[1]}")
+      log.info(f"[Termination] Connection closed {addr[0]}:{addr[1]}")
       if self.__on_close is not None:
         self.__on_close(MessageInfo(addr[0], addr[1], segment))
   
     # ack only, server receive final ack
     elif segment.flags.ack:
-      print(f"[~] Received ACK with ACK NUM [{segment.ack_num}]")
+      if log.tracing:
+        log.trace("[~] Received ACK with ACK NUM [%d]", segment.ack_num)
       if connection is None:  
         return
       # ack for the fin
@@ -216,46 +503,76 @@ class Node(ABC):
         # If ack num is not the same as seq num + 1
         if segment.ack_num != increment_seqnum(connection.send.seq_num):
           return
-        connection.send.is_connected = True
-        connection.send.seq_num = segment.ack_num
-        if self.__on_connect is not None:
-          self.__on_connect(MessageInfo(addr[0], addr[1], segment))
+        self.__connected(addr, connection, segment)
       else:
+        if segment.window is not None:
+          connection.send.receive_window = segment.window
         # If connected, set the seq num to the ack num
-        if connection.send.is_valid_ack(segment.ack_num):
-          connection.send.seq_num = segment.ack_num
+        # an ack that moves the sequence base and echoes our timestamp is an rtt sample
+        if connection.send.acknowledge(segment.ack_num) and segment.timestamp is not None and segment.timestamp[1]:
+          connection.send.rtt.sample_timestamp(segment.timestamp[1])
+        # segments the receiver holds out of order
+        for left, right in segment.sack_blocks:
+          connection.send.selective_acknowledge(left, right)
           
     # receive payload
     else:
       if connection is None or not connection.receive.is_connected:
         return
 
-      # exact sequence numbe
+      # timestamp to echo, the one of the first segment an ack is pending for
+      if segment.timestamp is not None and connection.receive.unacked_segments == 0:
+        connection.receive.ts_recent = segment.timestamp[0]
+
+      # exact sequence number
       if segment.seq_num == connection.receive.seq_num:
-        # send ack and call the message handler
+        # deliver it with the buffered segments that follow it
         connection.receive.seq_num = increment_seqnum(segment.seq_num)
-        self.send(addr[0], addr[1], Segment.ack(increment_seqnum(segment.seq_num)))
+        segments = [segment] + connection.receive.pop_contiguous()
+        connection.stats.on_delivered(sum(len(received.payload) for received in segments))
+        # delivered before the ack, so the ack reflects what the handler did (e.g. a resumed
+        # transfer moving the expected sequence number past the chunks already held)
         if self.__handler is not None:
-          self.__handler(MessageInfo(addr[0], addr[1], segment))
-        return  
+          for received in segments:
+            self.__handler(MessageInfo(addr[0], addr[1], received))
+        if len(segments) > 1:
+          # a hole was filled, tell the sender right away
+          self.__send_ack(addr, connection)
+        else:
+          self.__delay_ack(addr, connection)
+        return
+
+      # ahead of the expected segment, keep it and ack immediately so the sender learns about the hole
+      if connection.receive.buffer(segment):
+        self.__send_ack(addr, connection)
+        return
       
       # retransmit but ack failed before
-      if get_seqnum_diff(segment.seq_num, connection.receive.seq_num) < WINDOW_SIZE:
-        self.send(addr[0], addr[1], Segment.ack(increment_seqnum(segment.seq_num)))
+      if get_seqnum_diff(segment.seq_num, connection.receive.seq_num) <= connection.receive.buffer_size:
+        self.__send_ack(addr, connection)
         return
+
   def close(self):
     self.__socket.close()
+    self.release()
+
+  # Frees what the node holds besides its socket (e.g. when an event loop transport closes it)
+  def release(self):
+    self.pending_datagrams.clear()
+    self.chunk_cache.clear()
+    self.compressor.close()
+    for file in self.input_files.values():
+      file.close()
+    self.input_files.clear()
 
   def end_connection(self, ip: str, port: int):
     connection = self.connections.get((ip, port))
     if connection is None:
       return
-    self.send(ip, port, Segment.fin())
-    while self.connections.get((ip, port)) is not None:
-      try:
-        self.listen(2)
-      except socket.timeout:
-        self.send(ip, port, Segment.fin())
+    self.send_bytes(ip, port, FIN_BYTES)
+    if self.wait_for(lambda: self.connections.get((ip, port)) is None, lambda: self.send_bytes(ip, port, FIN_BYTES), connection.send.rtt) is None:
+      log.warning(f"[Termination] No FIN ACK from {ip}:{port}, closing")
+      self.connections.pop((ip, port), None)
 
   @abstractmethod
   def run():
@@ -266,59 +583,13 @@ class Node(ABC):
     pass
   
   def transfer(self, ip: str, port: int, file_path: str):
-    print("Transfer file...")
-    file_path = "input/" + file_path
-    file = open(file_path, "rb")
-    filesize = os.path.getsize(file_path)
-    max_segment = math.ceil(filesize / MAX_PAYLOAD)
-
+    log.debug("Transfer file...")
     conn = self.connections[(ip, port)]
-    sent_segment = 0
-    # Send metadata
-    metadata = {
-      'filename': file_path.split('.')[-2],
-      'extension': file_path.split('.')[-1]
-    }
-    metadata_segment = Segment.metadata(conn.send.seq_num, metadata)
-    is_ack = False
-    while not is_ack:
-      print("waiting for ack")
-      try:
-        self.send(conn.send.remote_ip, conn.send.remote_port, metadata_segment)
-        addr, segment = self.listen(2)
-        if segment is not None and segment.flags.ack and addr == (conn.send.remote_ip, conn.send.remote_port):
-          print(f"[Segment SEQ={segment.ack_num-1}] Ack metadata received")
-          is_ack = True
-      except socket.timeout:
-        print(f"[Socket timeout] ACK not received")
-
-    while sent_segment < max_segment:
-      to_send = min(conn.send.window_size, max_segment - sent_segment)
-      start_seq_num = conn.send.seq_num
-      for i in range(to_send):
-        file.seek((sent_segment + i) * MAX_PAYLOAD)
-        print(f"[Segment SEQ={increment_seqnum(start_seq_num, i)}] Sent")
-        self.send(conn.send.remote_ip, conn.send.remote_port, Segment.payload(increment_seqnum(start_seq_num, i), file.read(MAX_PAYLOAD)))
-
-      start_sent_segment = sent_segment
-      i = 0
-      while i < to_send:
-        for _ in range(to_send):
-          try:
-            addr, segment = self.listen(0.5)
-            if segment is not None and segment.flags.ack and addr == (conn.send.remote_ip, conn.send.remote_port):
-              print(f"[Segment SEQ={segment.ack_num-1}] Ack received", end="")
-              diff = get_seqnum_diff(start_seq_num, conn.send.seq_num)
-              if start_sent_segment + diff > sent_segment:
-                print(f", new sequence base = {segment.ack_num}")
-                sent_segment = start_sent_segment + diff
-              else:
-                print()
-              i += 1
-              if diff == to_send:
-                break
-          except socket.timeout:
-            i = to_send
-            break
-    print(f"[!] Finished sending to {ip}:{port}")
-    self.end_connection(conn.send.remote_ip, conn.send.remote_port)
\ No newline at end of file
+    try:
+      FileTransfer(self, conn, "input/" + file_path).run()
+    except TransferError as e:
+      log.error(f"[!] Giving up {ip}:{port}: {e}")
+      self.connections.pop((ip, port), None)
+      return
+    log.info(f"[!] Finished sending to {ip}:{port}")
+    self.end_connection(conn.send.remote_ip, conn.send.remote_port)
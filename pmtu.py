@@ -0,0 +1,116 @@
+import socket
+import sys
+import time
+import typing
+from log import log
+from segment import DEFAULT_PAYLOAD, HEADER_SIZE, MAX_PAYLOAD, MIN_PAYLOAD, Segment, SegmentError, max_segment
+
+
+# how the payload size towards a peer is found: "fixed" takes the payload size of the node as is,
+# "route" the mtu the kernel knows for the route to the peer, "probe" searches the largest
+# datagram reaching the peer unfragmented
+PMTU_MODE = "route"
+PMTU_MODES = ("fixed", "route", "probe")
+# ip and udp headers in front of every datagram
+IP_UDP_HEADER_SIZE = 28
+# room kept for the header options of data segments
+DATA_OPTIONS_ROOM = 40
+# a probe is sent PROBE_RETRIES times, waiting PROBE_TIMEOUT seconds for its ack each time
+PROBE_TIMEOUT = 0.2
+PROBE_RETRIES = 2
+# the search stops once the largest size acked and the smallest one lost are this close
+PROBE_PRECISION = 32
+
+# linux socket options, not exported by the socket module
+HAS_PMTU = sys.platform.startswith("linux")
+IP_MTU_DISCOVER = 10
+# don't fragment, without taking the cached path mtu into account
+IP_PMTUDISC_PROBE = 3
+IP_MTU = 14
+
+# Largest payload of a segment fitting a datagram of mtu bytes
+def mtu_payload(mtu: int):
+  return min(MAX_PAYLOAD, mtu - IP_UDP_HEADER_SIZE - HEADER_SIZE - DATA_OPTIONS_ROOM)
+
+# Payload fitting the mtu of the route to ip, None when the kernel does not tell
+def route_payload(ip: str):
+  if not HAS_PMTU:
+    return None
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    try:
+      # connecting a udp socket only picks the route, nothing is sent
+      sock.connect((ip, 9))
+      return max(MIN_PAYLOAD, mtu_payload(sock.getsockopt(socket.IPPROTO_IP, IP_MTU)))
+    except OSError:
+      return None
+
+# Packetization layer path mtu discovery (RFC 8899 like): probes padded to a payload size are sent
+# with the don't fragment bit from a socket of their own, the peer acks each probe it receives
+# whole (Node answers OPTION_PROBE). Binary search of the largest acked size between low and high,
+# None when not even low gets through (the peer does not answer probes, or the platform cannot
+# set the don't fragment bit)
+def probe_payload(ip: str, port: int, low: int = DEFAULT_PAYLOAD, high: int = MAX_PAYLOAD, timeout: float = PROBE_TIMEOUT):
+  if not HAS_PMTU:
+    return None
+  low = min(low, high)
+  with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+    sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+    if probe(sock, ip, port, high, timeout):
+      return high
+    if not probe(sock, ip, port, low, timeout):
+      return None
+    while high - low > PROBE_PRECISION:
+      size = (low + high) // 2
+      if probe(sock, ip, port, size, timeout):
+        low = size
+      else:
+        high = size
+    log.info(f"[PMTU] {ip}:{port} takes {low} byte payloads")
+    return low
+
+# Whether a probe of payload_size bytes is acked
+def probe(sock: socket.socket, ip: str, port: int, payload_size: int, timeout: float):
+  segment = Segment.probe(payload_size)
+  data = segment.pack_headers() + segment.payload
+  buffer = bytearray(max_segment(0))
+  for _ in range(PROBE_RETRIES):
+    try:
+      sock.sendto(data, (ip, port))
+    except OSError:
+      # larger than the mtu of the interface (EMSGSIZE)
+      return False
+    deadline = time.monotonic() + timeout
+    while deadline > time.monotonic():
+      sock.settimeout(deadline - time.monotonic())
+      try:
+        nbytes, addr = sock.recvfrom_into(buffer)
+        reply, checksum_valid = Segment.from_bytes(memoryview(buffer)[:nbytes])
+      except socket.timeout:
+        break
+      except (OSError, SegmentError):
+        continue
+      # a late ack of a smaller probe says nothing about this one
+      if checksum_valid and addr == (ip, port) and reply.probe_size == payload_size:
+        return True
+  return False
+
+# Payload sizes towards peers, found according to a mode of PMTU_MODES and kept per peer ip
+class PathPayloads:
+  def __init__(self, mode: str = PMTU_MODE) -> None:
+    self.mode = mode
+    self.payloads: typing.Dict[str, int] = {}
+
+  # Largest payload towards ip:port, at most limit. Only an active open probes, the peer of a
+  # passive open is not listening for probes yet. DEFAULT_PAYLOAD when nothing is known
+  def get(self, ip: str, port: int, limit: int, active: bool = True):
+    if self.mode == "fixed":
+      return limit
+    payload = self.payloads.get(ip)
+    if payload is None:
+      route = route_payload(ip)
+      if self.mode == "probe" and active:
+        payload = probe_payload(ip, port, high=min(limit, route or MAX_PAYLOAD))
+        payload = self.payloads[ip] = payload or route or DEFAULT_PAYLOAD
+      else:
+        payload = route or DEFAULT_PAYLOAD
+    return min(limit, payload)
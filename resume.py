@@ -0,0 +1,110 @@
+import json
+import math
+import os
+import threading
+import typing
+
+
+# progress file next to the output file
+RESUME_SUFFIX = ".resume"
+# chunks written between two saves of the progress
+RESUME_SAVE_INTERVAL = 256
+
+# Chunks of a file already written by the receiver, as a bitmap persisted next to the partial
+# output file: a json line with the file identity (size, content hash, chunk size), then one bit
+# per chunk. A transfer of the same file resumes from it, a different file starts over.
+class ResumeState:
+  def __init__(self, path: str, identity: dict) -> None:
+    self.path = path
+    self.identity = identity
+    self.chunk_count = math.ceil(identity['filesize'] / identity['chunk_size']) if identity['chunk_size'] else 0
+    self.bitmap = bytearray((self.chunk_count + 7) // 8)
+    self.unsaved = 0
+    # chunks are marked by the writer thread of the sink
+    self.__lock = threading.Lock()
+
+  # Progress saved for output_file, or None when there is none or it belongs to another file
+  @staticmethod
+  def load(output_file: str, identity: dict):
+    path = output_file + RESUME_SUFFIX
+    if not os.path.exists(output_file):
+      return None
+    try:
+      with open(path, "rb") as f:
+        saved = json.loads(f.readline())
+        bitmap = f.read()
+    except (OSError, ValueError):
+      return None
+    state = ResumeState(path, identity)
+    if saved != identity or len(bitmap) != len(state.bitmap):
+      return None
+    state.bitmap[:] = bitmap
+    return state
+
+  def is_held(self, index: int):
+    return bool(self.bitmap[index >> 3] & (1 << (index & 7)))
+
+  # Chunks held from first on (at most count), the sender skips them
+  def held_from(self, first: int, count: int):
+    held = 0
+    while held < count and self.is_held(first + held):
+      held += 1
+    return held
+
+  @property
+  def held(self):
+    return sum(bin(byte).count("1") for byte in self.bitmap)
+
+  @property
+  def is_complete(self):
+    return self.held == self.chunk_count
+
+  # Marks the chunks written at offset, saving every RESUME_SAVE_INTERVAL chunks
+  def mark(self, offset: int, length: int):
+    chunk_size = self.identity['chunk_size']
+    with self.__lock:
+      for index in range(offset // chunk_size, (offset + length + chunk_size - 1) // chunk_size):
+        self.bitmap[index >> 3] |= 1 << (index & 7)
+      self.unsaved += 1
+      if self.unsaved >= RESUME_SAVE_INTERVAL:
+        self.__save()
+
+  # Forgets the chunks overlapping [offset, offset + length), e.g. a block found corrupted
+  def unmark(self, offset: int, length: int):
+    chunk_size = self.identity['chunk_size']
+    with self.__lock:
+      for index in range(offset // chunk_size, (offset + length + chunk_size - 1) // chunk_size):
+        self.bitmap[index >> 3] &= ~(1 << (index & 7))
+      self.__save()
+
+  # (offset, length) of the runs of held chunks, in order
+  def held_ranges(self):
+    chunk_size = self.identity['chunk_size']
+    ranges: typing.List[typing.List[int]] = []
+    for index in range(self.chunk_count):
+      if not self.is_held(index):
+        continue
+      if ranges and ranges[-1][0] + ranges[-1][1] == index * chunk_size:
+        ranges[-1][1] += chunk_size
+      else:
+        ranges.append([index * chunk_size, chunk_size])
+    filesize = self.identity['filesize']
+    return [(offset, min(length, filesize - offset)) for offset, length in ranges]
+
+  def save(self):
+    with self.__lock:
+      self.__save()
+
+  # Written to a temporary file then renamed, a crash never leaves a torn bitmap
+  def __save(self):
+    self.unsaved = 0
+    tmp_path = self.path + ".tmp"
+    with open(tmp_path, "wb") as f:
+      f.write(json.dumps(self.identity).encode() + b"\n")
+      f.write(self.bitmap)
+    os.replace(tmp_path, self.path)
+
+  def remove(self):
+    with self.__lock:
+      if os.path.exists(self.path):
+        os.remove(self.path)
@@ -81,7 +81,7 @@ class rps(Server):
   def handle_message(self, message: MessageInfo):
     super().handle_message(message)
     if not self.is_first:
-      self.players[self.count] = rps_dict[int(message.segment.payload)]
+      self.players[self.count] = rps_dict[int(bytes(message.segment.payload))]
       self.count += 1
     else:
       self.is_first = False
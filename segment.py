@@ -1,79 +1,227 @@
 import json
-from struct import pack, unpack
+from struct import Struct
+import typing
 from typing import Optional
+from checksum import fold, payload_sum
 
 
+HEADER_SIZE = 12
+MAX_OPTIONS_SIZE = 252
 MAX_PAYLOAD = 32756
+# payload of a peer that does not advertise its own (OPTION_MSS) or of a path that cannot be
+# measured, fits a 1500 byte ethernet frame with the ip, udp and segment headers
+DEFAULT_PAYLOAD = 1400
+# smallest payload a peer may advertise
+MIN_PAYLOAD = 512
+
+# Largest datagram carrying payload_size bytes of payload, header and options included
+def max_segment(payload_size: int):
+  return HEADER_SIZE + MAX_OPTIONS_SIZE + payload_size
+
+MAX_SEGMENT = max_segment(MAX_PAYLOAD)
 
 class SegmentError(Exception):
   def __init__(self, message: str) -> None:
     super().__init__(message)
 
+# flags are kept as the header byte itself
+FLAG_FIN = 0x01
+FLAG_SYN = 0x02
+FLAG_ACK = 0x10
+
+HEADER = Struct("!IIBBH")
+
+# Header options sit between the header and the payload, the reserved header byte holds their
+# length. Each option is kind (1 byte), length of the whole option (1 byte) and value, the options
+# are padded with EOL to a multiple of 4 bytes so the payload words stay aligned for the checksum.
+OPTION_EOL = 0
+OPTION_NOP = 1
+# largest payload the sender of a syn or syn ack takes (maximum segment size), in bytes
+OPTION_MSS = 2
+MSS = Struct("!H")
+# receive window advertised by the receiver in acks, in segments
+OPTION_WINDOW = 3
+WINDOW = Struct("!H")
+# selective acknowledgement, (left, right) sequence number pairs of segments received out of order
+OPTION_SACK = 5
+# timestamp of the sender and the echoed timestamp of the peer (in acks), both in milliseconds
+OPTION_TIMESTAMP = 8
+TIMESTAMP = Struct("!II")
+SACK_BLOCK = Struct("!II")
+MAX_SACK_BLOCKS = 4
+# number of parallel connections a client asks for in its broadcast request (striped transfer)
+OPTION_STREAMS = 30
+STREAMS = Struct("!B")
+# path mtu probe (pmtu.py), the padded payload size, echoed in the ack of the probe
+OPTION_PROBE = 31
+PROBE = Struct("!H")
+# data segment whose payload is compressed with the codec of the transfer (no value)
+OPTION_COMPRESSED = 32
+# codecs the sender of a syn or syn ack decodes, a bitmask (compression.CODEC_BITS)
+OPTION_CODECS = 33
+CODECS = Struct("!B")
+# byte range (offset, length) a request asks for instead of the whole file, e.g. a corrupted block
+OPTION_RANGE = 34
+RANGE = Struct("!QI")
+
+def pack_options(options: typing.Dict[int, bytes]):
+  data = b"".join(bytes((kind, len(value) + 2)) + value for kind, value in options.items())
+  if len(data) > MAX_OPTIONS_SIZE:
+    raise SegmentError(f"options must be at most {MAX_OPTIONS_SIZE} bytes")
+  return data + bytes(-len(data) % 4)
+
+def unpack_options(data: bytes):
+  options: typing.Dict[int, bytes] = {}
+  i = 0
+  while i < len(data):
+    kind = data[i]
+    if kind == OPTION_EOL:
+      break
+    if kind == OPTION_NOP:
+      i += 1
+      continue
+    if i + 1 >= len(data) or data[i + 1] < 2 or i + data[i + 1] > len(data):
+      raise SegmentError("malformed header option")
+    options[kind] = bytes(data[i + 2:i + data[i + 1]])
+    i += data[i + 1]
+  return options
+
+def pack_timestamp(value: int, echo: int = 0):
+  return TIMESTAMP.pack(value, echo)
+
+def pack_window(window: int):
+  return WINDOW.pack(min(window, 0xFFFF))
+
+def pack_streams(streams: int):
+  return STREAMS.pack(min(streams, 0xFF))
+
+def pack_mss(payload_size: int):
+  return MSS.pack(min(payload_size, MAX_PAYLOAD))
+
+def pack_codecs(codecs: int):
+  return CODECS.pack(codecs & 0xFF)
+
+def pack_range(offset: int, length: int):
+  return RANGE.pack(offset, length)
+
+# Blocks are [left, right) ranges of sequence numbers
+def pack_sack(blocks: typing.List[typing.Tuple[int, int]]):
+  return b"".join(SACK_BLOCK.pack(left, right) for left, right in blocks[:MAX_SACK_BLOCKS])
+
+def unpack_sack(value: bytes):
+  return [SACK_BLOCK.unpack_from(value, i) for i in range(0, len(value) - len(value) % SACK_BLOCK.size, SACK_BLOCK.size)]
+
 class SegmentFlags:
+  __slots__ = ("value",)
+
   def __init__(self, syn: bool, ack: bool, fin: bool) -> None:
-    self.syn = syn
-    self.ack = ack
-    self.fin = fin
+    self.value = (syn << 1) | (ack << 4) | fin
+
+  @property
+  def syn(self):
+    return bool(self.value & FLAG_SYN)
+
+  @property
+  def ack(self):
+    return bool(self.value & FLAG_ACK)
+
+  @property
+  def fin(self):
+    return bool(self.value & FLAG_FIN)
 
   def get_flag_bytes(self):
-    return ((self.syn << 1) | (self.ack << 4) | self.fin)
+    return self.value
   
+  # Flags are immutable, so every parsed segment shares one instance per flag combination
   @staticmethod
   def from_byte(data: int):
-    return SegmentFlags(bool(data >> 1 & 1), bool(data >> 4 & 1), bool(data & 1))
+    return FLAGS_BY_BYTE[data]
   
   def __str__(self) -> str:
     return f"SYN: {self.syn}, ACK: {self.ack}, FIN: {self.fin}"
 
+FLAGS = {(syn, ack, fin): SegmentFlags(syn, ack, fin) for syn in (False, True) for ack in (False, True) for fin in (False, True)}
+FLAGS_BY_BYTE = [FLAGS[(bool(data >> 1 & 1), bool(data >> 4 & 1), bool(data & 1))] for data in range(256)]
+
 class Segment:
-  def __init__(self, flags: SegmentFlags, seq_num: int, ack_num: int, payload: bytes, checksum: Optional[int] = None) -> None:
+  __slots__ = ("flags", "seq_num", "ack_num", "options", "options_bytes", "payload", "payload_checksum", "checksum")
+
+  def __init__(self, flags: SegmentFlags, seq_num: int, ack_num: int, payload: bytes, checksum: Optional[int] = None, payload_checksum: Optional[int] = None, options: Optional[typing.Dict[int, bytes]] = None) -> None:
     self.flags = flags
     self.seq_num = seq_num
     self.ack_num = ack_num
+    self.options = options if options is not None else {}
+    self.options_bytes = pack_options(self.options) if self.options else b""
     self.payload = payload
+    # precomputed one's complement sum of the payload (e.g. from the chunk cache)
+    self.payload_checksum = payload_checksum
     if not isinstance(checksum, int):
       self.checksum = self.__calculate_checksum()
     else:
       self.checksum = checksum
 
   @staticmethod
-  def syn(seq_num: int):
-    return Segment(SegmentFlags(True, False, False), seq_num, 0, b"", b"")
+  def syn(seq_num: int, options: Optional[typing.Dict[int, bytes]] = None):
+    return Segment(FLAGS[(True, False, False)], seq_num, 0, b"", b"", options=options)
   
   @staticmethod
   def ack(ack_num: int):
-    return Segment(SegmentFlags(False, True, False), 0, ack_num, b"", b"")
+    return Segment(FLAGS[(False, True, False)], 0, ack_num, b"", b"")
   
+  # Fast path for the ACK sent for every received segment, packs the header without building a segment
+  # options_bytes are already packed options (pack_options)
+  @staticmethod
+  def ack_bytes(ack_num: int, options_bytes: bytes = b""):
+    checksum = (ack_num >> 16) + (ack_num & 0xFFFF) + (FLAG_ACK << 8) + len(options_bytes)
+    if options_bytes:
+      checksum += payload_sum(options_bytes)
+    checksum = fold(checksum)
+    return HEADER.pack(0, ack_num, FLAG_ACK, len(options_bytes), (~checksum) & 0xFFFF) + options_bytes
+
   @staticmethod
-  def syn_ack(seq_num: int, ack_num: int):
-    return Segment(SegmentFlags(True, True, False), seq_num, ack_num, b"", b"")
+  def syn_ack(seq_num: int, ack_num: int, options: Optional[typing.Dict[int, bytes]] = None):
+    return Segment(FLAGS[(True, True, False)], seq_num, ack_num, b"", b"", options=options)
 
   @staticmethod
   def fin():
-    return Segment(SegmentFlags(False, False, True), 0, 0, b"", b"")
+    return Segment(FLAGS[(False, False, True)], 0, 0, b"", b"")
   
   @staticmethod
   def fin_ack():
-    return Segment(SegmentFlags(False, True, True), 0, 0, b"", b"")
+    return Segment(FLAGS[(False, True, True)], 0, 0, b"", b"")
   
+  # Data segment (named data because payload is the instance slot)
   @staticmethod
-  def payload(seq_num: int, payload: bytes):
-    return Segment(SegmentFlags(False, False, False), seq_num, 0, payload)
+  def data(seq_num: int, payload: bytes, payload_checksum: Optional[int] = None, options: Optional[typing.Dict[int, bytes]] = None):
+    return Segment(FLAGS[(False, False, False)], seq_num, 0, payload, payload_checksum=payload_checksum, options=options)
   
+  # Path mtu probe padded to payload_size bytes of payload, never delivered to a handler
+  @staticmethod
+  def probe(payload_size: int):
+    return Segment(FLAGS[(False, False, False)], 0, 0, bytes(payload_size), options={OPTION_PROBE: PROBE.pack(payload_size)})
+
   @staticmethod
   def metadata(seq_num: int, metadata: dict):
     payload = json.dumps(metadata)
     payload = payload.encode()
-    seg = Segment(SegmentFlags(False, False, False), seq_num, 0, payload)
+    seg = Segment(FLAGS[(False, False, False)], seq_num, 0, payload)
     return seg
 
+  # Parses a datagram, the payload is a memoryview into data (no copy), so it is only valid
+  # as long as data is not reused
   @staticmethod
   def from_bytes(data: bytes):
-    if (len(data) < 12):
+    if (len(data) < HEADER_SIZE):
       raise SegmentError("data must be at least 12 bytes")
-    seq_num, ack_num, flags, _, checksum = unpack("!IIBBH", data[:12])
-    payload = data[12:] if len(data) > 12 else b""
+    seq_num, ack_num, flags, options_size, checksum = HEADER.unpack_from(data)
+    payload_start = HEADER_SIZE + options_size
+    if len(data) < payload_start:
+      raise SegmentError("options are longer than the segment")
+    payload = memoryview(data)[payload_start:] if len(data) > payload_start else b""
     segment = Segment(SegmentFlags.from_byte(flags), seq_num, ack_num, payload, checksum)
+    if options_size:
+      segment.options_bytes = bytes(data[HEADER_SIZE:payload_start])
+      segment.options = unpack_options(segment.options_bytes)
     return segment, segment.is_valid_checksum()
   
 
@@ -85,31 +233,90 @@ class Segment:
     checksum = ((self.seq_num >> 16) + (self.seq_num & 0xFFFF))
     # ack num
     checksum += ((self.ack_num >> 16) + (self.ack_num & 0xFFFF))
-    # flags and empty
-    checksum += (self.flags.get_flag_bytes() << 8) & 0xFF00
+    # flags and options length
+    checksum += ((self.flags.get_flag_bytes() << 8) & 0xFF00) + len(self.options_bytes)
+
+    # options
+    if self.options_bytes:
+      checksum += payload_sum(self.options_bytes)
 
     # payload
-    for i in range(0, len(self.payload), 2):
-      checksum += (self.payload[i] << 8)
-      if i + 1 < len(self.payload):
-        checksum += self.payload[i + 1]
+    if self.payload_checksum is None:
+      self.payload_checksum = payload_sum(self.payload)
+    checksum += self.payload_checksum
 
     # add carry
-    while checksum >> 16:
-      checksum = (checksum >> 16) + (checksum & 0xFFFF)
+    checksum = fold(checksum)
     if is_recv:
       return checksum
     else:
       return (~checksum) & 0xFFFF
     
   def update_checksum(self):
+    self.options_bytes = pack_options(self.options) if self.options else b""
     self.checksum = self.__calculate_checksum()
 
   def is_valid_checksum(self):
     return self.__calculate_checksum(True) + self.checksum == 0xFFFF
     
+  # Header followed by the options
   def pack_headers(self):
-    return pack("!IIBBH", self.seq_num, self.ack_num, self.flags.get_flag_bytes(), 0x00, self.checksum)
+    return HEADER.pack(self.seq_num, self.ack_num, self.flags.get_flag_bytes(), len(self.options_bytes), self.checksum) + self.options_bytes
+
+  # Advertised receive window or None
+  @property
+  def window(self):
+    value = self.options.get(OPTION_WINDOW)
+    return WINDOW.unpack(value)[0] if value is not None and len(value) == WINDOW.size else None
+
+  # Largest payload advertised by the peer, or None
+  @property
+  def mss(self):
+    value = self.options.get(OPTION_MSS)
+    return MSS.unpack(value)[0] if value is not None and len(value) == MSS.size else None
+
+  # Codecs the peer decodes, 0 when it advertises none
+  @property
+  def codecs(self):
+    value = self.options.get(OPTION_CODECS)
+    return CODECS.unpack(value)[0] if value is not None and len(value) == CODECS.size else 0
+
+  @property
+  def compressed(self):
+    return OPTION_COMPRESSED in self.options
+
+  # Payload size of a path mtu probe (or of the probe an ack answers), or None
+  @property
+  def probe_size(self):
+    value = self.options.get(OPTION_PROBE)
+    return PROBE.unpack(value)[0] if value is not None and len(value) == PROBE.size else None
+
+  # (offset, length) requested, or None
+  @property
+  def range(self):
+    value = self.options.get(OPTION_RANGE)
+    return RANGE.unpack(value) if value is not None and len(value) == RANGE.size else None
+
+  # Parallel connections requested, or None
+  @property
+  def streams(self):
+    value = self.options.get(OPTION_STREAMS)
+    return STREAMS.unpack(value)[0] if value is not None and len(value) == STREAMS.size else None
+
+  # (timestamp, echoed timestamp) or None
+  @property
+  def timestamp(self):
+    value = self.options.get(OPTION_TIMESTAMP)
+    return TIMESTAMP.unpack(value) if value is not None and len(value) == TIMESTAMP.size else None
+
+  @property
+  def sack_blocks(self):
+    value = self.options.get(OPTION_SACK)
+    return unpack_sack(value) if value is not None else []
   
   def __str__(self) -> str:
-    return f"seq_num: {self.seq_num}\nack_num: {self.ack_num}\nflags: {self.flags}\nchecksum: {self.checksum:b}\npayload: {self.payload}"
\ No newline at end of file
+    return f"seq_num: {self.seq_num}\nack_num: {self.ack_num}\nflags: {self.flags}\nchecksum: {self.checksum:b}\noptions: {self.options}\npayload: {bytes(self.payload)}"
+
+# Control segments that never change, packed once
+FIN_BYTES = Segment.fin().pack_headers()
+FIN_ACK_BYTES = Segment.fin_ack().pack_headers()
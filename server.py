@@ -1,231 +1,190 @@
 import argparse
-import math
-import os
 import socket
 import typing
-from connection import get_seqnum_diff, increment_seqnum
+from compression import CODECS, COMPRESSION
+from congestion import CONGESTION_CONTROLS
+from connection import CONGESTION_CONTROL
 from node import MessageInfo, Node
-from segment import MAX_PAYLOAD, Segment, SegmentError
-import threading
+from segment import Segment
+from pmtu import PMTU_MODE, PMTU_MODES
+from segment import MAX_PAYLOAD, MIN_PAYLOAD, SegmentError
+from event_loop import EventLoop, SendFileTask
+from fanout import FanOutGroup
+from integrity import DIGEST_ALGORITHM, DIGEST_ALGORITHMS
+from log import log
+from stats import SNAPSHOT_INTERVAL, start_exporters
+from striping import MAX_STREAMS, StripedTransfer
+from transfer import FileTransfer, TransferError
 
 ENABLE_PARALLEL = True
-
-# For parallelization
-class PausableBroadcastThread(threading.Thread):
-  def __init__(self, server, addr: tuple[str, int]):
-    super().__init__()
-    self.server = server
-    self.addr = addr
-    self.is_paused = False
-    self.is_stopped = False
-    self.pause_cond = threading.Condition(threading.Lock())
-
-  # thread run method
-  def run(self):
-    with self.pause_cond:
-      while self.is_paused:
-        self.pause_cond.wait()
-      file = open(server.file_path, "rb")
-      max_segment = math.ceil(server.filesize / MAX_PAYLOAD)
-      addr = self.addr
-      conn = server.handshake(addr[0], addr[1])
-      sent_segment = 0
-      # Send metadata
-      metadata = {
-        'filename': server.file_path.split('.')[-2],
-        'extension': server.file_path.split('.')[-1]
-      }
-      metadata_segment = Segment.metadata(conn.send.seq_num, metadata)
-      is_ack = False
-      while not is_ack:
-        print("waiting for ack")
-        try:
-          server.send(conn.send.remote_ip, conn.send.remote_port, metadata_segment)
-          addr, segment = server.listen(2)
-          if segment is not None and segment.flags.ack and addr == (conn.send.remote_ip, conn.send.remote_port):
-            print(f"[Segment SEQ={segment.ack_num-1}] Ack metadata received")
-            is_ack = True
-        except socket.timeout:
-          print(f"[Socket timeout] ACK not received")
-    while sent_segment < max_segment:
-      with self.pause_cond:
-        while self.is_paused:
-          self.pause_cond.wait()
-        to_send = min(conn.send.window_size, max_segment - sent_segment)
-        start_seq_num = conn.send.seq_num
-        for i in range(to_send):
-          file.seek((increment_seqnum(sent_segment, i)) * MAX_PAYLOAD)
-          print(f"[Segment SEQ={increment_seqnum(start_seq_num, i)}] Sent")
-          server.send(conn.send.remote_ip, conn.send.remote_port, Segment.payload(increment_seqnum(start_seq_num, i), file.read(MAX_PAYLOAD)))
-
-        start_sent_segment = sent_segment
-        i = 0
-      while i < to_send:
-        with self.pause_cond:
-          while self.is_paused:
-            self.pause_cond.wait()
-          for _ in range(to_send):
-            try:
-              addr, segment = server.listen(0.5)
-              if segment is not None and segment.flags.ack and addr == (conn.send.remote_ip, conn.send.remote_port):
-                print(f"[Segment SEQ={segment.ack_num-1}] Ack received", end="")
-                diff = get_seqnum_diff(start_seq_num, conn.send.seq_num)
-                if start_sent_segment + diff > sent_segment:
-                  print(f", new sequence base = {segment.ack_num}")
-                  sent_segment = start_sent_segment + diff
-                else:
-                  print()
-                i += 1
-                if diff == to_send:
-                  break
-            except socket.timeout:
-              i = to_send
-              break
-    print(f"[!] Finished sending to {addr[0]}:{addr[1]}")
-    server.end_connection(conn.send.remote_ip, conn.send.remote_port)
-
-  def pause(self):
-    if not self.is_paused:
-      self.is_paused = True
-      self.pause_cond.acquire()
-  
-  def resume(self):
-    self.is_paused = False
-    self.pause_cond.notify()
-    self.pause_cond.release()
-
+# seconds the server keeps serving range requests (corrupted blocks) once every transfer is done
+REPAIR_WAIT = 1.0
 
 class Server(Node):
   def __init__(self, ip: str, port: int, file_path: typing.Optional[str]=None) -> None:
-    file_path = "input/" + file_path
     super().__init__(ip, port)
     self.register_handler(self.handle_message)
-    self.listen_addresses: dict[tuple[str, int], typing.Optional[PausableBroadcastThread]] = {}
-    self.file_path = file_path
-    if file_path is not None:
-      self.filesize = os.path.getsize(file_path)
+    self.listen_addresses: list[tuple[str, int]] = []
+    # parallel connections of each client (striped transfer), at most max_streams
+    self.stream_counts: dict[tuple[str, int], int] = {}
+    self.max_streams = MAX_STREAMS
+    # byte range asked by a client instead of the whole file (OPTION_RANGE)
+    self.request_ranges: dict[tuple[str, int], typing.Optional[tuple[int, int]]] = {}
+    self.repair_wait = REPAIR_WAIT
+    self.file_path = None if file_path is None else "input/" + file_path
+    if self.file_path is not None:
+      # mapped once, every transfer slices its chunks out of the same pages
+      self.input_file = self.open_input(self.file_path)
+      self.filesize = self.input_file.size
   
   def run(self):
     listening = True
     print("[!] Listening for broadcast request for clients.\n")
     while listening:
-        addr = None
         try:
-          if ENABLE_PARALLEL:
-            for addr, thread in self.listen_addresses.items():
-              if thread is not None:
-                thread.resume()
-          addr = self.listen_broadcast()
-          if addr is not None and ENABLE_PARALLEL:
-            self.listen_addresses[addr] = PausableBroadcastThread(self, addr)
-            self.listen_addresses[addr].pause()
-            self.listen_addresses[addr].start()
+          self.listen_broadcast()
         except socket.error:
           print("Timeout")
-        for addr, thread in self.listen_addresses.items():
-          if thread is not None:
-            thread.pause()
         is_listen_more = input("[?] Listen more? (y/N) ")
         if is_listen_more != "y":
             break
 
   # Listening for broadcast request from client
-  def listen_broadcast(self, timeout: typing.Optional[bool]=True):
+  # A client asking for a range is served again even if it was already
+  def listen_broadcast(self, timeout: typing.Optional[bool]=True, wait: float=5):
+    buffer = self.buffer_pool.acquire()
     try:
-      addr, segment, valid_checksum = self.listen_base(5 if timeout else None)
-      if valid_checksum and segment.flags.syn and not segment.flags.ack and addr not in self.listen_addresses:
-        self.listen_addresses[addr] = None
-        print(f"[!] Received request from {addr[0]}:{addr[1]}")
+      addr, segment, valid_checksum = self.listen_base(wait if timeout else None, buffer)
+      if valid_checksum and segment.flags.syn and not segment.flags.ack and (addr not in self.listen_addresses or segment.range is not None):
+        if addr not in self.listen_addresses:
+          self.listen_addresses.append(addr)
+        self.stream_counts[addr] = max(1, min(segment.streams or 1, self.max_streams))
+        self.request_ranges[addr] = segment.range
+        log.info(f"[!] Received request from {addr[0]}:{addr[1]}")
         return addr
-      else:
-        return self.listen_broadcast()
     except SegmentError as e:
-      print(e)
+      log.warning(str(e))
+      return
+    finally:
+      self.buffer_pool.release(buffer)
+    return self.listen_broadcast(timeout, wait)
 
   def broadcast(self):
-    file = open(self.file_path, "rb")
-    max_segment = math.ceil(self.filesize / MAX_PAYLOAD)
     print(f"\nClient list:")
     for i, addr in enumerate(self.listen_addresses):
       print(f"{i+1}. {addr[0]}:{addr[1]}")
     print()
 
     for addr in self.listen_addresses:
-      conn = self.handshake(addr[0], addr[1])
-      sent_segment = 0
-      # Send metadata
-      metadata = {
-        'filename': server.file_path.split('.')[-2],
-        'extension': server.file_path.split('.')[-1]
-      }
-      metadata_segment = Segment.metadata(conn.send.seq_num, metadata)
-      is_ack = False
-      while not is_ack:
-        print("waiting for ack")
-        try:
-          server.send(conn.send.remote_ip, conn.send.remote_port, metadata_segment)
-          addr, segment = server.listen(2)
-          if segment is not None and segment.flags.ack and addr == (conn.send.remote_ip, conn.send.remote_port):
-            print(f"[Segment SEQ={segment.ack_num-1}] Ack metadata received")
-            is_ack = True
-        except socket.timeout:
-          print(f"[Socket timeout] ACK not received")
-
-      while sent_segment < max_segment:
-        to_send = min(conn.send.window_size, max_segment - sent_segment)
-        start_seq_num = conn.send.seq_num
-
-        for i in range(to_send):
-          file.seek((sent_segment + i) * MAX_PAYLOAD)
-          print(f"[Segment SEQ={increment_seqnum(start_seq_num, i)}] Sent")
-          self.send(conn.send.remote_ip, conn.send.remote_port, Segment.payload(increment_seqnum(start_seq_num, i), file.read(MAX_PAYLOAD)))
-
-        start_sent_segment = sent_segment
-        i = 0
-        while i < to_send:
-          for _ in range(to_send):
-            try:
-              addr, segment = self.listen(0.5)
-              if segment is not None and segment.flags.ack and addr == (conn.send.remote_ip, conn.send.remote_port):
-                print(f"[Segment SEQ={segment.ack_num-1}] Ack received", end="")
-                diff = get_seqnum_diff(start_seq_num, conn.send.seq_num)
-                if start_sent_segment + diff > sent_segment:
-                  print(f", new sequence base = {segment.ack_num}")
-                  sent_segment = start_sent_segment + diff
-                else:
-                  print()
-                i += 1
-                if diff == to_send:
-                  break
-            except socket.timeout:
-              i = to_send
-              break
-      print(f"[!] Finished sending to {addr[0]}:{addr[1]}")
-      self.end_connection(conn.send.remote_ip, conn.send.remote_port)
+      self.send_file(addr)
+    # corrupted blocks the clients ask for again
+    while self.repair_wait > 0:
+      try:
+        addr = self.listen_broadcast(wait=self.repair_wait)
+      except socket.timeout:
+        break
+      if addr is not None and self.request_ranges.get(addr) is not None:
+        self.send_file(addr)
+    log.info(f"[!] Chunk cache {self.chunk_cache}")
+    if self.compression is not None:
+      log.info(f"[!] Compression ({self.compression}) {self.compressor}")
+
+  def send_file(self, addr: tuple[str, int]):
+    byte_range = self.request_ranges.get(addr)
+    if self.stream_counts.get(addr, 1) > 1 and byte_range is None:
+      StripedTransfer(self, addr[0], addr[1], self.file_path, self.stream_counts[addr]).run()
+      return
+    conn = self.handshake(addr[0], addr[1])
+    transfer = FileTransfer(self, conn, self.file_path, byte_range=byte_range)
+    try:
+      transfer.run()
+    except TransferError as e:
+      log.error(f"[!] Giving up {addr[0]}:{addr[1]}: {e}")
+      self.connections.pop(addr, None)
+      return
+    log.info(f"[!] Finished sending to {addr[0]}:{addr[1]} ({transfer.retransmissions} retransmissions)")
+    self.end_connection(conn.send.remote_ip, conn.send.remote_port)
+
+  # Sends the file to every client at once, a single event loop drives all the transfers,
+  # clients that send a request meanwhile are served too
+  # With fanout, each chunk is encoded once and sent to every client in lockstep (FanOutGroup)
+  # Striped clients have their own sockets, their transfers run beside the loop
+  def broadcast_parallel(self, fanout: bool = False):
+    striped = [StripedTransfer(self, addr[0], addr[1], self.file_path, self.stream_counts[addr]) for addr in self.listen_addresses if self.stream_counts.get(addr, 1) > 1]
+    for transfer in striped:
+      transfer.start()
+    loop = EventLoop(self)
+    group = FanOutGroup(self, self.file_path) if fanout else None
+    def on_request(addr: tuple[str, int], segment: Segment):
+      if segment.range is not None:
+        # a corrupted block, sent alone
+        if addr not in loop.tasks:
+          log.info(f"[!] Received request from {addr[0]}:{addr[1]} for {segment.range[1]} bytes at {segment.range[0]}")
+          loop.add_task(SendFileTask(self, addr[0], addr[1], self.file_path, byte_range=segment.range))
+        return
+      if addr in self.listen_addresses:
+        return
+      self.listen_addresses.append(addr)
+      log.info(f"[!] Received request from {addr[0]}:{addr[1]}")
+      loop.add_task(SendFileTask(self, addr[0], addr[1], self.file_path, group))
+    loop.register_on_request(on_request)
+    for addr in self.listen_addresses:
+      if self.stream_counts.get(addr, 1) == 1:
+        loop.add_task(SendFileTask(self, addr[0], addr[1], self.file_path, group))
+    loop.run(self.repair_wait)
+    loop.close()
+    for transfer in striped:
+      transfer.join()
+    if group is not None:
+      log.info(f"[!] Fan out: {group.encodings} chunk encodings for {len(self.listen_addresses)} clients")
+    log.info(f"[!] Chunk cache {self.chunk_cache}")
+    if self.compression is not None:
+      log.info(f"[!] Compression ({self.compression}) {self.compressor}")
 
   def handle_message(self, message: MessageInfo):
-    print("==========================")
-    print("Received message from ", message.ip, message.port)
-    print(message.segment)
-    print("==========================")
+    if log.tracing:
+      log.trace("==========================\nReceived message from %s %d\n%s\n==========================", message.ip, message.port, message.segment)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("port", type=int)
     parser.add_argument("input_path", type=str)
+    parser.add_argument("--congestion", type=str, default=CONGESTION_CONTROL, choices=CONGESTION_CONTROLS)
+    parser.add_argument("--compression", type=str, default=COMPRESSION, choices=list(CODECS), help="codec of the chunks sent, raw by default")
+    parser.add_argument("--fanout", action="store_true", help="encode each chunk once for every client")
+    parser.add_argument("--streams", type=int, default=MAX_STREAMS, help="most parallel connections granted to a client")
+    parser.add_argument("--pmtu", type=str, default=PMTU_MODE, choices=PMTU_MODES, help="how the payload size towards a peer is found")
+    parser.add_argument("--payload-size", type=int, default=MAX_PAYLOAD, help="largest payload taken, in bytes")
+    parser.add_argument("--digest", type=str, default=DIGEST_ALGORITHM, choices=DIGEST_ALGORITHMS, help="digest of the content sent in the metadata")
+    parser.add_argument("--no-block-hashes", action="store_true", help="only the whole content digest, no per block hashes")
+    parser.add_argument("--stats-file", type=str, default=None, help="writes a json snapshot of the connection statistics there")
+    parser.add_argument("--stats-interval", type=float, default=SNAPSHOT_INTERVAL, help="seconds between two snapshots")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serves the statistics in the prometheus format on this port")
+    parser.add_argument("--no-batch-io", action="store_true", help="one system call per datagram, no sendmmsg, recvmmsg or segmentation offload")
+    parser.add_argument("--no-buffer-tuning", action="store_true", help="keeps the system default socket buffers instead of sizing them for the window")
+    log.add_arguments(parser)
     args = parser.parse_args()
+    log.from_args(args)
 
     server = Server('127.0.0.1', args.port, args.input_path)
+    server.congestion_control = args.congestion
+    server.compression = args.compression
+    server.payload_size = min(max(args.payload_size, MIN_PAYLOAD), MAX_PAYLOAD)
+    server.path_payloads.mode = args.pmtu
+    server.digest_algorithm = args.digest
+    server.block_hashes = not args.no_block_hashes
+    if args.no_batch_io:
+      server.batch_socket.mmsg = server.batch_socket.gso = False
+    server.socket_buffers.auto_tune = not args.no_buffer_tuning
+    server.max_streams = args.streams
+    exporters = start_exporters(server.stats, args.stats_file, args.stats_interval, args.metrics_port)
     
     server.run()
-    if ENABLE_PARALLEL:
-      for addr, thread in server.listen_addresses.items():
-        if thread is not None:
-          thread.resume()
-      for addr, thread in server.listen_addresses.items():
-        if thread is not None:
-          thread.join()
+    if ENABLE_PARALLEL or args.fanout:
+      server.broadcast_parallel(args.fanout)
     else:
       server.broadcast()
-    print("[!] Finished broadcasting")
\ No newline at end of file
+    print("[!] Finished broadcasting")
+    for exporter in exporters:
+      exporter.close()
\ No newline at end of file
@@ -0,0 +1,66 @@
+import socket
+import sys
+import typing
+from log import log
+from stats import SocketStats
+
+
+# socket buffers follow the windows of the connections, off keeps the system defaults
+AUTO_TUNE = True
+# smallest and largest buffers asked for, the kernel caps them at net.core.rmem_max / wmem_max
+# unless the process may go past it (SO_RCVBUFFORCE / SO_SNDBUFFORCE, CAP_NET_ADMIN)
+SOCKET_BUFFER_MIN = 256 * 1024
+SOCKET_BUFFER_MAX = 16 * 1024 * 1024
+# linux options, not exposed by the socket module
+IS_LINUX = sys.platform.startswith("linux")
+SO_RCVBUFFORCE = getattr(socket, "SO_RCVBUFFORCE", 33) if IS_LINUX else None
+SO_SNDBUFFORCE = getattr(socket, "SO_SNDBUFFORCE", 32) if IS_LINUX else None
+
+# Receive and send buffers of a socket sized for the bytes in flight (bandwidth delay product:
+# window x segment size) instead of the system defaults, so a full window is queued by the kernel
+# rather than dropped while the receiver is busy. Buffers only grow, and the sizes kept are the
+# ones the kernel granted (linux doubles what is asked for its bookkeeping, caps it at the
+# system maximum), read back after each change.
+class SocketBuffers:
+  def __init__(self, sock: socket.socket, stats: SocketStats) -> None:
+    self.sock = sock
+    self.stats = stats
+    self.auto_tune = AUTO_TUNE
+    self.receive = self.stats.receive_buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+    self.send = self.stats.send_buffer = sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+    # bytes last asked for each way, a window is only asked again once it grows past them
+    self.receive_asked = 0
+    self.send_asked = 0
+
+  # Grows the buffers to hold receive_bytes and send_bytes in flight
+  def fit(self, receive_bytes: int, send_bytes: int):
+    if not self.auto_tune:
+      return
+    receive_bytes = min(max(receive_bytes, SOCKET_BUFFER_MIN), SOCKET_BUFFER_MAX)
+    send_bytes = min(max(send_bytes, SOCKET_BUFFER_MIN), SOCKET_BUFFER_MAX)
+    if receive_bytes > self.receive_asked:
+      self.receive_asked = receive_bytes
+      self.receive = self.stats.receive_buffer = max(self.receive, self.__grow(socket.SO_RCVBUF, SO_RCVBUFFORCE, receive_bytes))
+    if send_bytes > self.send_asked:
+      self.send_asked = send_bytes
+      self.send = self.stats.send_buffer = max(self.send, self.__grow(socket.SO_SNDBUF, SO_SNDBUFFORCE, send_bytes))
+
+  # Asks for size bytes of option, forced past the system maximum where the process may,
+  # returns the size granted
+  def __grow(self, option: int, force: typing.Optional[int], size: int):
+    try:
+      self.sock.setsockopt(socket.SOL_SOCKET, option, size)
+    except OSError as e:
+      log.debug(f"[Socket] Buffer of {size} bytes refused: {e}")
+    granted = self.sock.getsockopt(socket.SOL_SOCKET, option)
+    if granted < size and force is not None:
+      try:
+        self.sock.setsockopt(socket.SOL_SOCKET, force, size)
+        granted = self.sock.getsockopt(socket.SOL_SOCKET, option)
+      except OSError:
+        pass
+    log.debug(f"[Socket] Asked for a {size} byte {'receive' if option == socket.SO_RCVBUF else 'send'} buffer, granted {granted}")
+    return granted
+
+  def __str__(self):
+    return f"receive buffer {self.receive} bytes, send buffer {self.send} bytes"
@@ -0,0 +1,225 @@
+import http.server
+import json
+import os
+import threading
+import time
+import typing
+from collections import OrderedDict
+from log import log
+
+
+# connections a node keeps the statistics of, the oldest closed ones are forgotten first
+STATS_HISTORY = 256
+# seconds between two snapshots of the statistics file
+SNAPSHOT_INTERVAL = 5.0
+
+# Counters of a connection, bumped in place by the transport (single writer, no lock) and read by
+# the exporters. Data flows one way on a connection: goodput is the payload acknowledged by the
+# peer on the sending side, the payload delivered in order on the receiving side.
+class ConnectionStats:
+  def __init__(self) -> None:
+    self.opened_at = time.monotonic()
+    self.segments_sent = 0
+    self.bytes_sent = 0
+    self.segments_received = 0
+    self.bytes_received = 0
+    self.retransmissions = 0
+    self.duplicate_acks = 0
+    self.checksum_failures = 0
+    self.acked_bytes = 0
+    self.delivered_bytes = 0
+    # last time payload was acknowledged or delivered, goodput is measured until then
+    self.progress_at = self.opened_at
+    # chunks in flight and window when the send window was last filled, with their sums to
+    # average the occupancy of the window
+    self.in_flight = 0
+    self.window = 0
+    self.in_flight_sum = 0
+    self.window_sum = 0
+    # statistics of the socket the connection uses, set by the node
+    self.socket: typing.Optional[SocketStats] = None
+
+  def on_acked(self, nbytes: int):
+    self.acked_bytes += nbytes
+    self.progress_at = time.monotonic()
+
+  def on_delivered(self, nbytes: int):
+    self.delivered_bytes += nbytes
+    self.progress_at = time.monotonic()
+
+  def on_window(self, in_flight: int, window: int):
+    self.in_flight = in_flight
+    self.window = window
+    # the window can shrink below what is in flight
+    self.in_flight_sum += min(in_flight, window)
+    self.window_sum += window
+
+  # Share of the window filled on average, near 1 for a window limited transfer
+  @property
+  def window_occupancy(self):
+    return self.in_flight_sum / self.window_sum if self.window_sum else 0.0
+
+  @property
+  def goodput(self):
+    elapsed = self.progress_at - self.opened_at
+    return max(self.acked_bytes, self.delivered_bytes) / elapsed if elapsed > 0 else 0.0
+
+# Counters of the socket of a node, shared by the statistics of its connections: the buffer sizes
+# the kernel granted (socket_buffers.py) and the datagrams it dropped because the receive buffer
+# was full (SO_RXQ_OVFL, None where the platform does not report them)
+class SocketStats:
+  def __init__(self) -> None:
+    self.receive_buffer = 0
+    self.send_buffer = 0
+    self.kernel_drops: typing.Optional[int] = None
+
+# Statistics of the connections of a node, by (local address, remote address)
+class StatsRegistry:
+  def __init__(self, history: int = STATS_HISTORY) -> None:
+    self.history = history
+    # connection, kept after it is closed until history newer ones replace it
+    self.connections: OrderedDict[typing.Tuple[typing.Tuple[str, int], typing.Tuple[str, int]], typing.Any] = OrderedDict()
+    self.__lock = threading.Lock()
+
+  def add(self, connection):
+    key = ((connection.send.ip, connection.send.port), (connection.send.remote_ip, connection.send.remote_port))
+    with self.__lock:
+      self.connections[key] = connection
+      self.connections.move_to_end(key)
+      while len(self.connections) > self.history:
+        self.connections.popitem(last=False)
+
+  # Statistics of every connection as plain values, with the rtt estimate of the connection
+  def snapshot(self):
+    with self.__lock:
+      connections = list(self.connections.items())
+    entries = []
+    for (local, remote), connection in connections:
+      stats: ConnectionStats = connection.stats
+      rtt = connection.send.rtt
+      socket_stats = stats.socket
+      entries.append({
+        'local': f"{local[0]}:{local[1]}",
+        'remote': f"{remote[0]}:{remote[1]}",
+        'connected': connection.send.is_connected or connection.receive.is_connected,
+        'seconds': time.monotonic() - stats.opened_at,
+        'segments_sent': stats.segments_sent,
+        'bytes_sent': stats.bytes_sent,
+        'segments_received': stats.segments_received,
+        'bytes_received': stats.bytes_received,
+        'retransmissions': stats.retransmissions,
+        'duplicate_acks': stats.duplicate_acks,
+        'checksum_failures': stats.checksum_failures,
+        'rtt_samples': rtt.samples,
+        'srtt': rtt.srtt,
+        'min_rtt': rtt.min_rtt,
+        'rto': rtt.rto,
+        'congestion_window': connection.send.congestion.window,
+        'receive_window': connection.send.receive_window,
+        'in_flight': stats.in_flight,
+        'window': stats.window,
+        'window_occupancy': stats.window_occupancy,
+        'goodput': stats.goodput,
+        'socket_receive_buffer': None if socket_stats is None else socket_stats.receive_buffer,
+        'socket_send_buffer': None if socket_stats is None else socket_stats.send_buffer,
+        'kernel_drops': None if socket_stats is None else socket_stats.kernel_drops,
+      })
+    return {'time': time.time(), 'connections': entries}
+
+# (name, type, help, snapshot key) of the metrics exported in the prometheus text format
+PROMETHEUS_METRICS = [
+  ("transport_segments_sent_total", "counter", "Segments sent", 'segments_sent'),
+  ("transport_bytes_sent_total", "counter", "Bytes sent, headers included", 'bytes_sent'),
+  ("transport_segments_received_total", "counter", "Segments received", 'segments_received'),
+  ("transport_bytes_received_total", "counter", "Bytes received, headers included", 'bytes_received'),
+  ("transport_retransmissions_total", "counter", "Chunks sent again", 'retransmissions'),
+  ("transport_duplicate_acks_total", "counter", "Acks that did not move the sequence base", 'duplicate_acks'),
+  ("transport_checksum_failures_total", "counter", "Segments dropped on a checksum failure", 'checksum_failures'),
+  ("transport_rtt_samples_total", "counter", "Round trip time samples", 'rtt_samples'),
+  ("transport_srtt_seconds", "gauge", "Smoothed round trip time", 'srtt'),
+  ("transport_min_rtt_seconds", "gauge", "Smallest round trip time sample", 'min_rtt'),
+  ("transport_rto_seconds", "gauge", "Retransmission timeout", 'rto'),
+  ("transport_congestion_window_segments", "gauge", "Congestion window", 'congestion_window'),
+  ("transport_receive_window_segments", "gauge", "Window advertised by the peer", 'receive_window'),
+  ("transport_in_flight_segments", "gauge", "Chunks in flight", 'in_flight'),
+  ("transport_window_occupancy_ratio", "gauge", "Average share of the window in flight", 'window_occupancy'),
+  ("transport_goodput_bytes_per_second", "gauge", "Payload acknowledged or delivered per second", 'goodput'),
+  ("transport_socket_receive_buffer_bytes", "gauge", "Receive buffer the kernel granted the socket", 'socket_receive_buffer'),
+  ("transport_socket_send_buffer_bytes", "gauge", "Send buffer the kernel granted the socket", 'socket_send_buffer'),
+  ("transport_kernel_drops_total", "counter", "Datagrams the kernel dropped on a full receive buffer of the socket", 'kernel_drops'),
+]
+
+def prometheus_text(snapshot: dict):
+  lines = []
+  for name, kind, description, key in PROMETHEUS_METRICS:
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} {kind}")
+    for entry in snapshot['connections']:
+      if entry[key] is not None:
+        lines.append(f"{name}{{local=\"{entry['local']}\",remote=\"{entry['remote']}\"}} {entry[key]}")
+  return "\n".join(lines) + "\n"
+
+# Writes a json snapshot of the registry to path every interval seconds, from a thread, replacing
+# the file at once so readers never see half of it
+class SnapshotWriter:
+  def __init__(self, registry: StatsRegistry, path: str, interval: float = SNAPSHOT_INTERVAL) -> None:
+    self.registry = registry
+    self.path = path
+    self.interval = interval
+    self.__stop = threading.Event()
+    self.__thread = threading.Thread(target=self.__run, name="stats-snapshot", daemon=True)
+    self.__thread.start()
+
+  def write(self):
+    temp_path = self.path + ".tmp"
+    with open(temp_path, "w") as f:
+      json.dump(self.registry.snapshot(), f, indent=2)
+    os.replace(temp_path, self.path)
+
+  def __run(self):
+    while not self.__stop.wait(self.interval):
+      self.write()
+
+  # Stops the thread after a last snapshot
+  def close(self):
+    self.__stop.set()
+    self.__thread.join()
+    self.write()
+
+# Serves the registry in the prometheus text format on http://ip:port/metrics, from a thread
+class MetricsServer:
+  def __init__(self, registry: StatsRegistry, port: int, ip: str = "127.0.0.1") -> None:
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path != "/metrics":
+          self.send_error(404)
+          return
+        body = prometheus_text(registry.snapshot()).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      # requests are not logged, the transport owns the terminal
+      def log_message(self, format: str, *args):
+        pass
+
+    self.server = http.server.ThreadingHTTPServer((ip, port), Handler)
+    self.port = self.server.server_address[1]
+    self.__thread = threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True)
+    self.__thread.start()
+
+  def close(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+# Exporters asked for on the command line, closed by the caller once done
+def start_exporters(registry: StatsRegistry, stats_file: typing.Optional[str], interval: float, metrics_port: typing.Optional[int]):
+  exporters: typing.List[typing.Any] = []
+  if stats_file is not None:
+    exporters.append(SnapshotWriter(registry, stats_file, interval))
+  if metrics_port is not None:
+    exporters.append(MetricsServer(registry, metrics_port))
+    log.info(f"[!] Metrics on http://127.0.0.1:{exporters[-1].port}/metrics")
+  return exporters
@@ -0,0 +1,85 @@
+import threading
+import typing
+from node import HandshakeError, MessageInfo, Node
+from log import log
+from transfer import FileTransfer, TransferError
+
+
+# parallel connections a client asks for, and the most a server grants
+STREAM_COUNT = 1
+MAX_STREAMS = 8
+
+# Extra socket of a striped transfer, bound to an ephemeral port. It shares the input mappings,
+# chunk cache, compressor, congestion control and windows, batched i/o and socket buffer settings of the node it
+# sends for.
+class StreamNode(Node):
+  def __init__(self, parent: Node) -> None:
+    super().__init__(parent.ip, 0)
+    self.input_files = parent.input_files
+    self.chunk_cache = parent.chunk_cache
+    self.congestion_control = parent.congestion_control
+    self.max_window = parent.max_window
+    self.receive_buffer_segments = parent.receive_buffer_segments
+    self.payload_size = parent.payload_size
+    self.path_payloads = parent.path_payloads
+    self.compression = parent.compression
+    self.compressor = parent.compressor
+    self.stats = parent.stats
+    self.batch_socket.mmsg = parent.batch_socket.mmsg
+    self.batch_socket.gso = self.batch_socket.gso and parent.batch_socket.gso
+    self.socket_buffers.auto_tune = parent.socket_buffers.auto_tune
+
+  def run(self):
+    pass
+
+  def handle_message(self, message: MessageInfo):
+    pass
+
+# Sends a file to one receiver over streams connections, each from its own socket with its own
+# window and sender loop (a thread), connection k sending the k-th contiguous range of chunks.
+# The metadata of each connection tells the receiver where its range starts (FileTransfer).
+# StreamNode shares the path measurements of its parent, so every connection negotiates the same
+# payload size.
+class StripedTransfer:
+  def __init__(self, node: Node, ip: str, port: int, file_path: str, streams: int) -> None:
+    self.node = node
+    self.ip = ip
+    self.port = port
+    self.file_path = file_path
+    self.streams = streams
+    self.transfers: typing.List[typing.Optional[FileTransfer]] = [None] * streams
+    self.__threads: typing.List[threading.Thread] = []
+
+  @property
+  def retransmissions(self):
+    return sum(transfer.retransmissions for transfer in self.transfers if transfer is not None)
+
+  def start(self):
+    # every stripe cuts the file in chunks of the same size, the path is measured once for all of them
+    self.node.path_payloads.get(self.ip, self.port, self.node.payload_size)
+    for stripe in range(self.streams):
+      thread = threading.Thread(target=self.__send_stripe, args=(stripe,), daemon=True)
+      thread.start()
+      self.__threads.append(thread)
+
+  def join(self):
+    for thread in self.__threads:
+      thread.join()
+    log.info(f"[!] Finished sending to {self.ip}:{self.port} over {self.streams} streams ({self.retransmissions} retransmissions)")
+
+  def run(self):
+    self.start()
+    self.join()
+
+  def __send_stripe(self, stripe: int):
+    node = StreamNode(self.node)
+    try:
+      conn = node.handshake(self.ip, self.port)
+      transfer = FileTransfer(node, conn, self.file_path, stripe, self.streams)
+      self.transfers[stripe] = transfer
+      transfer.run()
+      node.end_connection(self.ip, self.port)
+    except (HandshakeError, TransferError) as e:
+      log.error(f"[!] Stream {stripe} to {self.ip}:{self.port}: {e}")
+    finally:
+      node.get_socket().close()
@@ -0,0 +1,404 @@
+import hashlib
+import json
+import math
+import socket
+import time
+import typing
+from connection import Connection, get_seqnum_diff, increment_seqnum, timestamp
+from integrity import fit_block_size
+from log import log
+from compression import COMPRESS_AHEAD, choose_codec
+from segment import OPTION_COMPRESSED, OPTION_SACK, OPTION_TIMESTAMP, Segment, pack_timestamp
+
+
+DUPLICATE_ACK_THRESHOLD = 3
+# bytes of the metadata segment kept for the keys of the block hash list
+METADATA_SLACK = 64
+# consecutive retransmission timeouts without progress before the receiver is considered gone
+MAX_TIMEOUTS = 10
+
+class TransferError(Exception):
+  def __init__(self, message: str) -> None:
+    super().__init__(message)
+
+# Sender side of a file transfer over an established connection: the metadata segment, then every
+# chunk of the file inside the send window. Each chunk in flight has its own timer. With selective
+# repeat only the chunks that are neither cumulatively nor selectively acknowledged are resent,
+# otherwise (go back n) the whole window from the sequence base is resent. Timers use the
+# retransmission timeout of the connection, the window is the congestion window of the connection,
+# fed with the acks, losses and timeouts seen here.
+# In a striped transfer (striping.py) the file is split in stripes contiguous chunk ranges, each
+# sent by its own connection, this one sends the range of stripe. Indexes are relative to the range.
+# A byte range (offset, length) sends only the chunks covering it (a range request, OPTION_RANGE).
+class FileTransfer:
+  def __init__(self, node, conn: Connection, file_path: str, stripe: int = 0, stripes: int = 1, byte_range: typing.Optional[typing.Tuple[int, int]] = None) -> None:
+    self.node = node
+    self.conn = conn
+    self.file_path = file_path
+    # shared mapping of the node
+    self.file = node.open_input(file_path)
+    self.filesize = self.file.size
+    # payload size negotiated by the connection
+    self.chunk_size = conn.send.payload_size
+    # codec of the chunks, if the receiver decodes the one of the node
+    self.codec = choose_codec(node.compression, conn.send.codecs)
+    total_chunks = math.ceil(self.filesize / self.chunk_size)
+    self.first_chunk = total_chunks * stripe // stripes
+    self.chunk_count = total_chunks * (stripe + 1) // stripes - self.first_chunk
+    if byte_range is not None:
+      self.first_chunk = min(byte_range[0] // self.chunk_size, total_chunks)
+      self.chunk_count = min(total_chunks, math.ceil(sum(byte_range) / self.chunk_size)) - self.first_chunk
+    self.metadata = {
+      'filename': file_path.split('.')[-2],
+      'extension': file_path.split('.')[-1],
+      # lets the receiver preallocate the file and write each chunk at its offset
+      'filesize': self.filesize,
+      'chunk_size': self.chunk_size,
+      # global index of the first chunk of this connection, and the number of connections
+      'first_chunk': self.first_chunk,
+      'stripe_chunks': self.chunk_count,
+      'stripes': stripes,
+      # chunks flagged compressed (OPTION_COMPRESSED) are compressed with it
+      'compression': self.codec
+    }
+    # digest of the content, checked by the receiver as it writes and identifying the content
+    # to resume, with as many block hashes as the metadata segment has room for
+    block_size = None
+    if node.block_hashes:
+      self.metadata['digest'] = {'algorithm': node.digest_algorithm, 'value': "0" * hashlib.new(node.digest_algorithm).digest_size * 2}
+      block_size = fit_block_size(self.filesize, self.chunk_size - len(json.dumps(self.metadata)) - METADATA_SLACK)
+    self.metadata['digest'] = self.file.digest(node.digest_algorithm, block_size).to_metadata()
+    # sequence number of chunk 0, known once the metadata is acknowledged
+    self.first_seq_num = None
+    self.next_chunk = 0
+    # chunks sent at least once, acks are valid up to there
+    self.sent_chunks = 0
+    # send time of the chunks in flight
+    self.sent_at: typing.Dict[int, float] = {}
+    # chunks sent more than once, their acks are not rtt samples (Karn's rule)
+    self.retransmitted: typing.Set[int] = set()
+    self.retransmissions = 0
+    # loss recovery, chunks fast retransmitted until the chunks sent before the loss are acked
+    self.recovery_point: typing.Optional[int] = None
+    self.fast_retransmitted: typing.Set[int] = set()
+    self.duplicate_acks = 0
+    # consecutive timeouts since the last ack that moved the sequence base
+    self.timeouts = 0
+    # next zero window probe
+    self.probe_at: typing.Optional[float] = None
+    # acked chunks when the last ack was handled
+    self.acked_before = 0
+    # (ack number, window, sack blocks) of the last ack, an ack repeating all of them is a duplicate
+    self.last_ack: typing.Optional[typing.Tuple[int, typing.Optional[int], typing.Optional[bytes]]] = None
+    self.metadata_seq_num = None
+    self.metadata_segment = None
+    self.metadata_retry_at = 0.0
+    # chunks below it are being compressed or were
+    self.prefetched = 0
+
+  @property
+  def remote(self):
+    return (self.conn.send.remote_ip, self.conn.send.remote_port)
+
+  # Number of chunks cumulatively acknowledged
+  @property
+  def acked_chunks(self):
+    return get_seqnum_diff(self.first_seq_num, self.conn.send.seq_num)
+
+  @property
+  def is_done(self):
+    return self.first_seq_num is not None and self.acked_chunks >= self.chunk_count
+
+  @property
+  def is_failed(self):
+    return self.timeouts > MAX_TIMEOUTS
+
+  def seq_num(self, index: int):
+    return increment_seqnum(self.first_seq_num, index)
+
+  # Payload bytes of the chunks from first to end (excluded), the last chunk of the file is shorter
+  def chunks_length(self, first: int, end: int):
+    return min((self.first_chunk + end) * self.chunk_size, self.filesize) - min((self.first_chunk + first) * self.chunk_size, self.filesize)
+
+  def run(self):
+    self.send_metadata()
+    while not self.is_done and not self.is_failed:
+      self.step()
+    self.close()
+    if self.is_failed:
+      raise TransferError(f"no ack from {self.remote[0]}:{self.remote[1]} after {MAX_TIMEOUTS} timeouts")
+
+  # The mapping stays open for the other transfers of the node, it is closed with the node
+  def close(self):
+    pass
+
+  # Sends the metadata segment, chunks are sent once it is acknowledged
+  def start(self):
+    self.metadata_seq_num = self.conn.send.seq_num
+    self.metadata_segment = Segment.metadata(self.metadata_seq_num, self.metadata)
+    # a receiver resuming the transfer acks the metadata together with the chunks it already holds
+    self.conn.send.next_seq_num = increment_seqnum(self.metadata_seq_num, 1 + self.chunk_count)
+    log.debug("waiting for ack")
+    self.node.send(*self.remote, self.metadata_segment)
+    self.metadata_retry_at = time.monotonic() + self.conn.send.rto
+    # the first chunks are compressed while the metadata is on its way
+    self.prefetch(0, 0)
+
+  # acknowledged once the sequence base moves past the metadata segment
+  @property
+  def is_metadata_acked(self):
+    return self.conn.send.seq_num != self.metadata_seq_num
+
+  def resend_metadata(self):
+    log.debug("[Socket timeout] ACK not received")
+    self.node.send(*self.remote, self.metadata_segment)
+
+  def on_metadata_acked(self):
+    log.debug(f"[Segment SEQ={self.metadata_seq_num}] Ack metadata received")
+    self.first_seq_num = increment_seqnum(self.metadata_seq_num)
+    # chunks the receiver already holds are skipped
+    self.acked_before = self.next_chunk = self.sent_chunks = self.acked_chunks
+    self.conn.send.next_seq_num = self.seq_num(self.sent_chunks)
+    if self.sent_chunks:
+      log.info(f"[!] Resuming from chunk {self.first_chunk + self.sent_chunks}, {self.sent_chunks} chunks already held")
+
+  def send_metadata(self):
+    self.start()
+    self.node.wait_for(lambda: self.is_metadata_acked, self.resend_metadata, self.conn.send.rtt, None)
+    self.on_metadata_acked()
+
+  # Headers and payload of the segment of chunk index, with the send time as timestamp
+  def encode_chunk(self, index: int):
+    options = {OPTION_TIMESTAMP: pack_timestamp(timestamp())} if self.conn.send.use_timestamps else {}
+    payload, payload_sum, compressed = self.read_chunk(index)
+    if compressed:
+      options[OPTION_COMPRESSED] = b""
+    segment = Segment.data(self.seq_num(index), payload, payload_sum, options=options or None)
+    return segment.pack_headers(), segment.payload
+
+  # (payload, payload sum, compressed) of chunk index, compressed by the compressor of the node
+  # when the transfer has a codec
+  def read_chunk(self, index: int):
+    if self.codec is None:
+      return (*self.node.read_chunk(self.file, self.first_chunk + index, self.chunk_size), False)
+    return self.node.compressor.get(self.compressor_key(index), self.chunk_loader(index))
+
+  def compressor_key(self, index: int):
+    return (self.file.path, self.chunk_size, self.first_chunk + index, self.codec)
+
+  def chunk_loader(self, index: int):
+    return lambda: self.file.chunk(self.first_chunk + index, self.chunk_size)
+
+  # Hands the chunks from start to COMPRESS_AHEAD past the window end to the compressor, so they
+  # are ready by the time the window reaches them
+  def prefetch(self, start: int, window_end: int):
+    if self.codec is None:
+      return
+    end = min(window_end + COMPRESS_AHEAD, self.chunk_count)
+    for index in range(max(self.prefetched, start), end):
+      self.node.compressor.prefetch(self.compressor_key(index), self.chunk_loader(index))
+    self.prefetched = max(self.prefetched, end)
+
+  # Sends chunks in one batch (Node.send_batch)
+  def send_chunks(self, indexes: typing.List[int]):
+    if not indexes:
+      return
+    datagrams = []
+    for index in indexes:
+      if log.tracing:
+        log.trace("[Segment SEQ=%d] Sent", self.seq_num(index))
+      datagrams.append(self.encode_chunk(index))
+      if index < self.sent_chunks:
+        self.retransmissions += 1
+        self.conn.stats.retransmissions += 1
+        self.retransmitted.add(index)
+    self.node.send_batch(*self.remote, datagrams)
+    now = time.monotonic()
+    for index in indexes:
+      self.sent_at[index] = now
+
+  # Sends the chunks that fit in the window and were not sent yet
+  def send_window(self):
+    acked_chunks = self.acked_chunks
+    # after a go back n rewind the receiver may already hold chunks past next_chunk
+    self.next_chunk = max(self.next_chunk, acked_chunks)
+    window = self.conn.send.window_size
+    if window == 0:
+      window = self.zero_window_probe()
+    else:
+      self.probe_at = None
+    window_end = min(acked_chunks + window, self.send_limit())
+    self.prefetch(self.next_chunk, window_end)
+    if self.next_chunk < window_end:
+      # the whole burst leaves at once
+      self.send_chunks(list(range(self.next_chunk, window_end)))
+      self.next_chunk = window_end
+      if self.next_chunk > self.sent_chunks:
+        self.sent_chunks = self.next_chunk
+        self.conn.send.next_seq_num = self.seq_num(self.sent_chunks)
+    self.conn.stats.on_window(self.next_chunk - acked_chunks, window)
+
+  # Chunks up to this index may be sent
+  def send_limit(self):
+    return self.chunk_count
+
+  # The receiver closed its window: once nothing is in flight, one chunk is sent every rto to
+  # learn when it opens again, in case the window update is lost
+  def zero_window_probe(self):
+    if self.in_flight():
+      return 0
+    now = time.monotonic()
+    if self.probe_at is None:
+      self.probe_at = now + self.conn.send.rto
+    if now < self.probe_at:
+      return 0
+    self.probe_at = now + self.conn.send.rto
+    return 1
+
+  # Without timestamps the rtt is measured from the newest chunk an ack covers, if it was sent once
+  def sample_rtt(self, index: int):
+    if self.conn.send.use_timestamps or index in self.retransmitted or index not in self.sent_at:
+      return
+    self.conn.send.rtt.sample(time.monotonic() - self.sent_at[index])
+
+  # Chunks sent but not acknowledged yet
+  def in_flight(self):
+    acked_chunks = self.acked_chunks
+    for index in list(self.sent_at):
+      if index < acked_chunks or self.conn.send.is_selectively_acked(self.seq_num(index)):
+        self.sent_at.pop(index)
+    return self.sent_at
+
+  # Seconds until the earliest retransmission timer expires
+  def timeout(self):
+    deadline = self.deadline()
+    if deadline is None:
+      return self.conn.send.rto
+    # a zero timeout would make the socket non blocking
+    return max(0.001, deadline - time.monotonic())
+
+  def retransmit_expired(self):
+    now = time.monotonic()
+    rto = self.conn.send.rto
+    in_flight = self.in_flight()
+    if not in_flight or min(in_flight.values()) + rto > now:
+      return
+    # one timeout for the whole window: back off until the next ack gives a new sample, shrink the window
+    self.timeouts += 1
+    self.conn.send.rtt.on_timeout()
+    self.conn.send.congestion.on_timeout()
+    self.end_recovery()
+    if not self.conn.send.selective_repeat:
+      # go back n, send everything again from the sequence base
+      self.retransmitted.update(in_flight)
+      self.sent_at.clear()
+      self.next_chunk = self.acked_chunks
+      return
+    # resend the oldest chunks the window allows, the others wait for a new timeout
+    expired = sorted(in_flight)
+    self.send_chunks(expired[:self.conn.send.window_size])
+    for index in expired[self.conn.send.window_size:]:
+      self.retransmitted.add(index)
+      self.sent_at[index] = now
+
+  # Chunks considered lost before their timer expires: DUPLICATE_ACK_THRESHOLD chunks sent after
+  # them are selectively acknowledged, or the base chunk got that many duplicate acks
+  def lost_chunks(self):
+    acked_chunks = self.acked_chunks
+    lost = []
+    sacked_after = 0
+    for index in range(self.next_chunk - 1, acked_chunks - 1, -1):
+      if self.conn.send.is_selectively_acked(self.seq_num(index)):
+        sacked_after += 1
+      elif sacked_after >= DUPLICATE_ACK_THRESHOLD:
+        lost.append(index)
+    if self.duplicate_acks >= DUPLICATE_ACK_THRESHOLD and acked_chunks < self.next_chunk and acked_chunks not in lost:
+      lost.append(acked_chunks)
+    return [index for index in sorted(lost) if index not in self.fast_retransmitted]
+
+  # Fast retransmit, the window is reduced once per window of data (until the recovery point is acked)
+  def retransmit_lost(self):
+    lost = self.lost_chunks()
+    if not lost:
+      return
+    if self.recovery_point is None:
+      self.conn.send.congestion.on_loss()
+      self.recovery_point = self.next_chunk
+    self.fast_retransmitted.update(lost)
+    self.send_chunks(lost)
+
+  def end_recovery(self):
+    self.recovery_point = None
+    self.fast_retransmitted.clear()
+    self.duplicate_acks = 0
+
+  def on_ack(self, segment: Segment):
+    newly_acked = self.acked_chunks - self.acked_before
+    acked_before = self.acked_before
+    self.acked_before = self.acked_chunks
+    # a window update or new sack blocks tell something, they are not duplicates
+    ack = (segment.ack_num, segment.window, segment.options.get(OPTION_SACK))
+    is_duplicate = ack == self.last_ack
+    self.last_ack = ack
+    if log.tracing:
+      log.trace("[Segment SEQ=%d] Ack received, sequence base = %d", segment.ack_num - 1, self.conn.send.seq_num)
+    if newly_acked > 0:
+      self.timeouts = 0
+      self.conn.stats.on_acked(self.chunks_length(acked_before, self.acked_chunks))
+      self.sample_rtt(self.acked_chunks - 1)
+      self.duplicate_acks = 0
+      if self.recovery_point is not None and self.acked_chunks >= self.recovery_point:
+        self.end_recovery()
+      if self.recovery_point is None:
+        self.conn.send.congestion.on_ack(newly_acked)
+    else:
+      if is_duplicate and self.acked_chunks < self.next_chunk:
+        self.duplicate_acks += 1
+        self.conn.stats.duplicate_acks += 1
+    if self.conn.send.selective_repeat:
+      self.retransmit_lost()
+
+  # One round of the send loop: fill the window, wait for an ack and resend what is lost or timed out
+  def step(self):
+    self.send_window()
+    try:
+      received = self.node.listen(self.timeout())
+      if received is not None:
+        addr, segment = received
+        if segment.flags.ack and addr == self.remote:
+          self.on_ack(segment)
+    except socket.timeout:
+      log.debug("[Socket timeout] ACK not received")
+    self.retransmit_expired()
+
+  # Event driven interface, for a loop that reads the socket itself (event_loop.EventLoop):
+  # start, then on_segment for each segment of the peer (once the node processed it) and
+  # on_timer when the deadline passed
+
+  def on_segment(self, segment: Segment):
+    if self.first_seq_num is None:
+      if not self.is_metadata_acked:
+        return
+      self.on_metadata_acked()
+    elif segment.flags.ack and not segment.flags.syn and not segment.flags.fin:
+      self.on_ack(segment)
+    if not self.is_done:
+      self.send_window()
+
+  def on_timer(self):
+    if self.first_seq_num is None:
+      self.conn.send.rtt.on_timeout()
+      self.resend_metadata()
+      self.metadata_retry_at = time.monotonic() + self.conn.send.rto
+      return
+    self.retransmit_expired()
+    self.send_window()
+
+  # Time the earliest timer expires at (metadata, chunk in flight or zero window probe), or None
+  def deadline(self):
+    if self.first_seq_num is None:
+      return self.metadata_retry_at
+    in_flight = self.in_flight()
+    if in_flight:
+      return min(in_flight.values()) + self.conn.send.rto
+    return self.probe_at